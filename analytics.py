@@ -0,0 +1,228 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+import connection
+
+_lock = threading.Lock()
+_watcher = None
+_data_version = None
+_snapshot = None
+
+
+def _positions(trips, trip_ids):
+    """
+    Return the row position in the trips frame of each trip ID.
+    """
+    return np.searchsorted(trips['id'].to_numpy(), trip_ids.to_numpy())
+
+
+def _months(days):
+    """
+    Convert stored day numbers, with NaN for missing days, to the first day of their month.
+    """
+    return days.to_numpy().astype('datetime64[D]').astype('datetime64[M]')
+
+
+def load_snapshot(conn):
+    """
+    Read the columns used by the analytics from every table into pandas data frames.
+
+    All four tables are read in one transaction, one query per table, so the snapshot is consistent.
+    Stored day numbers are converted to NumPy dates here, and every booking is tagged with the row of
+    its trip in the trips frame, so the aggregations below only need vectorized array operations.
+
+    Args:
+        conn (sqlite3.Connection): The connection to read from, in autocommit mode.
+
+    Returns:
+        dict: The keys 'trips', 'activities', 'flights' and 'hotels', each holding a data frame.
+    """
+    conn.execute('BEGIN')
+    try:
+        trips = pd.read_sql_query('SELECT id, start_day, end_day FROM trips ORDER BY id', conn,
+                                  dtype={'start_day': 'float64', 'end_day': 'float64'})
+        activities = pd.read_sql_query('SELECT trip_id, day, cost FROM activities', conn,
+                                       dtype={'day': 'float64', 'cost': 'float64'})
+        flights = pd.read_sql_query('SELECT trip_id, airline, cost FROM flights', conn, dtype={'cost': 'float64'})
+        hotels = pd.read_sql_query('SELECT trip_id, name, rooms, cost FROM hotels', conn,
+                                   dtype={'rooms': 'float64', 'cost': 'float64'})
+    finally:
+        conn.rollback()
+
+    trips['start_month'] = _months(trips['start_day'])
+    trips['days'] = (trips['end_day'] - trips['start_day'] + 1).clip(lower=1)
+    trips['nights'] = (trips['end_day'] - trips['start_day']).clip(lower=1)
+
+    activities['month'] = _months(activities['day'])
+    for bookings in (activities, flights, hotels):
+        bookings['trip_pos'] = _positions(trips, bookings['trip_id'])
+    # Flights and hotels aren't dated, so they are counted in the month their trip starts.
+    for bookings in (flights, hotels):
+        bookings['month'] = trips['start_month'].to_numpy()[bookings['trip_pos'].to_numpy()]
+    hotels['nights'] = trips['nights'].to_numpy()[hotels['trip_pos'].to_numpy()]
+    return {'trips': trips, 'activities': activities, 'flights': flights, 'hotels': hotels}
+
+
+def get_snapshot():
+    """
+    Return the analytics snapshot, reloading it only if the database changed since it was taken.
+
+    Changes are detected with ``PRAGMA data_version`` on a dedicated connection, which moves whenever
+    any other connection, in this process or another, commits a write.
+
+    Returns:
+        dict: The snapshot, as returned by ``load_snapshot``. Treat it as read-only.
+    """
+    global _watcher, _data_version, _snapshot
+    with _lock:
+        if _watcher is None:
+            _watcher = connection.open_connection()
+        data_version = _watcher.execute('PRAGMA data_version').fetchone()[0]
+        if _snapshot is None or data_version != _data_version:
+            _snapshot = load_snapshot(_watcher)
+            _data_version = data_version
+        return _snapshot
+
+
+@connection.on_database_change
+def _forget_snapshot():
+    """
+    Drop the snapshot and close the watcher connection when the application switches databases.
+    """
+    global _watcher, _data_version, _snapshot
+    with _lock:
+        if _watcher is not None:
+            _watcher.close()
+        _watcher = _data_version = _snapshot = None
+
+
+def _trip_costs(snapshot):
+    """
+    Return the total cost of every trip, aligned with the rows of the trips frame.
+    """
+    count = len(snapshot['trips'])
+    totals = np.zeros(count)
+    for kind in ('activities', 'flights', 'hotels'):
+        bookings = snapshot[kind]
+        totals += np.bincount(bookings['trip_pos'], weights=bookings['cost'].fillna(0).to_numpy(), minlength=count)
+    return totals
+
+
+def summary(snapshot=None):
+    """
+    Compute the headline figures across all trips.
+
+    Args:
+        snapshot (dict): The snapshot to use. Defaults to ``get_snapshot()``.
+
+    Returns:
+        dict: The keys 'trips', 'total_spend', 'hotel_cost_per_night' (hotel spend divided by hotel
+            nights) and 'cost_per_traveler_day' (total spend divided by the number of trip days).
+    """
+    snapshot = snapshot if snapshot is not None else get_snapshot()
+    hotels = snapshot['hotels']
+    priced = hotels['cost'].notna()
+    nights = hotels['nights'][priced].sum()
+    total_spend = _trip_costs(snapshot).sum()
+    days = snapshot['trips']['days'].sum()
+    return {
+        'trips': len(snapshot['trips']),
+        'total_spend': float(total_spend),
+        'hotel_cost_per_night': float(hotels['cost'][priced].sum() / nights) if nights else 0.0,
+        'cost_per_traveler_day': float(total_spend / days) if days else 0.0,
+    }
+
+
+def spend_by_month(snapshot=None):
+    """
+    Total the spend on activities, flights and hotels per calendar month.
+
+    Activities count in the month they take place; flights and hotels in the month their trip starts.
+
+    Args:
+        snapshot (dict): The snapshot to use. Defaults to ``get_snapshot()``.
+
+    Returns:
+        pandas.DataFrame: One row per month, indexed by the first day of the month, with the columns
+            'activities', 'flights', 'hotels' and 'total'.
+    """
+    snapshot = snapshot if snapshot is not None else get_snapshot()
+    spend = pd.DataFrame({
+        kind: snapshot[kind].groupby('month')['cost'].sum()
+        for kind in ('activities', 'flights', 'hotels')
+    }).fillna(0.0)
+    spend.index.name = 'month'
+    spend['total'] = spend.sum(axis=1)
+    return spend
+
+
+def top_airlines(snapshot=None, limit=10):
+    """
+    Rank airlines by the number of flights booked with them.
+
+    Args:
+        snapshot (dict): The snapshot to use. Defaults to ``get_snapshot()``.
+        limit (int): The number of airlines to return.
+
+    Returns:
+        pandas.DataFrame: Indexed by airline, with the columns 'flights', 'total_cost' and 'average_cost'.
+    """
+    snapshot = snapshot if snapshot is not None else get_snapshot()
+    airlines = snapshot['flights'].groupby('airline')['cost'].agg(['size', 'sum', 'mean'])
+    airlines.columns = ['flights', 'total_cost', 'average_cost']
+    return airlines.sort_values(['flights', 'total_cost'], ascending=False).head(limit)
+
+
+def hotel_cost_per_night(snapshot=None, limit=10):
+    """
+    Compute the average cost per night of the most booked hotels.
+
+    Hotels aren't dated, so each stay is taken to last the nights of its trip.
+
+    Args:
+        snapshot (dict): The snapshot to use. Defaults to ``get_snapshot()``.
+        limit (int): The number of hotels to return.
+
+    Returns:
+        pandas.DataFrame: Indexed by hotel name, with the columns 'stays', 'nights', 'cost_per_night'
+            and 'cost_per_room_night'.
+    """
+    snapshot = snapshot if snapshot is not None else get_snapshot()
+    hotels = snapshot['hotels']
+    hotels = hotels[hotels['cost'].notna()]
+    grouped = pd.DataFrame({
+        'name': hotels['name'],
+        'cost': hotels['cost'],
+        'nights': hotels['nights'],
+        'room_nights': hotels['nights'] * hotels['rooms'].fillna(1).clip(lower=1),
+    }).groupby('name').agg(stays=('cost', 'size'), cost=('cost', 'sum'), nights=('nights', 'sum'),
+                           room_nights=('room_nights', 'sum'))
+    grouped['cost_per_night'] = grouped['cost'] / grouped['nights']
+    grouped['cost_per_room_night'] = grouped['cost'] / grouped['room_nights']
+    grouped = grouped.sort_values(['stays', 'cost'], ascending=False).head(limit)
+    return grouped[['stays', 'nights', 'cost_per_night', 'cost_per_room_night']]
+
+
+def cost_per_traveler_day(snapshot=None):
+    """
+    Compute the average spend per traveler-day of the trips starting in each month.
+
+    Trips don't record how many people travel, so each trip counts as one traveler and a
+    traveler-day is one day of a trip.
+
+    Args:
+        snapshot (dict): The snapshot to use. Defaults to ``get_snapshot()``.
+
+    Returns:
+        pandas.Series: The spend per traveler-day, indexed by the first day of the start month.
+    """
+    snapshot = snapshot if snapshot is not None else get_snapshot()
+    trips = snapshot['trips']
+    per_month = pd.DataFrame({
+        'month': trips['start_month'],
+        'cost': _trip_costs(snapshot),
+        'days': trips['days'],
+    }).groupby('month')[['cost', 'days']].sum()
+    return (per_month['cost'] / per_month['days']).rename('cost_per_traveler_day')
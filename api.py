@@ -0,0 +1,607 @@
+import argparse
+import gzip
+import json
+import mimetypes
+import re
+import sqlite3
+import sys
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import attachments
+import conflicts
+import db
+import instrumentation
+from cache import TRIP_LIST
+
+# Responses smaller than this many bytes are sent uncompressed, since gzip wouldn't pay for itself.
+MIN_GZIP_SIZE = 1024
+GZIP_LEVEL = 5
+
+# Most sub-requests accepted in one /batch call.
+MAX_BATCH = 50
+
+# Seconds an idle keep-alive connection is held open.
+KEEP_ALIVE_TIMEOUT = 30
+
+# Path serving the instrumentation metrics in Prometheus text format, outside the JSON routes.
+METRICS_PATH = '/metrics'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Attachment uploads (PUT /attachments/{name}) and downloads (GET /attachments/{digest}/{name}) are raw
+# bytes rather than JSON. Uploads larger than MAX_ATTACHMENT_SIZE bytes are refused.
+ATTACHMENTS_PATH = '/attachments/'
+MAX_ATTACHMENT_SIZE = 100 * 1024 * 1024
+# Blobs are named by their content, so a URL's response never changes and clients may cache it for good.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class ApiError(Exception):
+    """
+    An error reported to the client as a JSON body with the given HTTP status.
+
+    Attributes:
+        status (http.HTTPStatus): The response status.
+        message (str): The error message.
+        details (dict): Further fields of the error body.
+    """
+
+    def __init__(self, status, message, **details):
+        """
+        Initialize an ApiError object.
+
+        Args:
+            status (http.HTTPStatus): The response status.
+            message (str): The error message.
+            **details: Further fields of the error body, e.g. the conflicts behind a 409.
+        """
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.details = details
+
+
+def _require_trip(trip_id):
+    """
+    Return a trip, raising a 404 ApiError if it doesn't exist.
+    """
+    trip = db.get_trip_by_id(trip_id)
+    if trip is None:
+        raise ApiError(HTTPStatus.NOT_FOUND, f'Trip {trip_id} not found')
+    return trip
+
+
+def _fields(body, *names):
+    """
+    Pick the named fields from a JSON request body, raising a 400 ApiError if any is missing.
+    """
+    if not isinstance(body, dict):
+        raise ApiError(HTTPStatus.BAD_REQUEST, 'Request body must be a JSON object')
+    missing = [name for name in names if name not in body]
+    if missing:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f'Missing fields: {", ".join(missing)}')
+    return [body[name] for name in names]
+
+
+def _limit(query, default, maximum):
+    """
+    Read the 'limit' query parameter, clamped to 1..maximum, raising a 400 ApiError if it isn't an integer.
+    """
+    value = query.get('limit', default)
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"'limit' must be an integer, not {value!r}") from None
+    return max(1, min(limit, maximum))
+
+
+def _check_conflicts(body, found):
+    """
+    Raise a 409 ApiError listing scheduling conflicts, unless the request body sets 'allow_conflicts'.
+    """
+    if found and not body.get('allow_conflicts'):
+        raise ApiError(HTTPStatus.CONFLICT, 'Conflicts with the schedule; send "allow_conflicts": true to save anyway',
+                       conflicts=found)
+
+
+def list_trips(query, body):
+    """
+    GET /trips: one page of trips, with the list_trips keyset (after_date, after_id), limit and q.
+    """
+    after = (query['after_date'], int(query['after_id'])) if 'after_date' in query else None
+    return HTTPStatus.OK, db.list_trips(after=after, limit=_limit(query, 50, 500),
+                                        filter=query.get('q'))
+
+
+def create_trip(query, body):
+    """
+    POST /trips: create a trip from 'title', 'start_date' and 'end_date'; 409 if it overlaps another trip.
+    """
+    title, start_date, end_date = _fields(body, 'title', 'start_date', 'end_date')
+    _check_conflicts(body, conflicts.check_trip(start_date, end_date))
+    trip_id = db.create_trip(title, start_date, end_date)
+    return HTTPStatus.CREATED, db.get_trip_by_id(trip_id)
+
+
+def get_trip(query, body, trip_id):
+    """
+    GET /trips/{id}: one trip.
+    """
+    return HTTPStatus.OK, _require_trip(trip_id)
+
+
+def delete_trip(query, body, trip_id):
+    """
+    DELETE /trips/{id}: delete a trip and its bookings.
+    """
+    _require_trip(trip_id)
+    db.delete_trip(trip_id)
+    return HTTPStatus.NO_CONTENT, None
+
+
+def get_bundle(query, body, trip_id):
+    """
+    GET /trips/{id}/bundle: a trip with its flights, hotels and full itinerary.
+    """
+    bundle = db.load_trip_bundle(trip_id)
+    if bundle is None:
+        raise ApiError(HTTPStatus.NOT_FOUND, f'Trip {trip_id} not found')
+    return HTTPStatus.OK, bundle
+
+
+def get_flights(query, body, trip_id):
+    """
+    GET /trips/{id}/flights: the flights of a trip.
+    """
+    _require_trip(trip_id)
+    return HTTPStatus.OK, db.get_flights_for_trip(trip_id)
+
+
+def add_flight(query, body, trip_id):
+    """
+    POST /trips/{id}/flights: book a flight; returns the trip's flights.
+    """
+    _require_trip(trip_id)
+    db.add_flight_to_trip(trip_id, *_fields(body, 'cost', 'seat', 'airline', 'flight_number', 'confirmation'))
+    return HTTPStatus.CREATED, db.get_flights_for_trip(trip_id)
+
+
+def get_hotels(query, body, trip_id):
+    """
+    GET /trips/{id}/hotels: the hotels of a trip.
+    """
+    _require_trip(trip_id)
+    return HTTPStatus.OK, db.get_hotels_for_trip(trip_id)
+
+
+def add_hotel(query, body, trip_id):
+    """
+    POST /trips/{id}/hotels: book a hotel; returns the trip's hotels.
+    """
+    _require_trip(trip_id)
+    db.add_hotel_to_trip(trip_id, *_fields(body, 'cost', 'name', 'address', 'rooms', 'confirmation'))
+    return HTTPStatus.CREATED, db.get_hotels_for_trip(trip_id)
+
+
+def get_activities(query, body, trip_id):
+    """
+    GET /trips/{id}/activities: one day's activities with date, else the itinerary from start to end.
+    """
+    trip = _require_trip(trip_id)
+    if 'date' in query:
+        return HTTPStatus.OK, db.get_itinerary_for_trip(trip_id, query['date'])
+    return HTTPStatus.OK, db.get_itinerary_range(trip_id, query.get('start', trip.start_date),
+                                                 query.get('end', trip.end_date))
+
+
+def add_activity(query, body, trip_id):
+    """
+    POST /trips/{id}/activities: add an activity; returns the activities of its day. 409 if it is double
+    booked or outside the trip's dates.
+    """
+    _require_trip(trip_id)
+    date, name = _fields(body, 'date', 'name')
+    file_path = body.get('file_path')
+    if attachments.parse_reference(file_path) and not attachments.exists(file_path):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f'Upload the attachment with PUT {ATTACHMENTS_PATH}{{name}} first')
+    _check_conflicts(body, conflicts.check_activity(trip_id, date, body.get('time')))
+    db.add_activity_to_day(trip_id, date, name, body.get('time'), body.get('cost'), body.get('file_path'),
+                           body.get('address'), body.get('confirmation'))
+    return HTTPStatus.CREATED, db.get_itinerary_for_trip(trip_id, date)
+
+
+def get_totals(query, body, trip_id):
+    """
+    GET /trips/{id}/totals: a trip's spending from the cost rollups.
+    """
+    _require_trip(trip_id)
+    return HTTPStatus.OK, db.get_trip_totals(trip_id)
+
+
+def get_conflicts(query, body, trip_id):
+    """
+    GET /trips/{id}/conflicts: overlapping trips, double bookings, activities outside the trip's dates
+    and nights without a hotel.
+    """
+    _require_trip(trip_id)
+    return HTTPStatus.OK, conflicts.trip_conflicts(trip_id)
+
+
+def audit(query, body):
+    """
+    GET /conflicts: the scheduling conflicts of every trip that isn't archived.
+    """
+    return HTTPStatus.OK, conflicts.audit()
+
+
+def search(query, body):
+    """
+    GET /search: full-text search with q and limit.
+    """
+    return HTTPStatus.OK, db.search(query.get('q', ''), limit=_limit(query, 20, 100))
+
+
+def batch(query, body):
+    """
+    POST /batch: run a list of GET paths, or {'path', 'etag'} objects, in one call.
+    """
+    requests = _fields(body, 'requests')[0]
+    if not isinstance(requests, list) or len(requests) > MAX_BATCH:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"'requests' must be a list of at most {MAX_BATCH} paths")
+    responses = []
+    for request in requests:
+        path, etag = (request.get('path'), request.get('etag')) if isinstance(request, dict) else (request, None)
+        if not isinstance(path, str):
+            responses.append({'path': path, 'status': HTTPStatus.BAD_REQUEST, 'etag': None,
+                              'body': {'error': 'Each request must be a path or a {"path", "etag"} object'}})
+            continue
+        status, etag, payload = dispatch('GET', path, if_none_match=etag)
+        responses.append({'path': path, 'status': status, 'etag': etag, 'body': payload})
+    return HTTPStatus.OK, {'responses': responses}
+
+
+# (method, path pattern, handler, versioned). Handlers take the parsed query string, the decoded JSON body
+# and the path parameters, and return (status, payload). Versioned routes get an ETag from the version
+# of their trip, or of the trip list for routes without a trip_id.
+ROUTES = [
+    ('GET', r'/trips', list_trips, True),
+    ('POST', r'/trips', create_trip, False),
+    ('GET', r'/trips/(?P<trip_id>\d+)', get_trip, True),
+    ('DELETE', r'/trips/(?P<trip_id>\d+)', delete_trip, False),
+    ('GET', r'/trips/(?P<trip_id>\d+)/bundle', get_bundle, True),
+    ('GET', r'/trips/(?P<trip_id>\d+)/flights', get_flights, True),
+    ('POST', r'/trips/(?P<trip_id>\d+)/flights', add_flight, False),
+    ('GET', r'/trips/(?P<trip_id>\d+)/hotels', get_hotels, True),
+    ('POST', r'/trips/(?P<trip_id>\d+)/hotels', add_hotel, False),
+    ('GET', r'/trips/(?P<trip_id>\d+)/activities', get_activities, True),
+    ('POST', r'/trips/(?P<trip_id>\d+)/activities', add_activity, False),
+    ('GET', r'/trips/(?P<trip_id>\d+)/totals', get_totals, True),
+    # Conflicts depend on the other trips too, so the trip's version can't validate them.
+    ('GET', r'/trips/(?P<trip_id>\d+)/conflicts', get_conflicts, False),
+    ('GET', r'/conflicts', audit, False),
+    ('GET', r'/search', search, False),
+    ('POST', r'/batch', batch, False),
+]
+ROUTES = [(method, re.compile(pattern), handler, versioned) for method, pattern, handler, versioned in ROUTES]
+
+
+def _etag(scope):
+    """
+    Return the weak ETag for the current version of a trip or of the trip list, or None.
+    """
+    version = db.get_trip_version(scope)
+    return f'W/"{version[0]}.{version[1]}"' if version else None
+
+
+def _matches(if_none_match, etag):
+    """
+    Return whether an If-None-Match header value matches an ETag.
+    """
+    if not if_none_match or etag is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or etag[2:] in tags
+
+
+def dispatch(method, target, body=None, if_none_match=None):
+    """
+    Route one API request to its handler.
+
+    Args:
+        method (str): The HTTP method.
+        target (str): The request path, with an optional query string.
+        body: The decoded JSON request body, or None.
+        if_none_match (str): The If-None-Match header sent by the client, if any.
+
+    Returns:
+        tuple: (status, etag, payload). The payload is None for 204 and 304 responses; for errors it
+            is a dictionary with an 'error' message, and the 'conflicts' of a 409.
+    """
+    url = urlsplit(target or '')
+    query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+    allowed = []
+    for route_method, pattern, handler, versioned in ROUTES:
+        match = pattern.fullmatch(url.path.rstrip('/') or '/')
+        if match is None:
+            continue
+        if route_method != method:
+            allowed.append(route_method)
+            continue
+        params = {name: int(value) for name, value in match.groupdict().items()}
+        etag = _etag(params.get('trip_id', TRIP_LIST)) if versioned else None
+        if _matches(if_none_match, etag):
+            return HTTPStatus.NOT_MODIFIED, etag, None
+        try:
+            status, payload = handler(query, body, **params)
+        except ApiError as error:
+            return error.status, None, {'error': error.message, **error.details}
+        except KeyError as error:
+            return HTTPStatus.BAD_REQUEST, None, {'error': f'Missing parameter: {error.args[0]}'}
+        except (ValueError, TypeError, sqlite3.IntegrityError) as error:
+            return HTTPStatus.BAD_REQUEST, None, {'error': str(error)}
+        return status, etag if status == HTTPStatus.OK else None, payload
+    if allowed:
+        return HTTPStatus.METHOD_NOT_ALLOWED, None, {'error': f'Allowed methods: {", ".join(allowed)}'}
+    return HTTPStatus.NOT_FOUND, None, {'error': f'No resource at {url.path}'}
+
+
+def _encode(value):
+    """
+    JSON encoder fallback for db.py records.
+    """
+    if isinstance(value, db.Record):
+        return value.as_dict()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _accepts_gzip(accept_encoding):
+    """
+    Return whether an Accept-Encoding header value allows a gzip response.
+    """
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def _byte_range(header, size):
+    """
+    Parse a single-range Range header into the offsets of the bytes to send.
+
+    Args:
+        header (str): The Range header value, or None.
+        size (int): The length of the content.
+
+    Returns:
+        tuple: (start, end), end exclusive, or None to send the whole content, as for a missing,
+            malformed or multi-range header.
+
+    Raises:
+        ValueError: If the range starts beyond the content.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        if int(last) == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - int(last), 0), size
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError('Range starts beyond the content')
+    return start, min(int(last) + 1, size) if last else size
+
+
+class _BoundedReader:
+    """
+    Reads exactly Content-Length bytes of a request body, so an upload can be streamed from the
+    connection without reading into the next request.
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size):
+        if self.remaining <= 0:
+            return b''
+        data = self.stream.read(min(size, self.remaining))
+        if not data:
+            raise ConnectionError('Client closed the connection before the end of the upload')
+        self.remaining -= len(data)
+        return data
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """
+    Serves the JSON API over HTTP/1.1, keeping connections alive between requests.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'TravelPlannerAPI/1.0'
+    timeout = KEEP_ALIVE_TIMEOUT
+    # Headers and body are written separately; without TCP_NODELAY the body waits on the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle()
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+    def _handle(self):
+        if self.command == 'GET' and urlsplit(self.path).path == METRICS_PATH:
+            self._send_data(HTTPStatus.OK, None, instrumentation.metrics_text().encode(), PROMETHEUS_CONTENT_TYPE)
+            return
+        path = urlsplit(self.path).path
+        if path.startswith(ATTACHMENTS_PATH):
+            reference = unquote(path[len(ATTACHMENTS_PATH):])
+            if self.command == 'PUT' or self.command == 'POST':
+                self._receive_attachment(reference)
+            elif self.command == 'GET':
+                self._send_attachment(reference)
+            else:
+                self._send(HTTPStatus.METHOD_NOT_ALLOWED, None, {'error': 'Attachments support GET and PUT'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Without a valid length the body can't be skipped, so the connection can't be reused.
+            self.close_connection = True
+            self._send(HTTPStatus.BAD_REQUEST, None, {'error': 'Content-Length must be a non-negative integer'})
+            return
+        body = None
+        if length:
+            try:
+                body = json.loads(self.rfile.read(length))
+            except ValueError:
+                self._send(HTTPStatus.BAD_REQUEST, None, {'error': 'Request body is not valid JSON'})
+                return
+        status, etag, payload = dispatch(self.command, self.path, body, self.headers.get('If-None-Match'))
+        self._send(status, etag, payload)
+
+    def _send(self, status, etag, payload):
+        data = b'' if payload is None else json.dumps(payload, default=_encode, separators=(',', ':')).encode()
+        self._send_data(status, etag, data, 'application/json')
+
+    def _send_data(self, status, etag, data, content_type):
+        self.send_response(status)
+        if data:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Vary', 'Accept-Encoding')
+            if len(data) >= MIN_GZIP_SIZE and _accepts_gzip(self.headers.get('Accept-Encoding')):
+                data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+                self.send_header('Content-Encoding', 'gzip')
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(data)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _receive_attachment(self, name):
+        """
+        Stream an uploaded body into the attachment store and reply with its reference.
+        """
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            self.close_connection = True
+            self._send(HTTPStatus.LENGTH_REQUIRED, None, {'error': 'Content-Length is required'})
+            return
+        if int(length) > MAX_ATTACHMENT_SIZE:
+            self.close_connection = True
+            self._send(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, None,
+                       {'error': f'Attachments are limited to {MAX_ATTACHMENT_SIZE:,} bytes'})
+            return
+        try:
+            reference = attachments.store(_BoundedReader(self.rfile, int(length)), name)
+        except ConnectionError:
+            self.close_connection = True
+            return
+        self._send(HTTPStatus.CREATED, None, {'file_path': reference})
+
+    def _send_attachment(self, reference):
+        """
+        Serve a stored attachment, or the byte range the client asked for, from a memory map.
+        """
+        digest, _, name = reference.partition('/')
+        file_path = f'{digest}/{name or "attachment"}'
+        if attachments.parse_reference(file_path) is None:
+            self._send(HTTPStatus.NOT_FOUND, None, {'error': 'Not found'})
+            return
+        etag = f'"{digest}"'
+        tags = [tag.strip() for tag in (self.headers.get('If-None-Match') or '').split(',')]
+        if etag in tags or 'W/' + etag in tags:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', IMMUTABLE_CACHE_CONTROL)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        try:
+            with attachments.map_attachment(file_path) as mapped:
+                size = len(mapped)
+                try:
+                    byte_range = _byte_range(self.headers.get('Range'), size)
+                except ValueError:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                start, end = byte_range or (0, size)
+                self.send_response(HTTPStatus.OK if byte_range is None else HTTPStatus.PARTIAL_CONTENT)
+                self.send_header('Content-Type', mimetypes.guess_type(name)[0] or 'application/octet-stream')
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', IMMUTABLE_CACHE_CONTROL)
+                if name:
+                    self.send_header('Content-Disposition', f"inline; filename*=UTF-8''{quote(name)}")
+                if byte_range is not None:
+                    self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+                self.send_header('Content-Length', str(end - start))
+                self.end_headers()
+                with memoryview(mapped) as view:
+                    for offset in range(start, end, attachments.CHUNK_SIZE):
+                        self.wfile.write(view[offset:min(offset + attachments.CHUNK_SIZE, end)])
+        except FileNotFoundError:
+            self._send(HTTPStatus.NOT_FOUND, None, {'error': 'Not found'})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(host='127.0.0.1', port=8000, verbose=False):
+    """
+    Create the API server. Call ``serve_forever()`` on the result to start handling requests.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on, or 0 for any free port.
+        verbose (bool): Log every request to stderr.
+
+    Returns:
+        http.server.ThreadingHTTPServer: The server, handling each connection on its own thread.
+    """
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    server.daemon_threads = True
+    server.verbose = verbose
+    return server
+
+
+def main(argv=None):
+    """
+    Command line entry point: serve the JSON API until interrupted.
+    """
+    parser = argparse.ArgumentParser(description='Serve trips, flights, hotels and activities as a JSON API.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    parser.add_argument('--instrument', action='store_true',
+                        help=f'record query metrics, served at {METRICS_PATH} (also enabled by TRIPS_INSTRUMENT=1)')
+    args = parser.parse_args(argv)
+
+    if args.instrument:
+        instrumentation.enable()
+    server = serve(args.host, args.port, args.verbose)
+    print(f'Serving on http://{server.server_address[0]}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,59 @@
+import functools
+import mimetypes
+
 import streamlit as st
-from db import create_trip, get_all_trips, get_trip_by_id, add_flight_to_trip, add_hotel_to_trip, add_activity_to_day, \
-    get_itinerary_for_trip, delete_trip, get_flights_for_trip, get_hotels_for_trip
+import analytics
+import attachments
+import instrumentation
+from conflicts import check_activity, check_trip, trip_conflicts
+from bulk_export import export_text
+from db import create_trip, list_trips, add_flight_to_trip, add_hotel_to_trip, add_activity_to_day, delete_trip, search, \
+    get_flights_for_trip, get_hotels_for_trip, get_itinerary_for_trip, get_itinerary_range, get_trip_by_id, \
+    get_trip_totals, clone_trip, delete_trips, archive_trips
+from dates import from_day
 from datetime import datetime, timedelta
 
+# Number of itinerary days shown at a time on the trip detail page
+ITINERARY_WINDOW_DAYS = 7
+
+# Number of trips shown per page of the saved trips list
+TRIP_PAGE_SIZE = 25
+
+# Number of scheduling conflicts listed in a dialog before the rest are summarized
+CONFLICTS_SHOWN = 5
+
+# Export formats offered on the trip detail page: label -> (format, MIME type)
+EXPORT_FORMATS = {
+    'Calendar (ICS)': ('ics', 'text/calendar'),
+    'CSV': ('csv', 'text/csv'),
+    'JSON Lines': ('jsonl', 'application/jsonl'),
+}
+
 # Hide the sidebar and set the app to fullscreen
 st.set_page_config(layout="wide")
 
+# Collect the database statistics of this run while the performance panel is open. Widget callbacks run
+# before the script and fragments rerun without it, so the statistics are kept in the session state for
+# them to add to until a full run has shown them in the panel.
+if st.session_state.get('show_performance_panel'):
+    instrumentation.enable()
+rerun_stats = st.session_state['rerun_stats'] = instrumentation.start_rerun(st.session_state.get('rerun_stats'))
+
 
-@st.experimental_dialog("Create a New Trip")
+def counted_in_rerun(function):
+    """
+    Decorate a widget callback, fragment or dialog so its db.py calls are counted in the statistics the
+    performance panel shows for the next full run, rather than in an earlier run or nowhere.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        st.session_state['rerun_stats'] = instrumentation.start_rerun(st.session_state.get('rerun_stats'))
+        return function(*args, **kwargs)
+    return wrapper
+
+
+@st.dialog("Create a New Trip")
+@counted_in_rerun
 def create_trip_modal():
     """
     Display a modal dialog for creating a new trip.
@@ -18,6 +64,7 @@ def create_trip_modal():
     trip_title = st.text_input('Trip Title')
     start_date = st.date_input('Start Date', value=datetime.now())
     end_date = st.date_input('End Date', value=datetime.now())
+    show_conflicts(check_trip(start_date, end_date))
 
     if not trip_title:
         st.warning("Trip title is required.")
@@ -32,96 +79,457 @@ def create_trip_modal():
         st.rerun()
 
 
-@st.experimental_dialog("Add Activity")
-def add_activity_dialog(trip_id, date):
+@st.dialog("Clone Trip")
+@counted_in_rerun
+def clone_trip_modal(trip):
     """
-    Display a dialog for adding a new activity to a trip.
+    Display a modal dialog for copying a trip with all its bookings to new dates.
+
+    Args:
+        trip (Trip): The trip to copy.
+
+    The copy starts on the chosen date, and every activity keeps its day within the trip. The new trip
+    is opened once it has been created.
+    """
+    title = st.text_input('Trip Title', value=trip.title, key='clone_trip_title')
+    start_date = st.date_input('Start Date', value=from_day(trip.start_day), key='clone_trip_start')
+    show_conflicts(check_trip(start_date, start_date + timedelta(days=trip.end_day - trip.start_day)))
+    if not title:
+        st.warning("Trip title is required.")
+    if st.button('Clone Trip', key='clone_trip_confirm', disabled=not title):
+        new_trip_id = clone_trip(trip.id, start_date, title)
+        if new_trip_id is None:
+            st.error('This trip no longer exists, so it could not be cloned.')
+        else:
+            st.session_state['selected_trip_id'] = new_trip_id
+            st.rerun()
+
+
+def add_activity_form(trip_id, date):
+    """
+    Display a form for adding a new activity to a trip.
+
+    Args:
+        trip_id (int): The ID of the trip to add the activity to.
+        date (str): The date of the activity in 'YYYY-MM-DD' format.
+
+    The activity is saved by the submit button's callback, before the enclosing fragment re-renders.
+    """
+    key = f'activity_{trip_id}_{date}'
+    with st.form(key=f'{key}_form', clear_on_submit=True):
+        st.text_input('Activity Name', key=f'{key}_name')
+        st.time_input('Time', key=f'{key}_time')
+        st.number_input('Cost', min_value=0.0, step=0.01, key=f'{key}_cost')
+        st.text_input('Address (Optional)', key=f'{key}_address')
+        st.text_input('Confirmation Number (Optional)', key=f'{key}_confirmation')
+        st.file_uploader('Attachment (Optional)', key=f'{key}_file')
+        st.form_submit_button('Add Activity', on_click=submit_activity, args=(trip_id, date))
+
+
+@counted_in_rerun
+def submit_activity(trip_id, date):
+    """
+    Save the activity entered in a day's Add Activity form, unless it conflicts with the schedule.
 
     Args:
         trip_id (int): The ID of the trip to add the activity to.
         date (str): The date of the activity in 'YYYY-MM-DD' format.
 
-    This function allows users to input activity details and adds the activity to the specified trip and date.
+    A conflicting activity is held in the session state instead, until the user adds it anyway or
+    cancels it below the day's activities.
     """
-    activity_name = st.text_input('Activity Name')
-    activity_time = st.time_input('Time')
-    activity_cost = st.number_input('Cost', min_value=0.0, step=0.01)
-    activity_address = st.text_input('Address (Optional)')
-    activity_confirmation = st.text_input('Confirmation Number (Optional)')
+    key = f'activity_{trip_id}_{date}'
+    activity_name = st.session_state[f'{key}_name']
+    activity_time = st.session_state[f'{key}_time']
 
     if not activity_name or activity_time is None:
-        st.warning("Activity name and time are required.")
-        add_activity_button_disabled = True
-    else:
-        add_activity_button_disabled = False
+        st.session_state[f'{key}_message'] = ('warning', "Activity name and time are required.")
+        return
 
-    activity_time_str = activity_time.strftime('%I:%M %p')
+    activity = (activity_name, activity_time, st.session_state[f'{key}_cost'], st.session_state.get(f'{key}_file'),
+                st.session_state[f'{key}_address'], st.session_state[f'{key}_confirmation'])
+    conflicts = check_activity(trip_id, date, activity_time)
+    if conflicts:
+        st.session_state[f'{key}_pending'] = (activity, conflicts)
+        return
+    save_activity(trip_id, date, activity)
 
-    if st.button('Add Activity', key=f'add_activity_dialog_btn_{trip_id}_{date}',
-                 disabled=add_activity_button_disabled):
-        add_activity_to_day(trip_id, date, activity_name, activity_time_str, activity_cost, None, activity_address,
-                            activity_confirmation)
-        st.success('Activity added successfully!')
-        st.session_state['show_activity_dialog'] = False
-        st.rerun()
 
+@counted_in_rerun
+def save_activity(trip_id, date, activity):
+    """
+    Store an activity entered in a day's Add Activity form, with its attachment.
 
-@st.experimental_dialog("Add Flight")
-def add_flight_dialog(trip_id):
+    Args:
+        trip_id (int): The ID of the trip to add the activity to.
+        date (str): The date of the activity in 'YYYY-MM-DD' format.
+        activity (tuple): The name, time, cost, uploaded file or None, address and confirmation number.
+    """
+    key = f'activity_{trip_id}_{date}'
+    st.session_state.pop(f'{key}_pending', None)
+    name, time, cost, uploaded, address, confirmation = activity
+    file_path = attachments.store(uploaded, uploaded.name) if uploaded is not None else None
+    add_activity_to_day(trip_id, date, name, time, cost, file_path, address, confirmation)
+    st.session_state[f'{key}_message'] = ('success', 'Activity added successfully!')
+    st.session_state['booking_saved'] = True
+
+
+def show_pending_activity(trip_id, date):
+    """
+    Display the conflicts of an activity held back by ``submit_activity``, with buttons to add it anyway
+    or to cancel it.
+
+    Args:
+        trip_id (int): The ID of the trip.
+        date (str): The date of the activity in 'YYYY-MM-DD' format.
+    """
+    key = f'activity_{trip_id}_{date}'
+    pending = st.session_state.get(f'{key}_pending')
+    if pending is None:
+        return
+    activity, conflicts = pending
+    st.warning(f'{activity[0]} conflicts with the schedule:\n' +
+               '\n'.join(f"- {conflict['message']}" for conflict in conflicts))
+    col1, col2 = st.columns(2)
+    col1.button('Add anyway', key=f'{key}_confirm', on_click=save_activity, args=(trip_id, date, activity))
+    col2.button('Cancel', key=f'{key}_cancel', on_click=st.session_state.pop, args=(f'{key}_pending',))
+
+
+def add_flight_form(trip_id):
     """
-    Display a dialog for adding flight details to a trip.
+    Display a form for adding flight details to a trip.
 
     Args:
         trip_id (int): The ID of the trip to add the flight details to.
 
-    This function allows users to input flight information and adds it to the specified trip.
+    The flight is saved by the submit button's callback, before the enclosing fragment re-renders.
+    """
+    key = f'flight_{trip_id}'
+    with st.form(key=f'{key}_form', clear_on_submit=True):
+        st.number_input('Cost', min_value=0.0, step=0.01, key=f'{key}_cost')
+        st.text_input('Seat Number', key=f'{key}_seat')
+        st.text_input('Airline', key=f'{key}_airline')
+        st.text_input('Flight Number', key=f'{key}_number')
+        st.text_input('Confirmation Number', key=f'{key}_confirmation')
+        st.form_submit_button('Add Flight', on_click=submit_flight, args=(trip_id,))
+
+
+@counted_in_rerun
+def submit_flight(trip_id):
+    """
+    Save the flight entered in a trip's Add Flight form.
+
+    Args:
+        trip_id (int): The ID of the trip to add the flight details to.
     """
-    flight_cost = st.number_input('Cost', min_value=0.0, step=0.01)
-    flight_seat = st.text_input('Seat Number')
-    flight_airline = st.text_input('Airline')
-    flight_number = st.text_input('Flight Number')
-    flight_confirmation = st.text_input('Confirmation Number')
+    key = f'flight_{trip_id}'
+    flight_airline = st.session_state[f'{key}_airline']
+    flight_number = st.session_state[f'{key}_number']
+    flight_confirmation = st.session_state[f'{key}_confirmation']
 
     if not flight_airline or not flight_confirmation or not flight_number:
-        st.warning("Airline, flight number, and confirmation number are required.")
-        add_flight_button_disabled = True
-    else:
-        add_flight_button_disabled = False
+        st.session_state[f'{key}_message'] = ('warning', "Airline, flight number, and confirmation number are required.")
+        return
 
-    if st.button('Add Flight', key=f'add_flight_dialog_btn_{trip_id}', disabled=add_flight_button_disabled):
-        add_flight_to_trip(trip_id, flight_cost, flight_seat, flight_airline, flight_number, flight_confirmation)
-        st.success('Flight added successfully!')
-        st.session_state['show_flight_dialog'] = False
-        st.rerun()
+    add_flight_to_trip(trip_id, st.session_state[f'{key}_cost'], st.session_state[f'{key}_seat'], flight_airline,
+                       flight_number, flight_confirmation)
+    st.session_state[f'{key}_message'] = ('success', 'Flight added successfully!')
+    st.session_state['booking_saved'] = True
 
 
-@st.experimental_dialog("Add Hotel")
-def add_hotel_dialog(trip_id):
+def add_hotel_form(trip_id):
     """
-    Display a dialog for adding hotel details to a trip.
+    Display a form for adding hotel details to a trip.
 
     Args:
         trip_id (int): The ID of the trip to add the hotel details to.
 
-    This function allows users to input hotel information and adds it to the specified trip.
+    The hotel is saved by the submit button's callback, before the enclosing fragment re-renders.
+    """
+    key = f'hotel_{trip_id}'
+    with st.form(key=f'{key}_form', clear_on_submit=True):
+        st.number_input('Cost', min_value=0.0, step=0.01, key=f'{key}_cost')
+        st.text_input('Hotel Name', key=f'{key}_name')
+        st.text_input('Address', key=f'{key}_address')
+        st.number_input('Number of Rooms', min_value=1, step=1, key=f'{key}_rooms')
+        st.text_input('Confirmation Number', key=f'{key}_confirmation')
+        st.form_submit_button('Add Hotel', on_click=submit_hotel, args=(trip_id,))
+
+
+@counted_in_rerun
+def submit_hotel(trip_id):
+    """
+    Save the hotel entered in a trip's Add Hotel form.
+
+    Args:
+        trip_id (int): The ID of the trip to add the hotel details to.
     """
-    hotel_cost = st.number_input('Cost', min_value=0.0, step=0.01)
-    hotel_name = st.text_input('Hotel Name')
-    hotel_address = st.text_input('Address')
-    hotel_rooms = st.number_input('Number of Rooms', min_value=1, step=1)
-    hotel_confirmation = st.text_input('Confirmation Number')
+    key = f'hotel_{trip_id}'
+    hotel_name = st.session_state[f'{key}_name']
+    hotel_address = st.session_state[f'{key}_address']
+    hotel_confirmation = st.session_state[f'{key}_confirmation']
 
     if not hotel_name or not hotel_address or not hotel_confirmation:
-        st.warning("Hotel name, address, and confirmation number are required.")
-        add_hotel_button_disabled = True
-    else:
-        add_hotel_button_disabled = False
+        st.session_state[f'{key}_message'] = ('warning', "Hotel name, address, and confirmation number are required.")
+        return
+
+    add_hotel_to_trip(trip_id, st.session_state[f'{key}_cost'], hotel_name, hotel_address,
+                      st.session_state[f'{key}_rooms'], hotel_confirmation)
+    st.session_state[f'{key}_message'] = ('success', 'Hotel added successfully!')
+    st.session_state['booking_saved'] = True
+
+
+def show_conflicts(conflicts, limit=CONFLICTS_SHOWN):
+    """
+    Display scheduling conflicts as warnings.
+
+    Args:
+        conflicts (list): Conflict dictionaries from the conflicts module.
+        limit (int): The number of conflicts to list before summarizing the rest, or None to list all.
+    """
+    for conflict in conflicts[:limit]:
+        st.warning(conflict['message'])
+    if limit is not None and len(conflicts) > limit:
+        st.caption(f'...and {len(conflicts) - limit} more conflicts.')
+
+
+def rerun_app_after_booking():
+    """
+    Rerun the whole app if a form callback has just saved a booking.
+
+    The callbacks of the forms inside a fragment only rerun that fragment, which would leave the budget
+    showing the trip's totals, and the itinerary's scheduling warnings the trip's conflicts, from before
+    the booking. Call at the start of the fragments holding those forms.
+    """
+    if st.session_state.pop('booking_saved', False):
+        st.rerun(scope='app')
+
+
+def show_form_message(key):
+    """
+    Display and clear the result message left by a form's submit callback.
+
+    Args:
+        key (str): The form's session state key prefix.
+    """
+    message = st.session_state.pop(f'{key}_message', None)
+    if message:
+        level, text = message
+        getattr(st, level)(text)
+
+
+@st.fragment
+@counted_in_rerun
+def show_flights(trip_id):
+    """
+    Display the flight details of a trip with a form to add another flight.
+
+    Args:
+        trip_id (int): The ID of the trip.
+
+    Runs as a fragment. Adding a flight reruns the whole page, so the budget includes it.
+    """
+    rerun_app_after_booking()
+    flights = get_flights_for_trip(trip_id)
+    if flights:
+        st.write(f'**Flight Details:** ${get_trip_totals(trip_id)["flights"]:,.2f} total')
+        for flight in flights:
+            st.write(
+                f'Cost: ${flight.cost}, Seat: {flight.seat}, Airline: {flight.airline}, Flight Number: {flight.flight_number}, Confirmation: {flight.confirmation}')
+
+    show_form_message(f'flight_{trip_id}')
+    with st.popover('Add Flight'):
+        add_flight_form(trip_id)
+
+
+@st.fragment
+@counted_in_rerun
+def show_hotels(trip_id):
+    """
+    Display the hotel details of a trip with a form to add another hotel.
+
+    Args:
+        trip_id (int): The ID of the trip.
+
+    Runs as a fragment. Adding a hotel reruns the whole page, so the budget includes it.
+    """
+    rerun_app_after_booking()
+    hotels = get_hotels_for_trip(trip_id)
+    if hotels:
+        st.write(f'**Hotel Details:** ${get_trip_totals(trip_id)["hotels"]:,.2f} total')
+        for hotel in hotels:
+            st.write(
+                f'Cost: ${hotel.cost}, Name: {hotel.name}, Address: {hotel.address}, Rooms: {hotel.rooms}, Confirmation: {hotel.confirmation}')
+
+    show_form_message(f'hotel_{trip_id}')
+    with st.popover('Add Hotel'):
+        add_hotel_form(trip_id)
+
+
+@st.fragment
+@counted_in_rerun
+def show_itinerary_day(trip_id, day):
+    """
+    Display the activities planned for one day of a trip with a form to add another activity.
+
+    Args:
+        trip_id (int): The ID of the trip.
+        day (datetime.date): The day to display.
+
+    Runs as a fragment. Adding an activity reruns the whole page, so the budget includes it.
+    """
+    rerun_app_after_booking()
+    date = day.isoformat()
+    st.subheader(day.strftime("%A, %B %d, %Y"))
+    # Activities come back from the database already ordered by time.
+    activities = get_itinerary_for_trip(trip_id, date)
+    day_cost = get_trip_totals(trip_id)['days'].get(date)
+    if day_cost:
+        st.write(f'**Day total:** ${day_cost:,.2f}')
+
+    if activities:
+        for activity in activities:
+            activity_info = []
+            if activity.time:
+                activity_info.append(f"**{activity.time}:**")
+            if activity.name:
+                activity_info.append(f"{activity.name}\n")
+            if activity.cost:
+                activity_info.append(f"**Cost:** ${activity.cost}\n")
+            if activity.address:
+                activity_info.append(f"**Address:** {activity.address}\n")
+            if activity.confirmation:
+                activity_info.append(f"**Confirmation:** {activity.confirmation}\n")
+
+            st.write('\n'.join(activity_info))
+            if activity.file_path:
+                show_attachment(activity)
+
+    show_form_message(f'activity_{trip_id}_{date}')
+    show_pending_activity(trip_id, date)
+    with st.popover('Add Activity'):
+        add_activity_form(trip_id, date)
+
+
+def show_attachment(activity):
+    """
+    Display an activity's attachment behind a toggle, with a download button and a preview of images.
+
+    Args:
+        activity (Activity): The activity, whose file_path refers to the attachment store.
+
+    The file is read, through a memory map, only while its toggle is on, so showing the itinerary
+    doesn't load every attachment.
+    """
+    attachment = attachments.parse_reference(activity.file_path)
+    if attachment is None:
+        st.write(f"**File:** {activity.file_path}")
+        return
+    name = attachment[1]
+    if not st.toggle(f'Attachment: {name}', key=f'attachment_{activity.id}'):
+        return
+    try:
+        content = attachments.read_attachment(activity.file_path)
+    except FileNotFoundError:
+        st.warning(f"The attachment {name} is missing.")
+        return
+    mime = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if mime.startswith('image/'):
+        try:
+            st.image(content, caption=name)
+        except OSError:
+            st.caption(f"{name} can't be previewed.")
+    st.download_button(f'Download {name}', content, file_name=name, mime=mime,
+                       key=f'download_attachment_{activity.id}')
+
+
+@st.fragment
+@counted_in_rerun
+def show_export(trip_id):
+    """
+    Display controls to download a trip's export.
+
+    Args:
+        trip_id (int): The ID of the trip to export.
+
+    The export is only generated after the user asks for it, so ordinary page runs don't pay for it.
+    """
+    format_label = st.selectbox('Export format', list(EXPORT_FORMATS), key=f'export_format_{trip_id}')
+    export_format, mime = EXPORT_FORMATS[format_label]
+    if st.button('Prepare Export', key=f'export_{trip_id}'):
+        st.download_button(f'Download {format_label}', data=export_text(export_format, [trip_id]),
+                           file_name=f'trip-{trip_id}.{export_format}', mime=mime, key=f'download_{trip_id}')
 
-    if st.button('Add Hotel', key=f'add_hotel_dialog_btn_{trip_id}', disabled=add_hotel_button_disabled):
-        add_hotel_to_trip(trip_id, hotel_cost, hotel_name, hotel_address, hotel_rooms, hotel_confirmation)
-        st.success('Hotel added successfully!')
-        st.session_state['show_hotel_dialog'] = False
-        st.rerun()
+
+@st.fragment
+@counted_in_rerun
+def show_itinerary(trip_id, start_date, end_date):
+    """
+    Display one window of a trip's itinerary with controls to move between windows.
+
+    Args:
+        trip_id (int): The ID of the trip.
+        start_date (datetime.date): The first day of the trip.
+        end_date (datetime.date): The last day of the trip.
+
+    Only the days in the visible window are queried and rendered, and checked for double bookings.
+    Runs as a fragment, so moving between windows re-renders only the itinerary.
+    """
+    num_windows = ((end_date - start_date).days // ITINERARY_WINDOW_DAYS) + 1
+    window_key = f'itinerary_window_{trip_id}'
+    window = min(st.session_state.get(window_key, 0), num_windows - 1)
+    window_start = start_date + timedelta(days=window * ITINERARY_WINDOW_DAYS)
+    window_end = min(window_start + timedelta(days=ITINERARY_WINDOW_DAYS - 1), end_date)
+
+    if num_windows > 1:
+        col1, col2, col3 = st.columns([1, 4, 1])
+        with col1:
+            st.button('Previous week', key=f'itinerary_prev_{trip_id}', disabled=window == 0,
+                      on_click=set_itinerary_window, args=(window_key, window - 1))
+        with col2:
+            st.write(f'Week {window + 1} of {num_windows}')
+        with col3:
+            st.button('Next week', key=f'itinerary_next_{trip_id}', disabled=window == num_windows - 1,
+                      on_click=set_itinerary_window, args=(window_key, window + 1))
+
+    # One range query fills the read cache for every day in the window, and is reused to look for
+    # double bookings in the window only.
+    get_itinerary_range(trip_id, window_start.isoformat(), window_end.isoformat())
+    conflicts = trip_conflicts(trip_id, window_start.isoformat(), window_end.isoformat())
+    if conflicts:
+        with st.expander(f'Scheduling warnings ({len(conflicts)})'):
+            show_conflicts(conflicts, limit=None)
+    current_date = window_start
+    while current_date <= window_end:
+        show_itinerary_day(trip_id, current_date)
+        current_date += timedelta(days=1)
+
+
+def set_itinerary_window(window_key, window):
+    """
+    Move a trip's itinerary to another window.
+
+    Args:
+        window_key (str): The session state key holding the trip's current window.
+        window (int): The index of the window to show.
+    """
+    st.session_state[window_key] = window
+
+
+def show_budget(trip_id):
+    """
+    Display a trip's total spend and its breakdown by kind of booking.
+
+    Args:
+        trip_id (int): The ID of the trip.
+
+    The totals come from the trip_totals rollup, so no bookings are read to compute them.
+    """
+    totals = get_trip_totals(trip_id)
+    columns = st.columns(4)
+    for column, (label, key) in zip(columns, (('Total', 'total'), ('Flights', 'flights'), ('Hotels', 'hotels'),
+                                              ('Activities', 'activities'))):
+        column.metric(label, f'${totals[key]:,.2f}')
 
 
 def show_trip_detail(trip_id):
@@ -133,11 +541,19 @@ def show_trip_detail(trip_id):
 
     This function shows trip details, including dates, flight and hotel information, and the itinerary.
     It also provides options to add activities, flights, hotels, and delete the trip.
+    The flights, the hotels and each day of the itinerary are rendered as separate fragments, and the
+    itinerary is shown one week at a time.
     """
     trip = get_trip_by_id(trip_id)
-    start_date = datetime.strptime(trip.start_date, "%Y-%m-%d")
-    end_date = datetime.strptime(trip.end_date, "%Y-%m-%d")
-    num_days = (end_date - start_date).days + 1
+    if trip is None:
+        st.error('This trip no longer exists.')
+        if st.button('Back to all trips', key='back_to_all_trips'):
+            del st.session_state['selected_trip_id']
+            st.rerun()
+        return
+    start_date = from_day(trip.start_day)
+    end_date = from_day(trip.end_day)
+    num_days = trip.end_day - trip.start_day + 1
     header_title = f'{trip.title} ({start_date.year})'
 
     col1, col2 = st.columns([4, 1])
@@ -151,92 +567,276 @@ def show_trip_detail(trip_id):
     st.write(
         f'**Dates:** {start_date.strftime("%m/%d/%Y")} - {end_date.strftime("%m/%d/%Y")} ({num_days} day{"s" if num_days > 1 else ""})')
 
-    flights = get_flights_for_trip(trip_id)
-    if flights:
-        st.write('**Flight Details:**')
-        for flight in flights:
-            st.write(
-                f'Cost: ${flight["cost"]}, Seat: {flight["seat"]}, Airline: {flight["airline"]}, Flight Number: {flight["flight_number"]}, Confirmation: {flight["confirmation"]}')
-
-    hotels = get_hotels_for_trip(trip_id)
-    if hotels:
-        st.write('**Hotel Details:**')
-        for hotel in hotels:
-            st.write(
-                f'Cost: ${hotel["cost"]}, Name: {hotel["name"]}, Address: {hotel["address"]}, Rooms: {hotel["rooms"]}, Confirmation: {hotel["confirmation"]}')
+    show_budget(trip.id)
 
     col1, col2, col3 = st.columns(3)
     with col1:
-        if st.button('Add Flight', key=f'add_flight_{trip_id}'):
-            st.session_state['show_flight_dialog'] = True
-            add_flight_dialog(trip.id)
+        show_flights(trip.id)
     with col2:
-        if st.button('Add Hotel', key=f'add_hotel_{trip_id}'):
-            st.session_state['show_hotel_dialog'] = True
-            add_hotel_dialog(trip.id)
+        show_hotels(trip.id)
     with col3:
         if st.button('Delete Trip', key=f'delete_trip_{trip_id}', type="primary"):
             delete_trip(trip_id)
             del st.session_state['selected_trip_id']
             st.success('Trip deleted successfully!')
             st.rerun()
+        if st.button('Clone Trip', key=f'clone_trip_{trip_id}'):
+            clone_trip_modal(trip)
+        show_export(trip.id)
 
     # Display the itinerary as a calendar view
     st.header('Itinerary')
-    current_date = start_date
-    while current_date <= end_date:
-        st.subheader(current_date.strftime("%A, %B %d, %Y"))
-        activities = get_itinerary_for_trip(trip.id, current_date.strftime("%Y-%m-%d"))
-
-        # Sort activities by time
-        if activities:
-            sorted_activities = sorted(activities, key=lambda x: datetime.strptime(x['time'], '%I:%M %p') if x[
-                'time'] else datetime.max.time())
-            for activity in sorted_activities:
-                activity_info = []
-                if activity['time']:
-                    activity_info.append(f"**{activity['time']}:**")
-                if activity['name']:
-                    activity_info.append(f"{activity['name']}\n")
-                if activity['cost']:
-                    activity_info.append(f"**Cost:** ${activity['cost']}\n")
-                if activity['address']:
-                    activity_info.append(f"**Address:** {activity['address']}\n")
-                if activity['confirmation']:
-                    activity_info.append(f"**Confirmation:** {activity['confirmation']}\n")
-
-                st.write('\n'.join(activity_info))
-
-        if st.button('Add Activity', key=f'add_activity_btn_{trip_id}_{current_date.strftime("%Y-%m-%d")}'):
-            st.session_state['show_activity_dialog'] = True
-            add_activity_dialog(trip.id, current_date.strftime("%Y-%m-%d"))
+    show_itinerary(trip.id, start_date, end_date)
 
-        current_date += timedelta(days=1)
 
+@st.fragment
+@counted_in_rerun
+def show_trip_list():
+    """
+    Display the saved trips one page at a time, with a title search and a "Load more" button.
 
-# Main content
+    Each page, with the trips' totals, is fetched with one keyset query, so the cost of the list depends
+    on how many trips are shown rather than on how many exist. Trips can be selected for bulk actions, and the archived
+    trips are listed instead of the active ones when the "Archived" toggle is on. Runs as a fragment,
+    so searching and loading more re-render only the list.
+    """
+    col1, col2 = st.columns([4, 1])
+    with col1:
+        search = st.text_input('Search trips', key='trip_search', placeholder='Trip title')
+    with col2:
+        archived = st.toggle('Archived', key='trip_list_archived')
+    if st.session_state.get('trip_list_search') != (search, archived):
+        st.session_state['trip_list_search'] = (search, archived)
+        st.session_state['trip_list_pages'] = 1
+
+    trips = []
+    after = None
+    has_more = False
+    for _ in range(st.session_state.get('trip_list_pages', 1)):
+        # Ask for one extra trip to find out whether there is another page.
+        page = list_trips(after=after, limit=TRIP_PAGE_SIZE + 1, filter=search or None, archived=archived,
+                          with_totals=True)
+        has_more = len(page) > TRIP_PAGE_SIZE
+        trips.extend(page[:TRIP_PAGE_SIZE])
+        if not has_more:
+            break
+        after = (trips[-1].start_date, trips[-1].id)
+
+    if trips:
+        st.header('Archived Trips' if archived else 'Saved Trips')
+        for trip in trips:
+            trip_date = from_day(trip.start_day)
+            select_col, trip_col = st.columns([1, 24])
+            select_col.checkbox('Select', key=f'select_trip_{trip.id}', label_visibility='collapsed')
+            if trip_col.button(f'{trip.title} ({trip_date.year}) · ${trip.total:,.2f}', key=f'trip_{trip.id}'):
+                st.session_state['selected_trip_id'] = trip.id
+                st.rerun()
+        if has_more:
+            st.button('Load more', key='load_more_trips', on_click=load_more_trips)
+
+        selected = [trip.id for trip in trips if st.session_state.get(f'select_trip_{trip.id}')]
+        if selected:
+            show_bulk_actions(selected, archived)
+    elif search:
+        st.write("No trips match your search.")
+    elif archived:
+        st.write("No archived trips.")
+    else:
+        st.write("No trips available.")
+    show_form_message('bulk_trips')
+
+
+def show_bulk_actions(trip_ids, archived):
+    """
+    Display the actions for the trips selected in the trip list.
+
+    Args:
+        trip_ids (list): The IDs of the selected trips.
+        archived (bool): Whether the archived trips are listed, so the selection can be restored.
+    """
+    st.write(f'{len(trip_ids)} selected')
+    col1, col2, _ = st.columns([1, 1, 4])
+    col1.button('Restore' if archived else 'Archive', key='bulk_archive_trips', on_click=archive_selected_trips,
+                args=(trip_ids, not archived))
+    col2.button('Delete', key='bulk_delete_trips', type='primary', on_click=delete_selected_trips, args=(trip_ids,))
 
-if 'selected_trip_id' not in st.session_state:
+
+@counted_in_rerun
+def archive_selected_trips(trip_ids, archived):
+    """
+    Archive or restore the selected trips in one write, and clear the selection.
+
+    Args:
+        trip_ids (list): The IDs of the selected trips.
+        archived (bool): True to archive the trips, False to restore them.
+    """
+    count = archive_trips(trip_ids, archived)
+    clear_trip_selection(trip_ids)
+    st.session_state['bulk_trips_message'] = (
+        'success', f'{count} trip{"s" if count != 1 else ""} {"archived" if archived else "restored"}.')
+
+
+@counted_in_rerun
+def delete_selected_trips(trip_ids):
+    """
+    Delete the selected trips in one write, and clear the selection.
+
+    Args:
+        trip_ids (list): The IDs of the selected trips.
+    """
+    count = delete_trips(trip_ids)
+    clear_trip_selection(trip_ids)
+    st.session_state['bulk_trips_message'] = ('success', f'{count} trip{"s" if count != 1 else ""} deleted.')
+
+
+def clear_trip_selection(trip_ids):
+    """
+    Untick the trip list checkboxes of the given trips.
+    """
+    for trip_id in trip_ids:
+        st.session_state.pop(f'select_trip_{trip_id}', None)
+
+
+@st.fragment
+@counted_in_rerun
+def show_search():
+    """
+    Display a full-text search over trips, activities, flights and hotels.
+
+    Each result links to its trip. Runs as a fragment, so searching re-renders only the results.
+    """
+    query = st.text_input('Search bookings', key='booking_search',
+                          placeholder='Place, hotel, airline, confirmation number...')
+    if not query:
+        return
+
+    results = search(query)
+    if not results:
+        st.write("No matches found.")
+    for index, result in enumerate(results):
+        details = ', '.join(value for value in (result['detail'], result['confirmation']) if value)
+        label = f"{result['kind'].title()}: {result['title']}"
+        if result['kind'] != 'trip':
+            label += f" ({result['trip_title']})"
+        if st.button(label, key=f'search_result_{index}', help=details or None):
+            st.session_state['selected_trip_id'] = result['trip_id']
+            st.rerun()
+
+
+def show_analytics():
+    """
+    Display spending analytics across all trips.
+
+    The figures are computed from a snapshot of the database that is reloaded only after the data
+    changes, so revisiting the page doesn't read the database again.
+    """
     col1, col2 = st.columns([4, 1])
+    with col1:
+        st.header('Analytics')
+    with col2:
+        if st.button('Back to all trips', key='analytics_back'):
+            del st.session_state['show_analytics']
+            st.rerun()
+
+    snapshot = analytics.get_snapshot()
+    totals = analytics.summary(snapshot)
+    if not totals['trips']:
+        st.write("No trips available.")
+        return
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric('Trips', f"{totals['trips']:,}")
+    col2.metric('Total spend', f"${totals['total_spend']:,.2f}")
+    col3.metric('Hotel cost per night', f"${totals['hotel_cost_per_night']:,.2f}")
+    col4.metric('Cost per traveler-day', f"${totals['cost_per_traveler_day']:,.2f}")
+
+    st.subheader('Spend by month')
+    st.bar_chart(analytics.spend_by_month(snapshot)[['activities', 'flights', 'hotels']])
+
+    st.subheader('Cost per traveler-day by start month')
+    st.line_chart(analytics.cost_per_traveler_day(snapshot))
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.subheader('Top airlines')
+        st.dataframe(analytics.top_airlines(snapshot))
+    with col2:
+        st.subheader('Hotel cost per night')
+        st.dataframe(analytics.hotel_cost_per_night(snapshot))
+
+
+def show_performance_panel(rerun):
+    """
+    Display the database calls made during this run, and the callbacks and fragment reruns since the last
+    one, latencies since the server started, slow
+    statements with their query plans, and the metrics in Prometheus text format.
+
+    Opening the panel turns instrumentation on for the whole server process; it stays on until restart.
+
+    Args:
+        rerun (instrumentation.Rerun): The statistics collected during this run, the callbacks that ran
+            before it and the fragment reruns since the previous full run.
+    """
+    st.subheader('Performance')
+    st.write(f"This run: {rerun.calls} db.py calls, {rerun.queries} queries, {rerun.rows} rows, "
+             f"{rerun.seconds * 1000:.1f} ms")
+    st.caption('Includes the form callbacks that ran just before this run, and the sections that reran on their '
+               'own since the previous one.')
+    if rerun.functions:
+        st.dataframe([
+            {'function': name, 'calls': calls, 'queries': queries, 'rows': rows, 'ms': round(seconds * 1000, 2)}
+            for name, (calls, queries, rows, seconds) in sorted(rerun.functions.items())
+        ])
+
+    st.write('Since start')
+    st.dataframe(instrumentation.summary())
+
+    slow = instrumentation.slow_queries()
+    st.write(f"Slow statements (at least {instrumentation.SLOW_QUERY_MS:g} ms): {len(slow)}")
+    for entry in reversed(slow):
+        with st.expander(f"{entry['function']}: {entry['ms']:.1f} ms"):
+            st.code(entry['sql'], language='sql')
+            st.code('\n'.join(entry['plan']))
+
+    st.download_button('Download metrics', instrumentation.metrics_text(), file_name='metrics.txt',
+                       mime='text/plain')
+
+
+def load_more_trips():
+    """
+    Show one more page of trips in the saved trips list.
+    """
+    st.session_state['trip_list_pages'] = st.session_state.get('trip_list_pages', 1) + 1
+
+
+# Main content
+
+if st.session_state.get('show_analytics'):
+    show_analytics()
+elif 'selected_trip_id' not in st.session_state:
+    col1, col2, col3 = st.columns([3, 1, 1])
     with col1:
         st.title('Travel Planner')
     with col2:
         if st.button("Create Trip", key="create_trip_btn"):
             st.session_state['show_trip_modal'] = True
+    with col3:
+        if st.button("Analytics", key="analytics_btn"):
+            st.session_state['show_analytics'] = True
+            st.rerun()
 
     if 'show_trip_modal' in st.session_state and st.session_state['show_trip_modal']:
         create_trip_modal()
 
-    trips = get_all_trips()
-
-    if trips:
-        st.header('Saved Trips')
-        for trip in trips:
-            trip_date = datetime.strptime(trip.start_date, "%Y-%m-%d")
-            if st.button(f'{trip.title} ({trip_date.year})', key=f'trip_{trip.id}'):
-                st.session_state['selected_trip_id'] = trip.id
-                st.rerun()
-    else:
-        st.write("No trips available.")
+    show_search()
+    show_trip_list()
 else:
-    show_trip_detail(st.session_state['selected_trip_id'])
\ No newline at end of file
+    show_trip_detail(st.session_state['selected_trip_id'])
+
+# Performance panel
+
+st.divider()
+if st.toggle('Performance panel', key='show_performance_panel'):
+    show_performance_panel(rerun_stats)
+# The calls of the next callbacks and fragment reruns are counted afresh
+del st.session_state['rerun_stats']
@@ -0,0 +1,75 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import connection
+import db
+
+# Worker threads running database calls. Matches the connection pool, so every worker keeps a pooled
+# connection instead of opening a new one per call.
+MAX_WORKERS = connection.POOL_SIZE
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor():
+    """
+    Return the executor running database calls, creating it on first use.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='async-db')
+        return _executor
+
+
+def shutdown(wait=True):
+    """
+    Stop the worker threads. A later call starts a new executor.
+
+    Args:
+        wait (bool): Wait for calls already submitted to finish.
+    """
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def _run_in_executor(function):
+    """
+    Wrap a blocking db.py function as a coroutine function that runs it on the executor.
+    """
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), functools.partial(function, *args, **kwargs))
+    return wrapper
+
+
+# The db.py API as coroutine functions, for use from asyncio code. Independent reads can be awaited
+# together, e.g. ``await asyncio.gather(get_flights_for_trip(id), get_hotels_for_trip(id))``.
+create_trip = _run_in_executor(db.create_trip)
+get_all_trips = _run_in_executor(db.get_all_trips)
+list_trips = _run_in_executor(db.list_trips)
+get_trip_by_id = _run_in_executor(db.get_trip_by_id)
+find_overlapping_trips = _run_in_executor(db.find_overlapping_trips)
+add_flight_to_trip = _run_in_executor(db.add_flight_to_trip)
+add_hotel_to_trip = _run_in_executor(db.add_hotel_to_trip)
+add_activity_to_day = _run_in_executor(db.add_activity_to_day)
+get_itinerary_for_trip = _run_in_executor(db.get_itinerary_for_trip)
+get_itinerary_range = _run_in_executor(db.get_itinerary_range)
+find_overlapping_activities = _run_in_executor(db.find_overlapping_activities)
+get_activity_days_outside_trip = _run_in_executor(db.get_activity_days_outside_trip)
+get_flights_for_trip = _run_in_executor(db.get_flights_for_trip)
+get_hotels_for_trip = _run_in_executor(db.get_hotels_for_trip)
+get_trip_totals = _run_in_executor(db.get_trip_totals)
+load_trip_bundle = _run_in_executor(db.load_trip_bundle)
+search = _run_in_executor(db.search)
+delete_trip = _run_in_executor(db.delete_trip)
+clone_trip = _run_in_executor(db.clone_trip)
+delete_trips = _run_in_executor(db.delete_trips)
+archive_trips = _run_in_executor(db.archive_trips)
@@ -0,0 +1,239 @@
+import argparse
+import hashlib
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from connection import transaction
+from writer import write_queue
+
+# Directory holding the attachment store. Set TRIPS_ATTACHMENTS to override the default, or call
+# use_directory() to switch at runtime.
+ATTACHMENTS_DIR = os.environ.get('TRIPS_ATTACHMENTS', 'attachments')
+
+# Bytes read from an upload and written to disk at a time.
+CHUNK_SIZE = 1024 * 1024
+
+# Seconds an unreferenced blob is kept before garbage collection removes it, so a file uploaded for an
+# activity that hasn't been saved yet survives a collection.
+GC_GRACE = 3600
+
+_REFERENCE = re.compile(r'([0-9a-f]{64})/(.+)', re.DOTALL)
+
+
+def use_directory(path):
+    """
+    Keep attachments in another directory, such as a temporary one for tests.
+
+    Args:
+        path (str): The directory. It is created on the first upload.
+    """
+    global ATTACHMENTS_DIR
+    ATTACHMENTS_DIR = path
+
+
+def parse_reference(file_path):
+    """
+    Split an activity's file_path into the blob digest and the original file name.
+
+    Args:
+        file_path (str): The value of activities.file_path.
+
+    Returns:
+        tuple: (digest, name), or None if the value doesn't refer to the attachment store.
+    """
+    match = _REFERENCE.fullmatch(file_path or '')
+    return (match.group(1), match.group(2)) if match else None
+
+
+def blob_path(digest):
+    """
+    Return the path of a blob in the store, fanned out by the first two hex digits of its digest.
+    """
+    return os.path.join(ATTACHMENTS_DIR, digest[:2], digest[2:])
+
+
+def exists(file_path):
+    """
+    Return whether an attachment reference points at a blob in the store.
+    """
+    attachment = parse_reference(file_path)
+    return attachment is not None and os.path.isfile(blob_path(attachment[0]))
+
+
+def store(stream, name, chunk_size=CHUNK_SIZE):
+    """
+    Save an uploaded file in the store and return the reference to keep in activities.file_path.
+
+    The upload is streamed to a temporary file in chunks while it is hashed, so memory use doesn't depend
+    on its size, then moved to a path named by its SHA-256 digest. Identical uploads share one blob. The
+    blob is referenced, and protected from garbage collection, once an activity stores the reference.
+
+    Args:
+        stream: A binary file-like object positioned at the start of the content.
+        name (str): The original file name, kept in the reference for downloads.
+        chunk_size (int): The number of bytes read at a time.
+
+    Returns:
+        str: The reference, '<sha256 hex digest>/<name>'.
+    """
+    name = os.path.basename(name.replace('\\', '/')) or 'attachment'
+    temp_dir = os.path.join(ATTACHMENTS_DIR, 'tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+    try:
+        hasher = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as temp:
+            while chunk := stream.read(chunk_size):
+                hasher.update(chunk)
+                temp.write(chunk)
+                size += len(chunk)
+            temp.flush()
+            os.fsync(temp.fileno())
+        digest = hasher.hexdigest()
+        # Record the blob before it lands on disk. A collection that committed earlier has already
+        # removed any old copy, and later ones see the fresh timestamp and leave it alone.
+        write_queue.run(_record_blob, digest, size, int(time.time()))
+        path = blob_path(digest)
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return f'{digest}/{name}'
+
+
+def _record_blob(conn, digest, size, created):
+    conn.execute('INSERT INTO blobs (digest, size, created) VALUES (?, ?, ?) '
+                 'ON CONFLICT (digest) DO UPDATE SET created = excluded.created', (digest, size, created))
+
+
+@contextmanager
+def map_attachment(file_path):
+    """
+    Map a stored attachment into memory, read-only. Slices of the map are served from the page cache
+    without reading the whole file, e.g. for HTTP range requests.
+
+    Args:
+        file_path (str): The attachment reference kept in activities.file_path.
+
+    Yields:
+        mmap.mmap: The mapped content; an empty bytes object for an empty file.
+
+    Raises:
+        FileNotFoundError: If the reference is not in the store.
+    """
+    attachment = parse_reference(file_path)
+    if attachment is None:
+        raise FileNotFoundError(f'Not an attachment reference: {file_path!r}')
+    with open(blob_path(attachment[0]), 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def read_attachment(file_path, start=0, end=None):
+    """
+    Read a byte range of a stored attachment through a memory map.
+
+    Args:
+        file_path (str): The attachment reference kept in activities.file_path.
+        start (int): The offset of the first byte.
+        end (int): The offset after the last byte, or None to read to the end.
+
+    Returns:
+        bytes: The content.
+    """
+    with map_attachment(file_path) as mapped:
+        return mapped[start:end]
+
+
+def collect_garbage(grace=GC_GRACE):
+    """
+    Remove blobs no activity references any more, and files left behind by interrupted uploads.
+
+    Reference counts are kept by triggers on activities, so deleting activities or whole trips, and
+    cloning trips, needs no bookkeeping here.
+
+    Args:
+        grace (float): Only remove blobs and files untouched for at least this many seconds.
+
+    Returns:
+        dict: The keys 'blobs' (unreferenced blobs removed), 'files' (stray files removed) and 'bytes'
+            (space freed by both).
+    """
+    cutoff = time.time() - grace
+    removed = write_queue.run(_remove_unreferenced, int(cutoff))
+    if removed:
+        write_queue.run(_remove_blob_files, [digest for digest, _ in removed])
+    result = {'blobs': len(removed), 'files': 0, 'bytes': sum(size for _, size in removed)}
+
+    if not os.path.isdir(ATTACHMENTS_DIR):
+        return result
+    with transaction() as conn:
+        known = {digest for digest, in conn.execute('SELECT digest FROM blobs')}
+    for entry in os.scandir(ATTACHMENTS_DIR):
+        if not entry.is_dir():
+            continue
+        for file in os.scandir(entry.path):
+            stray = entry.name == 'tmp' or entry.name + file.name not in known
+            if stray and file.is_file() and file.stat().st_mtime < cutoff:
+                result['bytes'] += file.stat().st_size
+                result['files'] += 1
+                os.remove(file.path)
+    return result
+
+
+def _remove_unreferenced(conn, cutoff):
+    """
+    Delete the rows of unreferenced blobs older than the cutoff, returning their (digest, size).
+    """
+    return conn.execute('DELETE FROM blobs WHERE refs <= 0 AND created < ? RETURNING digest, size',
+                        (cutoff,)).fetchall()
+
+
+def _remove_blob_files(conn, digests):
+    """
+    Remove the files of blobs whose rows have been deleted, once that delete has committed.
+
+    Runs on the writer, like the uploads recording their blobs, so an upload of the same content either
+    recorded its blob first, and the row found here keeps the file, or records it afterwards and finds
+    no file to reuse.
+    """
+    for digest in digests:
+        if conn.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone() is not None:
+            continue
+        try:
+            os.remove(blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+
+def main(argv=None):
+    """
+    Command line entry point: garbage collect the attachment store.
+    """
+    parser = argparse.ArgumentParser(description='Remove attachments no activity refers to any more.')
+    parser.add_argument('--grace', type=float, default=GC_GRACE,
+                        help='keep files younger than this many seconds (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    result = collect_garbage(args.grace)
+    print(f"Removed {result['blobs']} unreferenced blobs and {result['files']} stray files, "
+          f"{result['bytes']:,} bytes freed.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
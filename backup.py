@@ -0,0 +1,367 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+
+import connection
+import migrations
+from cache import TRIP_LIST, read_cache
+from dates import DATE_SQL
+from writer import write_queue
+
+# Directory holding the snapshots. Set TRIPS_BACKUPS to override the default.
+BACKUP_DIR = os.environ.get('TRIPS_BACKUPS', 'backups')
+
+# Database pages copied per step of a snapshot, and seconds to pause between steps so the copy leaves
+# disk bandwidth for the application.
+PAGES_PER_STEP = 1024
+STEP_PAUSE = 0.001
+
+# Default retention: the newest KEEP snapshots, plus the newest snapshot of each of the last KEEP_DAILY
+# days that have one.
+KEEP = 24
+KEEP_DAILY = 7
+
+# Days deleted rows are kept in trip_journal by scheduled runs.
+JOURNAL_RETENTION_DAYS = 30
+
+_SNAPSHOT_NAME = re.compile(r'trips-(\d{8}T\d{9})Z\.db')
+
+
+def snapshot(directory=None, pages=PAGES_PER_STEP, pause=STEP_PAUSE):
+    """
+    Copy the live database to a new snapshot file with the SQLite online backup API.
+
+    The copy runs in steps of a few pages inside one read transaction, so it is a consistent picture of
+    the database at the moment it started. In WAL mode readers don't block writers, so sessions keep
+    writing while it runs; without the open transaction every write would restart the copy. The file is
+    written under a temporary name and renamed once complete, so a snapshot is never torn.
+
+    Args:
+        directory (str): Where to write the snapshot. Defaults to BACKUP_DIR.
+        pages (int): The number of pages copied per step.
+        pause (float): Seconds to sleep between steps.
+
+    Returns:
+        str: The path of the snapshot, named after the UTC time it was taken.
+    """
+    directory = directory or BACKUP_DIR
+    os.makedirs(directory, exist_ok=True)
+    now = datetime.now(timezone.utc)
+    path = os.path.join(directory, f"trips-{now:%Y%m%dT%H%M%S}{now.microsecond // 1000:03d}Z.db")
+    temp_path = path + '.tmp'
+    database, uri = connection.database_target()
+    source = sqlite3.connect(database, uri=uri, timeout=connection.BUSY_TIMEOUT, isolation_level=None)
+    target = sqlite3.connect(temp_path, isolation_level=None)
+    try:
+        source.execute('BEGIN')
+        source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        source.backup(target, pages=pages, sleep=pause)
+        source.rollback()
+        # Keep the snapshot in a single file, rather than in WAL mode like the source.
+        target.execute('PRAGMA journal_mode = DELETE')
+        target.close()
+        os.replace(temp_path, path)
+    finally:
+        source.close()
+        target.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path
+
+
+def list_snapshots(directory=None):
+    """
+    List the snapshots in a directory, newest first.
+
+    Args:
+        directory (str): The directory to look in. Defaults to BACKUP_DIR.
+
+    Returns:
+        list: (path, taken) tuples, where taken is the UTC datetime the snapshot was taken.
+    """
+    directory = directory or BACKUP_DIR
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        match = _SNAPSHOT_NAME.fullmatch(name)
+        if match:
+            taken = datetime.strptime(match.group(1) + '000', '%Y%m%dT%H%M%S%f').replace(tzinfo=timezone.utc)
+            found.append((os.path.join(directory, name), taken))
+    return sorted(found, key=lambda entry: entry[1], reverse=True)
+
+
+def prune(keep=KEEP, daily=KEEP_DAILY, directory=None):
+    """
+    Delete the snapshots a retention policy doesn't keep.
+
+    Args:
+        keep (int): The number of newest snapshots to keep.
+        daily (int): The number of most recent days for which the newest snapshot is kept as well.
+        directory (str): The directory of the snapshots. Defaults to BACKUP_DIR.
+
+    Returns:
+        list: The paths of the deleted snapshots.
+    """
+    snapshots = list_snapshots(directory)
+    kept = {path for path, _ in snapshots[:keep]}
+    days = set()
+    for path, taken in snapshots:
+        if len(days) == daily:
+            break
+        if taken.date() not in days:
+            days.add(taken.date())
+            kept.add(path)
+    removed = [path for path, _ in snapshots if path not in kept]
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def restore(path, safety_snapshot=True):
+    """
+    Replace the contents of the live database with a snapshot.
+
+    The snapshot is copied in with the backup API in a single step, which holds the write lock only for
+    the copy, so sessions wait for it on the busy timeout rather than failing. It is migrated if it
+    predates the current schema. Every trip's version is then moved past the versions handed out before,
+    so read caches and API ETags, in this and other processes, don't serve pre-restore results.
+
+    Args:
+        path (str): The snapshot to restore.
+        safety_snapshot (bool): First take a snapshot of the current state, so the restore can be undone.
+
+    Returns:
+        str: The path of the safety snapshot, or None if none was taken.
+
+    Raises:
+        FileNotFoundError: If the snapshot doesn't exist.
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+    saved = snapshot(os.path.dirname(path) or None) if safety_snapshot else None
+    database, uri = connection.database_target()
+    target = sqlite3.connect(database, uri=uri, timeout=connection.BUSY_TIMEOUT, isolation_level=None)
+    source = sqlite3.connect(f'file:{os.path.abspath(path)}?mode=ro', uri=True)
+    try:
+        migrations.migrate(target)
+        before = target.execute('SELECT trip_id FROM trip_versions').fetchall()
+        seq, revision = target.execute('SELECT COALESCE(MAX(seq), 0), COALESCE(MAX(revision), 0) '
+                                       'FROM trip_versions').fetchone()
+        source.backup(target)
+        migrations.migrate(target)
+        target.execute('BEGIN IMMEDIATE')
+        target.execute('UPDATE trip_versions SET seq = ?, revision = revision + ?', (seq + 1, revision + 1))
+        target.executemany('INSERT INTO trip_versions (trip_id, seq, revision) VALUES (?, ?, ?) '
+                           'ON CONFLICT (trip_id) DO NOTHING',
+                           ((trip_id, seq + 1, revision + 1) for trip_id, in before))
+        target.execute('COMMIT')
+    finally:
+        source.close()
+        target.close()
+    connection.close_all()
+    read_cache.clear()
+    return saved
+
+
+def deleted_trips():
+    """
+    List the deleted trips that trip_journal can restore, most recently deleted first.
+
+    Returns:
+        list: One dictionary per deletion, with the keys 'trip_id', 'title', 'start_date', 'end_date'
+            and 'deleted' (a UTC datetime).
+    """
+    with connection.transaction() as conn:
+        rows = conn.execute(f'''
+            SELECT trip_id, json_extract(row, '$.title'),
+                   {DATE_SQL.format("json_extract(row, '$.start_day')")},
+                   {DATE_SQL.format("json_extract(row, '$.end_day')")}, deleted
+            FROM trip_journal WHERE table_name = 'trips' ORDER BY id DESC
+        ''').fetchall()
+    return [{'trip_id': trip_id, 'title': title, 'start_date': start_date, 'end_date': end_date,
+             'deleted': datetime.fromtimestamp(deleted / 1000, timezone.utc)}
+            for trip_id, title, start_date, end_date, deleted in rows]
+
+
+def restore_trip(trip_id):
+    """
+    Put back the most recent deletion of a trip, with the activities, flights and hotels deleted with it.
+
+    The trip keeps its ID unless another trip has taken it since. Its bookings get new IDs. The restored
+    rows are removed from trip_journal. Attachments are referenced again, unless garbage collection has
+    already removed them.
+
+    Args:
+        trip_id (int): The ID the trip had when it was deleted.
+
+    Returns:
+        int: The ID of the restored trip, or None if trip_journal holds no deletion of the trip.
+    """
+    restored_id = write_queue.run(_restore_trip, trip_id)
+    if restored_id is not None:
+        read_cache.invalidate(restored_id, TRIP_LIST)
+    return restored_id
+
+
+def _restore_trip(conn, trip_id):
+    """
+    Re-insert the rows of a trip's latest deletion from trip_journal, in the writer's transaction.
+    """
+    entry = conn.execute("SELECT id, deleted, row FROM trip_journal WHERE trip_id = ? AND table_name = 'trips' "
+                         'ORDER BY id DESC LIMIT 1', (trip_id,)).fetchone()
+    if entry is None:
+        return None
+    last, deleted, trip_row = entry
+    # The trip's bookings were journaled just before it, by the same statement.
+    boundary = conn.execute("SELECT id FROM trip_journal WHERE id < ? AND NOT (trip_id = ? AND deleted = ? "
+                            "AND table_name != 'trips') ORDER BY id DESC LIMIT 1",
+                            (last, trip_id, deleted)).fetchone()
+    first = boundary[0] + 1 if boundary else 0
+    rows = conn.execute('SELECT table_name, row FROM trip_journal WHERE id >= ? AND id < ? ORDER BY id',
+                        (first, last)).fetchall()
+
+    trip = json.loads(trip_row)
+    if conn.execute('SELECT 1 FROM trips WHERE id = ?', (trip_id,)).fetchone() is not None:
+        del trip['id']
+    restored_id = _insert(conn, 'trips', trip)
+    for table, row in rows:
+        values = json.loads(row)
+        del values['id']
+        values['trip_id'] = restored_id
+        _insert(conn, table, values)
+    conn.execute('DELETE FROM trip_journal WHERE id BETWEEN ? AND ?', (first, last))
+    return restored_id
+
+
+def _insert(conn, table, values):
+    columns = ', '.join(values)
+    placeholders = ', '.join('?' * len(values))
+    return conn.execute(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', tuple(values.values())).lastrowid
+
+
+def prune_journal(days=JOURNAL_RETENTION_DAYS):
+    """
+    Forget deleted rows older than a number of days, after which their trips can't be restored.
+
+    Args:
+        days (float): The age, in days, of the oldest deletions to keep.
+
+    Returns:
+        int: The number of journal rows removed.
+    """
+    cutoff = int((time.time() - days * 86400) * 1000)
+    return write_queue.run(_execute_rowcount, 'DELETE FROM trip_journal WHERE deleted < ?', (cutoff,))
+
+
+def _execute_rowcount(conn, sql, params):
+    return conn.execute(sql, params).rowcount
+
+
+def set_journal(enabled):
+    """
+    Turn the journaling of deleted rows on or off for every process using the database.
+
+    Args:
+        enabled (bool): Whether deleted rows are copied into trip_journal.
+    """
+    write_queue.run(migrations.create_journal_triggers if enabled else migrations.drop_journal_triggers)
+
+
+def run_schedule(interval, keep=KEEP, daily=KEEP_DAILY, journal_days=JOURNAL_RETENTION_DAYS, directory=None,
+                 count=None):
+    """
+    Take snapshots at a fixed interval, pruning old snapshots and journal rows after each one.
+
+    Args:
+        interval (float): Seconds between the start of one snapshot and the next.
+        keep (int): The number of newest snapshots to keep.
+        daily (int): The number of recent days whose newest snapshot is kept as well.
+        journal_days (float): The age, in days, of the oldest deleted rows to keep in trip_journal.
+        directory (str): Where to keep the snapshots. Defaults to BACKUP_DIR.
+        count (int): Stop after this many snapshots, or None to run until interrupted.
+    """
+    taken = 0
+    while count is None or taken < count:
+        started = time.monotonic()
+        path = snapshot(directory)
+        removed = prune(keep, daily, directory)
+        forgotten = prune_journal(journal_days)
+        taken += 1
+        print(f'{datetime.now():%Y-%m-%d %H:%M:%S} Saved {path} ({os.path.getsize(path):,} bytes), '
+              f'removed {len(removed)} old snapshots and {forgotten} journal rows.', flush=True)
+        if count is None or taken < count:
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+def main(argv=None):
+    """
+    Command line entry point: take, schedule, list and restore snapshots, and restore deleted trips.
+    """
+    parser = argparse.ArgumentParser(description='Back up and restore the trips database.')
+    parser.add_argument('--dir', default=None, help=f'snapshot directory (default: {BACKUP_DIR})')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('snapshot', help='take a snapshot now')
+    schedule_command = commands.add_parser('schedule', help='take snapshots at an interval and apply retention')
+    schedule_command.add_argument('--interval', type=float, default=3600,
+                                  help='seconds between snapshots (default: %(default)s)')
+    schedule_command.add_argument('--keep', type=int, default=KEEP,
+                                  help='newest snapshots to keep (default: %(default)s)')
+    schedule_command.add_argument('--daily', type=int, default=KEEP_DAILY,
+                                  help='days whose newest snapshot is also kept (default: %(default)s)')
+    schedule_command.add_argument('--journal-days', type=float, default=JOURNAL_RETENTION_DAYS,
+                                  help='days deleted trips stay restorable (default: %(default)s)')
+    commands.add_parser('list', help='list snapshots, newest first')
+    restore_command = commands.add_parser('restore', help='replace the database with a snapshot')
+    restore_command.add_argument('snapshot', help='snapshot file, or "latest"')
+    restore_command.add_argument('--no-safety-snapshot', action='store_true',
+                                 help="don't snapshot the current state first")
+    commands.add_parser('deleted', help='list deleted trips that can be restored')
+    restore_trip_command = commands.add_parser('restore-trip', help='restore a deleted trip from the journal')
+    restore_trip_command.add_argument('trip_id', type=int, help='ID of the deleted trip')
+    journal_command = commands.add_parser('journal', help='turn journaling of deleted rows on or off')
+    journal_command.add_argument('state', choices=['on', 'off'])
+    args = parser.parse_args(argv)
+
+    if args.command == 'snapshot':
+        path = snapshot(args.dir)
+        print(f'Saved {path} ({os.path.getsize(path):,} bytes).')
+    elif args.command == 'schedule':
+        run_schedule(args.interval, args.keep, args.daily, args.journal_days, args.dir)
+    elif args.command == 'list':
+        for path, taken in list_snapshots(args.dir):
+            print(f'{taken:%Y-%m-%d %H:%M:%S} UTC  {os.path.getsize(path):>14,}  {path}')
+    elif args.command == 'restore':
+        path = args.snapshot
+        if path == 'latest':
+            snapshots = list_snapshots(args.dir)
+            if not snapshots:
+                print('No snapshots to restore.')
+                return 1
+            path = snapshots[0][0]
+        saved = restore(path, not args.no_safety_snapshot)
+        print(f'Restored {path}.' + (f' The previous state is saved in {saved}.' if saved else ''))
+    elif args.command == 'deleted':
+        for trip in deleted_trips():
+            print(f"{trip['trip_id']:>6}  {trip['title']}  {trip['start_date']} to {trip['end_date']}  "
+                  f"deleted {trip['deleted']:%Y-%m-%d %H:%M:%S} UTC")
+    elif args.command == 'restore-trip':
+        restored_id = restore_trip(args.trip_id)
+        if restored_id is None:
+            print(f'No deletion of trip {args.trip_id} in the journal.')
+            return 1
+        print(f'Restored trip {args.trip_id} as trip {restored_id}.')
+    else:
+        set_journal(args.state == 'on')
+        print(f"Journaling of deleted rows is {args.state}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,373 @@
+import argparse
+import inspect
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import bulk_import
+import connection
+import db
+import instrumentation
+from connection import transaction
+from dates import from_day
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak RSS is then reported as None.
+    resource = None
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+# Synthetic database sizes: trips, days per trip, and activities per day, flights and hotels per trip.
+SCALES = {
+    'small': {'trips': 200, 'days': 7, 'activities': 3, 'flights': 2, 'hotels': 1},
+    'medium': {'trips': 2000, 'days': 10, 'activities': 4, 'flights': 2, 'hotels': 2},
+    'large': {'trips': 10000, 'days': 14, 'activities': 5, 'flights': 2, 'hotels': 2},
+}
+
+# Day number of the earliest generated trip start (2023-01-01); trips start within the following two years.
+FIRST_DAY = 19358
+
+CITIES = ['Lisbon', 'Porto', 'Paris', 'Rome', 'Tokyo', 'Kyoto', 'Lima', 'Oslo', 'Cairo', 'Hanoi', 'Quito', 'Seoul']
+SIGHTS = ['Museum', 'Cathedral', 'Market', 'Harbour Walk', 'Food Tour', 'Castle', 'Gallery', 'Old Town', 'Beach',
+          'Night Show', 'Cooking Class', 'Bike Ride']
+AIRLINES = ['TAP', 'Lufthansa', 'Air France', 'ANA', 'LATAM', 'KLM', 'Emirates', 'Iberia']
+HOTELS = ['Grand Hotel', 'Harbour Inn', 'City Suites', 'Garden House', 'Old Town Lodge', 'Riverside Rooms']
+
+# Latency changes smaller than this are timer noise on sub-millisecond operations and never count as regressions.
+MIN_REGRESSION_MS = 0.05
+
+
+def _peak_rss_mb():
+    """
+    Return the peak resident set size of this process in megabytes, or None if it can't be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def generate(path, trips, days, activities, flights, hotels, seed=0):
+    """
+    Create a synthetic database. The same arguments always produce the same data.
+
+    Args:
+        path (str): The database file to create. Must not exist yet.
+        trips (int): The number of trips.
+        days (int): The number of days of each trip.
+        activities (int): The number of activities per trip day.
+        flights (int): The number of flights per trip.
+        hotels (int): The number of hotels per trip.
+        seed (int): Seed for the random generator.
+    """
+    rng = random.Random(seed)
+    connection.use_database(path)
+    with transaction(immediate=True) as conn:
+        for trip_id in range(1, trips + 1):
+            city = rng.choice(CITIES)
+            start_day = FIRST_DAY + rng.randrange(730)
+            conn.execute(bulk_import.INSERTS['trip'], (trip_id, f'{city} {trip_id}', start_day, start_day + days - 1))
+            conn.executemany(bulk_import.INSERTS['activity'], (
+                (trip_id, start_day + day, f'{rng.choice(SIGHTS)} in {city}', rng.choice((None, rng.randrange(1440))),
+                 round(rng.uniform(0, 150), 2), None, f'{rng.randrange(1, 300)} {city} Street',
+                 f'A{trip_id}-{day}-{index}')
+                for day in range(days) for index in range(activities)))
+            conn.executemany(bulk_import.INSERTS['flight'], (
+                (trip_id, round(rng.uniform(80, 900), 2), f'{rng.randrange(1, 40)}{rng.choice("ABCDEF")}',
+                 rng.choice(AIRLINES), f'F{trip_id}-{index}', f'FL{rng.randrange(10 ** 6):06d}')
+                for index in range(flights)))
+            conn.executemany(bulk_import.INSERTS['hotel'], (
+                (trip_id, round(rng.uniform(100, 2000), 2), f'{rng.choice(HOTELS)} {city}',
+                 f'{rng.randrange(1, 300)} {city} Avenue', rng.randrange(1, 4), f'H{rng.randrange(10 ** 6):06d}')
+                for _ in range(hotels)))
+
+
+def _uncached(function):
+    """
+    Return a db.py reader without its read cache, so every call reaches the database. It stays instrumented.
+    """
+    return instrumentation.instrumented(inspect.unwrap(function))
+
+
+def _operations(trip_ids, rng):
+    """
+    Build the benchmarked db.py operations as (name, call) pairs, in the order they run.
+
+    Each call takes no arguments and picks its own trip. Reads bypass the read cache. Trips created by
+    create_trip are removed again by delete_trip, so a run leaves the trip count unchanged.
+    """
+    readers = {name: _uncached(getattr(db, name)) for name in (
+        'get_all_trips', 'list_trips', 'get_trip_by_id', 'get_itinerary_for_trip', 'get_itinerary_range',
+        'get_flights_for_trip', 'get_hotels_for_trip', 'get_trip_totals', 'load_trip_bundle', 'search')}
+    trips = {trip.id: trip for trip in readers['get_all_trips']()}
+    created = []
+
+    def some_trip():
+        return trips[rng.choice(trip_ids)]
+
+    def some_date(trip):
+        return from_day(rng.randrange(trip.start_day, trip.end_day + 1)).isoformat()
+
+    def page():
+        trip = some_trip()
+        return readers['list_trips'](after=(trip.start_date, trip.id), limit=50)
+
+    def itinerary_day():
+        trip = some_trip()
+        return readers['get_itinerary_for_trip'](trip.id, some_date(trip))
+
+    def itinerary_range():
+        trip = some_trip()
+        return readers['get_itinerary_range'](trip.id, trip.start_date, trip.end_date)
+
+    def create():
+        created.append(db.create_trip('Benchmark Trip', '2024-01-01', '2024-01-07'))
+
+    def add_activity():
+        trip = some_trip()
+        db.add_activity_to_day(trip.id, some_date(trip), 'Benchmark Walk', '10:00 AM', 12.5, None, None, None)
+
+    return [
+        ('get_all_trips', lambda: readers['get_all_trips']()),
+        ('list_trips', page),
+        ('get_trip_by_id', lambda: readers['get_trip_by_id'](some_trip().id)),
+        ('get_itinerary_for_trip', itinerary_day),
+        ('get_itinerary_range', itinerary_range),
+        ('get_flights_for_trip', lambda: readers['get_flights_for_trip'](some_trip().id)),
+        ('get_hotels_for_trip', lambda: readers['get_hotels_for_trip'](some_trip().id)),
+        ('get_trip_totals', lambda: readers['get_trip_totals'](some_trip().id)),
+        ('load_trip_bundle', lambda: readers['load_trip_bundle'](some_trip().id)),
+        ('load_trip_bundle (cached)', lambda: db.load_trip_bundle(trip_ids[0])),
+        ('search', lambda: readers['search'](rng.choice(CITIES + SIGHTS)[:4])),
+        ('create_trip', create),
+        ('add_flight_to_trip', lambda: db.add_flight_to_trip(some_trip().id, 250.0, '12A', 'TAP', 'TP1', 'C1')),
+        ('add_hotel_to_trip', lambda: db.add_hotel_to_trip(some_trip().id, 300.0, 'Bench Inn', '1 Road', 1, 'H1')),
+        ('add_activity_to_day', add_activity),
+        ('delete_trip', lambda: db.delete_trip(created.pop())),
+    ]
+
+
+def _page_renders(trip_ids, rng):
+    """
+    Build headless renders of the home page and the trip detail page as (name, call) pairs.
+
+    Returns:
+        list: The renders, or an empty list if streamlit's testing harness isn't installed.
+    """
+    try:
+        from streamlit.testing.v1 import AppTest
+    except ImportError:
+        return []
+
+    def render(app, name):
+        app.run()
+        if app.exception:
+            raise RuntimeError(f'{name} raised: {app.exception[0].message}')
+
+    home = AppTest.from_file(APP_PATH, default_timeout=120)
+    detail = AppTest.from_file(APP_PATH, default_timeout=120)
+
+    def render_detail():
+        detail.session_state['selected_trip_id'] = rng.choice(trip_ids)
+        render(detail, 'show_trip_detail')
+
+    return [('render home', lambda: render(home, 'home page')), ('render show_trip_detail', render_detail)]
+
+
+def measure(call, iterations):
+    """
+    Time repeated calls of one operation.
+
+    Args:
+        call (callable): The operation, taking no arguments.
+        iterations (int): The number of calls to time.
+
+    Returns:
+        dict: The keys 'iterations', 'ops_per_sec', 'p50_ms', 'p99_ms', 'queries_per_op' and 'peak_rss_mb'.
+            'queries_per_op' is None when instrumentation is disabled.
+    """
+    latencies = []
+    queries = instrumentation.query_count()
+    for _ in range(iterations):
+        started = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - started)
+    queries = instrumentation.query_count() - queries
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / sum(latencies),
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'queries_per_op': queries / iterations if instrumentation.is_enabled() else None,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def run(scale, seed=0, iterations=200, render_iterations=20, renders=True, instrument=True):
+    """
+    Generate a synthetic database in a temporary directory and benchmark every operation against it.
+
+    Args:
+        scale (dict): The generator sizes, as in SCALES.
+        seed (int): Seed for the data generator and for the choice of trips.
+        iterations (int): Calls timed per db.py operation.
+        render_iterations (int): Renders timed per page.
+        renders (bool): Include the headless page renders.
+        instrument (bool): Count queries per operation with the instrumentation enabled. Disable it to
+            measure the instrumentation's overhead.
+
+    Returns:
+        dict: The keys 'meta' (scale, seed and environment) and 'operations' (results by operation name,
+            as returned by ``measure``; operations that failed hold an 'error' message instead).
+    """
+    if instrument:
+        instrumentation.enable()
+    else:
+        instrumentation.disable()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        generate(os.path.join(directory, 'benchmark.db'), seed=seed, **scale)
+        generate_seconds = time.perf_counter() - started
+
+        rng = random.Random(seed)
+        trip_ids = list(range(1, scale['trips'] + 1))
+        operations = _operations(trip_ids, rng)
+        if renders:
+            operations += [(name, call, render_iterations) for name, call in _page_renders(trip_ids, rng)]
+        for name, call, *count in operations:
+            try:
+                call()  # Warm up connections, imports and statement caches.
+                results[name] = measure(call, count[0] if count else iterations)
+            except Exception as error:
+                results[name] = {'error': f'{type(error).__name__}: {error}'}
+        connection.use_database(':memory:')
+
+    return {
+        'meta': {
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'scale': scale,
+            'seed': seed,
+            'iterations': iterations,
+            'instrumented': instrument,
+            'generate_seconds': generate_seconds,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'operations': results,
+    }
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Find operations that got slower, run more queries, or started failing between two benchmark results.
+
+    Latency is compared on the median; p99 of short runs is too noisy to gate on.
+
+    Args:
+        baseline (dict): Results of the reference run, as returned by ``run``.
+        current (dict): Results of the run to check.
+        threshold (float): The relative increase in p50 latency tolerated, e.g. 0.2 for 20%.
+
+    Returns:
+        list: One (operation, metric, baseline value, current value) tuple per regression.
+    """
+    regressions = []
+    for name, before in baseline['operations'].items():
+        after = current['operations'].get(name)
+        if after is None or 'error' in before:
+            continue
+        if 'error' in after:
+            regressions.append((name, 'error', None, after['error']))
+            continue
+        if after['p50_ms'] > max(before['p50_ms'] * (1 + threshold), before['p50_ms'] + MIN_REGRESSION_MS):
+            regressions.append((name, 'p50_ms', before['p50_ms'], after['p50_ms']))
+        if None not in (before['queries_per_op'], after['queries_per_op']) and \
+                after['queries_per_op'] > before['queries_per_op']:
+            regressions.append((name, 'queries_per_op', before['queries_per_op'], after['queries_per_op']))
+    return regressions
+
+
+def _print_results(results):
+    print(f'{"operation":<28} {"ops/s":>10} {"p50 ms":>9} {"p99 ms":>9} {"queries":>8} {"peak MB":>8}')
+    for name, result in results['operations'].items():
+        if 'error' in result:
+            print(f'{name:<28} {result["error"]}')
+            continue
+        rss = f'{result["peak_rss_mb"]:.0f}' if result['peak_rss_mb'] is not None else '-'
+        queries = f'{result["queries_per_op"]:.1f}' if result['queries_per_op'] is not None else '-'
+        print(f'{name:<28} {result["ops_per_sec"]:>10,.0f} {result["p50_ms"]:>9.2f} {result["p99_ms"]:>9.2f} '
+              f'{queries:>8} {rss:>8}')
+
+
+def main(argv=None):
+    """
+    Command line entry point: generate databases, run the benchmarks, and compare results.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark db.py operations and page renders.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_scale_arguments(command):
+        command.add_argument('--scale', choices=sorted(SCALES), default='small', help='preset size (default: small)')
+        for name in SCALES['small']:
+            command.add_argument(f'--{name}', type=int, help=f'override the preset number of {name}')
+        command.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+
+    generate_command = commands.add_parser('generate', help='create a synthetic database')
+    generate_command.add_argument('output', help='database file to create')
+    add_scale_arguments(generate_command)
+
+    run_command = commands.add_parser('run', help='benchmark every operation on a generated database')
+    add_scale_arguments(run_command)
+    run_command.add_argument('--iterations', type=int, default=200, help='calls per operation (default: 200)')
+    run_command.add_argument('--render-iterations', type=int, default=20, help='renders per page (default: 20)')
+    run_command.add_argument('--no-renders', action='store_true', help='skip the page renders')
+    run_command.add_argument('--no-instrument', action='store_true',
+                             help='run without query instrumentation, e.g. to measure its overhead')
+    run_command.add_argument('--output', help='save the results to this JSON file')
+
+    compare_command = commands.add_parser('compare', help='flag regressions between two result files')
+    compare_command.add_argument('baseline', help='JSON results of the reference run')
+    compare_command.add_argument('current', help='JSON results of the run to check')
+    compare_command.add_argument('--threshold', type=float, default=0.2,
+                                 help='tolerated relative p50 latency increase (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.baseline) as baseline, open(args.current) as current:
+            regressions = compare(json.load(baseline), json.load(current), args.threshold)
+        for name, metric, before, after in regressions:
+            if isinstance(before, float):
+                before, after = f'{before:.3f}', f'{after:.3f}'
+            print(f'REGRESSION {name}: {metric} {before} -> {after}')
+        print(f'{len(regressions)} regressions beyond {args.threshold:.0%}.')
+        return 1 if regressions else 0
+
+    scale = dict(SCALES[args.scale])
+    scale.update({name: getattr(args, name) for name in scale if getattr(args, name) is not None})
+    if args.command == 'generate':
+        generate(args.output, seed=args.seed, **scale)
+        print(f'Generated {args.output}: {scale}')
+        return 0
+
+    results = run(scale, args.seed, args.iterations, args.render_iterations, not args.no_renders,
+                  not args.no_instrument)
+    _print_results(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
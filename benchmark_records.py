@@ -0,0 +1,110 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import connection
+import db
+from connection import transaction
+
+# Number of activities loaded by default, spread over trips of ACTIVITIES_PER_TRIP.
+DEFAULT_ACTIVITIES = 1000000
+ACTIVITIES_PER_TRIP = 100
+
+
+def populate(count, seed=0):
+    """
+    Fill the configured database with synthetic trips and activities.
+
+    Args:
+        count (int): The number of activities to insert.
+        seed (int): Seed for the random generator, so runs are repeatable.
+    """
+    rng = random.Random(seed)
+    trips = (count + ACTIVITIES_PER_TRIP - 1) // ACTIVITIES_PER_TRIP
+    with transaction(immediate=True) as conn:
+        conn.executemany('INSERT INTO trips (id, title, start_day, end_day) VALUES (?, ?, ?, ?)',
+                         ((trip_id, f'Trip {trip_id}', 19000 + trip_id % 1000, 19013 + trip_id % 1000)
+                          for trip_id in range(1, trips + 1)))
+        conn.executemany(
+            'INSERT INTO activities (trip_id, day, name, minute, cost, file_path, address, confirmation) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((index // ACTIVITIES_PER_TRIP + 1, 19000 + rng.randrange(1000), f'Activity {index}',
+              rng.choice((None, rng.randrange(1440))), round(rng.uniform(0, 200), 2), None,
+              f'{rng.randrange(1, 999)} Main Street', f'C{index:08d}')
+             for index in range(count)))
+
+
+def load_dicts():
+    """
+    Load every activity the way readers did before records: as tuples converted to dictionaries.
+    """
+    with transaction() as conn:
+        rows = conn.execute(f'SELECT {db.Activity.SELECT} FROM activities').fetchall()
+    return [{'id': row[0], 'trip_id': row[1], 'date': row[2], 'name': row[3], 'time': row[4], 'cost': row[5],
+             'file_path': row[6], 'address': row[7], 'confirmation': row[8]} for row in rows]
+
+
+def load_records():
+    """
+    Load every activity as Activity records built by the cursor's row factory.
+    """
+    with transaction() as conn:
+        return db._select(conn, db.Activity, 'FROM activities').fetchall()
+
+
+LOADERS = {'dict': load_dicts, 'record': load_records}
+
+
+def measure(loader):
+    """
+    Run a loader twice: once for wall time, and once under tracemalloc for memory.
+
+    Returns:
+        dict: The keys 'rows', 'seconds', 'retained_mb' (memory held by the loaded rows) and
+            'peak_mb' (the most memory allocated at any point while loading).
+    """
+    started = time.perf_counter()
+    rows = loader()
+    seconds = time.perf_counter() - started
+    count = len(rows)
+    del rows
+
+    tracemalloc.start()
+    rows = loader()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rows
+    return {'rows': count, 'seconds': seconds, 'retained_mb': retained / 2 ** 20, 'peak_mb': peak / 2 ** 20}
+
+
+def main(argv=None):
+    """
+    Command line entry point: compare loading activities as dictionaries and as records.
+    """
+    parser = argparse.ArgumentParser(description='Measure the time and memory of loading activities.')
+    parser.add_argument('--db', help='benchmark an existing database instead of a generated one')
+    parser.add_argument('--activities', type=int, default=DEFAULT_ACTIVITIES,
+                        help='number of activities to generate (default: %(default)s)')
+    parser.add_argument('--loader', choices=sorted(LOADERS), action='append',
+                        help='loader to measure; may be repeated (default: all)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        connection.use_database(args.db or os.path.join(directory, 'benchmark.db'))
+        if not args.db:
+            print(f'Generating {args.activities:,} activities...')
+            populate(args.activities)
+        for name in args.loader or sorted(LOADERS):
+            result = measure(LOADERS[name])
+            print(f'{name:>6}: {result["rows"]:,} rows in {result["seconds"]:.2f}s, '
+                  f'{result["retained_mb"]:.0f} MB retained, {result["peak_mb"]:.0f} MB peak')
+        connection.close_all()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
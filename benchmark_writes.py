@@ -0,0 +1,104 @@
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import connection
+import db
+import writer
+from connection import transaction
+
+
+def add_activity_directly(trip_id, index):
+    """
+    Add an activity the way writers did before the write queue: one transaction and commit per call.
+    """
+    with transaction(immediate=True) as conn:
+        conn.execute('INSERT INTO activities (trip_id, day, name, minute, cost) VALUES (?, ?, ?, ?, ?)',
+                     (trip_id, 19723, f'Activity {index}', index % 1440, 10.0))
+
+
+def add_activity_queued(trip_id, index):
+    """
+    Add an activity through ``db.add_activity_to_day``, which goes through the write queue.
+    """
+    db.add_activity_to_day(trip_id, '2024-01-01', f'Activity {index}', None, 10.0, None, None, None)
+
+
+WRITERS = {'direct': add_activity_directly, 'queue': add_activity_queued}
+
+
+def measure(write, sessions, writes_per_session):
+    """
+    Run concurrent sessions that each perform a series of writes, and time them.
+
+    Args:
+        write (callable): Called as ``write(trip_id, index)`` for every write.
+        sessions (int): The number of concurrent sessions, one thread each.
+        writes_per_session (int): The number of writes each session performs.
+
+    Returns:
+        dict: The keys 'writes' (successful writes), 'errors' (writes that raised ``sqlite3.Error``),
+            'seconds' and 'per_second'.
+    """
+    trip_ids = [db.create_trip(f'Session {session}', '2024-01-01', '2024-01-07') for session in range(sessions)]
+    counts = {'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    start = threading.Barrier(sessions + 1)
+
+    def session(trip_id):
+        start.wait()
+        for index in range(writes_per_session):
+            try:
+                write(trip_id, index)
+                outcome = 'writes'
+            except sqlite3.Error:
+                outcome = 'errors'
+            with lock:
+                counts[outcome] += 1
+
+    threads = [threading.Thread(target=session, args=(trip_id,)) for trip_id in trip_ids]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    return dict(counts, seconds=seconds, per_second=counts['writes'] / seconds)
+
+
+def main(argv=None):
+    """
+    Command line entry point: compare write throughput with and without the write queue.
+    """
+    parser = argparse.ArgumentParser(description='Measure write throughput under concurrent sessions.')
+    parser.add_argument('--sessions', type=int, default=100, help='concurrent sessions (default: %(default)s)')
+    parser.add_argument('--writes', type=int, default=50, help='writes per session (default: %(default)s)')
+    parser.add_argument('--synchronous', default=connection.PRAGMAS['synchronous'],
+                        help='synchronous pragma for the run, e.g. FULL (default: %(default)s)')
+    parser.add_argument('--writer', choices=sorted(WRITERS), action='append',
+                        help='write path to measure; may be repeated (default: all)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        connection.use_database(os.path.join(directory, 'benchmark.db'))
+        connection.configure(synchronous=args.synchronous)
+        for name in args.writer or sorted(WRITERS):
+            writer.write_queue.batches = writer.write_queue.writes = 0
+            result = measure(WRITERS[name], args.sessions, args.writes)
+            line = (f'{name:>6}: {result["writes"]:,} writes in {result["seconds"]:.2f}s '
+                    f'({result["per_second"]:,.0f}/s), {result["errors"]} errors')
+            if name == 'queue' and writer.write_queue.batches:
+                line += f', {writer.write_queue.writes / writer.write_queue.batches:.1f} writes per commit'
+            print(line)
+        writer.write_queue.close()
+        connection.close_all()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import datetime, timezone
+
+import connection
+from dates import DATE_SQL, TIME_SQL
+
+# Number of rows fetched from each cursor at a time.
+FETCH_SIZE = 1000
+
+TRIP_FIELDS = ('key', 'title', 'start_date', 'end_date')
+ACTIVITY_FIELDS = ('id', 'trip_key', 'date', 'name', 'time', 'cost', 'file_path', 'address', 'confirmation')
+FLIGHT_FIELDS = ('id', 'trip_key', 'cost', 'seat', 'airline', 'flight_number', 'confirmation')
+HOTEL_FIELDS = ('id', 'trip_key', 'cost', 'name', 'address', 'rooms', 'confirmation')
+
+# Columns of the CSV export: the union of the fields of every record type, in the layout bulk_import reads.
+CSV_FIELDS = ('type', 'key', 'id', 'trip_key', 'title', 'start_date', 'end_date', 'date', 'name', 'time', 'cost',
+              'file_path', 'address', 'confirmation', 'seat', 'airline', 'flight_number', 'rooms')
+
+
+def _rows(conn, query, params, size):
+    """
+    Yield the rows of a query, fetching them from the cursor in chunks.
+    """
+    cursor = conn.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+
+def iter_records(trip_ids=None, fetch_size=FETCH_SIZE):
+    """
+    Stream every trip followed by its flights, hotels and activities as export records.
+
+    Each table is read by one cursor in trip order and the cursors are merged, so memory use does not
+    depend on the size of the database. All reads share one snapshot on a dedicated connection.
+
+    Args:
+        trip_ids (list): Export only these trips. Exports every trip if omitted.
+        fetch_size (int): The number of rows fetched from a cursor at a time.
+
+    Yields:
+        dict: Records in the format read by ``bulk_import``. Trips use their ID as their key, and the
+            other records refer to it by 'trip_key'.
+    """
+    if trip_ids is None:
+        trip_condition = child_condition = ''
+        params = ()
+    else:
+        params = tuple(int(trip_id) for trip_id in trip_ids)
+        placeholders = ', '.join('?' * len(params))
+        trip_condition = f'WHERE id IN ({placeholders})'
+        child_condition = f'WHERE trip_id IN ({placeholders})'
+
+    conn = connection.open_connection()
+    try:
+        conn.execute('BEGIN')
+        trips = _rows(conn, f"SELECT id, title, {DATE_SQL.format('start_day')}, {DATE_SQL.format('end_day')} "
+                            f'FROM trips {trip_condition} ORDER BY id', params, fetch_size)
+        children = [
+            ('flight', FLIGHT_FIELDS, _rows(conn, 'SELECT id, trip_id, cost, seat, airline, flight_number, confirmation '
+                                                  f'FROM flights {child_condition} ORDER BY trip_id, id',
+                                            params, fetch_size)),
+            ('hotel', HOTEL_FIELDS, _rows(conn, 'SELECT id, trip_id, cost, name, address, rooms, confirmation '
+                                                f'FROM hotels {child_condition} ORDER BY trip_id, id',
+                                          params, fetch_size)),
+            ('activity', ACTIVITY_FIELDS, _rows(conn, f"SELECT id, trip_id, {DATE_SQL.format('day')}, name, "
+                                                      f"{TIME_SQL.format('minute')}, cost, file_path, address, "
+                                                      f'confirmation FROM activities {child_condition} '
+                                                      'ORDER BY trip_id, day, minute IS NULL, minute',
+                                          params, fetch_size)),
+        ]
+        heads = [next(rows, None) for _, _, rows in children]
+
+        for trip_row in trips:
+            trip_id = trip_row[0]
+            yield dict(zip(('type',) + TRIP_FIELDS, ('trip', str(trip_id)) + trip_row[1:]))
+            for index, (kind, fields, rows) in enumerate(children):
+                row = heads[index]
+                # Child rows of trips outside the export range are skipped as the cursors advance.
+                while row is not None and row[1] <= trip_id:
+                    if row[1] == trip_id:
+                        record = dict(zip(fields, row))
+                        record['trip_key'] = str(trip_id)
+                        yield dict(type=kind, **record)
+                    row = next(rows, None)
+                heads[index] = row
+    finally:
+        conn.close()
+
+
+def write_jsonl(records, out):
+    """
+    Write records as JSON lines.
+
+    Args:
+        records (iterable): Export records, as produced by ``iter_records``.
+        out (file): The text file to write to.
+    """
+    for record in records:
+        out.write(json.dumps(record) + '\n')
+
+
+def write_csv(records, out):
+    """
+    Write records as CSV with one column per field of any record type.
+
+    Args:
+        records (iterable): Export records, as produced by ``iter_records``.
+        out (file): The text file to write to.
+    """
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+
+
+def _ics_text(value):
+    """
+    Escape a value for use in an iCalendar text property.
+    """
+    return (str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _ics_line(out, line):
+    """
+    Write an iCalendar content line, folded at 75 octets as required by RFC 5545.
+    """
+    encoded = line.encode('utf-8')
+    limit = 75
+    while len(encoded) > limit:
+        cut = limit
+        # Don't split a multi-byte character.
+        while (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        out.write(encoded[:cut].decode('utf-8') + '\r\n ')
+        encoded = encoded[cut:]
+        # Continuation lines start with a space, which counts towards their length.
+        limit = 74
+    out.write(encoded.decode('utf-8') + '\r\n')
+
+
+def write_ics(records, out):
+    """
+    Write the activities among the records as an iCalendar file with one event per activity.
+
+    Activities with a time become timed events in floating local time; the others become all-day events.
+
+    Args:
+        records (iterable): Export records, as produced by ``iter_records``.
+        out (file): The text file to write to.
+    """
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    _ics_line(out, 'BEGIN:VCALENDAR')
+    _ics_line(out, 'VERSION:2.0')
+    _ics_line(out, 'PRODID:-//Travel Planner//Trip Export//EN')
+    trip_title = None
+    for record in records:
+        if record['type'] == 'trip':
+            trip_title = record['title']
+            continue
+        if record['type'] != 'activity':
+            continue
+        day = record['date'].replace('-', '')
+        _ics_line(out, 'BEGIN:VEVENT')
+        _ics_line(out, f'UID:activity-{record["id"]}@travel-planner')
+        _ics_line(out, f'DTSTAMP:{stamp}')
+        if record['time']:
+            _ics_line(out, f'DTSTART:{day}T{datetime.strptime(record["time"], "%I:%M %p").strftime("%H%M%S")}')
+        else:
+            _ics_line(out, f'DTSTART;VALUE=DATE:{day}')
+        _ics_line(out, f'SUMMARY:{_ics_text(record["name"] or "Activity")}')
+        if record['address']:
+            _ics_line(out, f'LOCATION:{_ics_text(record["address"])}')
+        description = [f'Trip: {trip_title}']
+        if record['cost']:
+            description.append(f'Cost: ${record["cost"]}')
+        if record['confirmation']:
+            description.append(f'Confirmation: {record["confirmation"]}')
+        description = _ics_text('\n'.join(description))
+        _ics_line(out, f'DESCRIPTION:{description}')
+        _ics_line(out, 'END:VEVENT')
+    _ics_line(out, 'END:VCALENDAR')
+
+
+WRITERS = {
+    'jsonl': write_jsonl,
+    'csv': write_csv,
+    'ics': write_ics,
+}
+
+
+def export(out, fmt, trip_ids=None):
+    """
+    Stream trips and their bookings to a file.
+
+    Args:
+        out (file): The text file to write to. For CSV and ICS it should be opened with newline=''.
+        fmt (str): One of 'jsonl', 'csv' or 'ics'.
+        trip_ids (list): Export only these trips. Exports every trip if omitted.
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f'Unsupported export format: {fmt}')
+    WRITERS[fmt](iter_records(trip_ids), out)
+
+
+def export_text(fmt, trip_ids=None):
+    """
+    Export trips to a string, for callers such as download buttons that need the whole file at once.
+
+    Args:
+        fmt (str): One of 'jsonl', 'csv' or 'ics'.
+        trip_ids (list): Export only these trips. Exports every trip if omitted.
+
+    Returns:
+        str: The exported file contents.
+    """
+    out = io.StringIO(newline='')
+    export(out, fmt, trip_ids)
+    return out.getvalue()
+
+
+def main(argv=None):
+    """
+    Command line entry point: export trips to JSONL, CSV or iCalendar.
+    """
+    parser = argparse.ArgumentParser(description='Export trips, activities, flights and hotels.')
+    parser.add_argument('--format', choices=tuple(WRITERS), default='jsonl', help='output format')
+    parser.add_argument('--trip', type=int, action='append', dest='trip_ids', help='export only this trip ID '
+                                                                                   '(may be repeated)')
+    parser.add_argument('--output', default='-', help="file to write, or '-' for standard output")
+    args = parser.parse_args(argv)
+
+    if args.output == '-':
+        sys.stdout.reconfigure(newline='')
+        export(sys.stdout, args.format, args.trip_ids)
+    else:
+        with open(args.output, 'w', newline='', encoding='utf-8') as out:
+            export(out, args.format, args.trip_ids)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
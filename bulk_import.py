@@ -0,0 +1,358 @@
+import argparse
+import csv
+import json
+import math
+import sys
+
+import conflicts
+from cache import TRIP_LIST, read_cache
+from dates import to_day, to_minute
+from migrations import SEARCH_SOURCES
+from writer import write_queue
+
+# Number of rows inserted per transaction.
+BATCH_SIZE = 5000
+
+INSERTS = {
+    'trip': 'INSERT INTO trips (id, title, start_day, end_day) VALUES (?, ?, ?, ?)',
+    'activity': 'INSERT INTO activities (trip_id, day, name, minute, cost, file_path, address, confirmation) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+    'flight': 'INSERT INTO flights (trip_id, cost, seat, airline, flight_number, confirmation) '
+              'VALUES (?, ?, ?, ?, ?, ?)',
+    'hotel': 'INSERT INTO hotels (trip_id, cost, name, address, rooms, confirmation) VALUES (?, ?, ?, ?, ?, ?)',
+}
+
+
+def read_records(source, fmt):
+    """
+    Stream records from an open CSV or JSONL file without loading it into memory.
+
+    Every record is a mapping with a 'type' of 'trip', 'activity', 'flight' or 'hotel'. Trips carry an
+    external 'key'; the other types refer to their trip by 'trip_key'. In CSV files the columns are the
+    union of the fields of all types, and unused cells are left empty.
+
+    Args:
+        source (file): The open text file to read.
+        fmt (str): Either 'csv' or 'jsonl'.
+
+    Yields:
+        tuple: (line_number, record, error), where record is a dict, or None with an error message
+            if the line could not be parsed.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(source)
+        for record in reader:
+            yield reader.line_num, {name: value for name, value in record.items() if value != ''}, None
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(source, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as error:
+                yield line_number, None, f'invalid JSON: {error}'
+                continue
+            if not isinstance(record, dict):
+                yield line_number, None, 'expected a JSON object'
+                continue
+            yield line_number, record, None
+    else:
+        raise ValueError(f'Unsupported import format: {fmt}')
+
+
+def _text(record, field, required=False):
+    """
+    Read an optional or required text field from a record.
+    """
+    value = record.get(field)
+    if value is None or value == '':
+        if required:
+            raise ValueError(f'{field} is required')
+        return None
+    return str(value)
+
+
+def _date(record, field):
+    """
+    Read a required 'YYYY-MM-DD' date field from a record as a day number.
+    """
+    value = _text(record, field, required=True)
+    try:
+        return to_day(value)
+    except ValueError:
+        raise ValueError(f"{field} must be a 'YYYY-MM-DD' date") from None
+
+
+def _number(record, field, kind=float):
+    """
+    Read an optional non-negative, finite number field from a record.
+
+    Integer fields reject fractional values such as 2.7 instead of truncating them.
+    """
+    value = record.get(field)
+    if value is None or value == '':
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} must be a number') from None
+    if not math.isfinite(number):
+        raise ValueError(f'{field} must be a finite number')
+    if number < 0:
+        raise ValueError(f'{field} must not be negative')
+    if kind is int:
+        if not number.is_integer():
+            raise ValueError(f'{field} must be a whole number')
+        return int(number)
+    return number
+
+
+def _validate(record):
+    """
+    Validate a record and convert it to the row values for its table.
+
+    Returns:
+        tuple: (type, trip_key, values), where values omits the trip ID, which is resolved at insert time.
+    """
+    kind = record.get('type')
+    if kind == 'trip':
+        start_date = _date(record, 'start_date')
+        end_date = _date(record, 'end_date')
+        if end_date < start_date:
+            raise ValueError('end_date is before start_date')
+        return kind, _text(record, 'key', required=True), (_text(record, 'title', required=True), start_date,
+                                                           end_date)
+    trip_key = _text(record, 'trip_key', required=True)
+    if kind == 'activity':
+        try:
+            time = to_minute(_text(record, 'time'))
+        except ValueError:
+            raise ValueError("time must be in 'HH:MM AM' format") from None
+        return kind, trip_key, (_date(record, 'date'), _text(record, 'name', required=True), time,
+                                _number(record, 'cost'), _text(record, 'file_path'), _text(record, 'address'),
+                                _text(record, 'confirmation'))
+    if kind == 'flight':
+        return kind, trip_key, (_number(record, 'cost'), _text(record, 'seat'),
+                                _text(record, 'airline', required=True),
+                                _text(record, 'flight_number', required=True), _text(record, 'confirmation'))
+    if kind == 'hotel':
+        return kind, trip_key, (_number(record, 'cost'), _text(record, 'name', required=True),
+                                _text(record, 'address'), _number(record, 'rooms', int),
+                                _text(record, 'confirmation'))
+    raise ValueError(f'unknown record type: {kind!r}')
+
+
+# Tables whose per-row AFTER INSERT triggers skip their work while bulk_load holds a row (see
+# migrations._let_bulk_loads_suspend_insert_triggers); _apply_insert_triggers does it set-based instead.
+IMPORTED_TABLES = ('trips', 'activities', 'flights', 'hotels')
+
+
+def _apply_insert_triggers(conn, last_ids):
+    """
+    Do the work of the suspended insert triggers for every row inserted after the given IDs, set-based.
+
+    Indexes the new rows for search, adds their costs to the trip_totals and trip_day_totals rollups,
+    counts their references to attachment blobs and stamps their trips in trip_versions, as the
+    triggers in migrations.py would have row by row. Every query reads the new rows by rowid range
+    (NOT INDEXED), so a batch costs the same however large the tables already are.
+
+    Args:
+        conn (sqlite3.Connection): The connection holding the write transaction of the batch.
+        last_ids (dict): Table names mapped to the largest ID in the table before the batch.
+    """
+    for table, last_id in last_ids.items():
+        code, kind, *expressions = SEARCH_SOURCES[table]
+        conn.execute(f'''
+            INSERT INTO search_index (rowid, kind, trip_id, title, detail, confirmation)
+            SELECT id * 4 + {code}, '{kind}', {', '.join(expressions).format(row=table)} FROM {table} NOT INDEXED WHERE id > ?
+        ''', (last_id,))
+        if table == 'trips':
+            conn.execute('INSERT OR IGNORE INTO trip_totals (trip_id) SELECT id FROM trips NOT INDEXED WHERE id > ?', (last_id,))
+            continue
+        conn.execute(f'''
+            INSERT INTO trip_totals (trip_id, {table})
+            SELECT trip_id, SUM(COALESCE(cost, 0)) FROM {table} NOT INDEXED WHERE id > ? GROUP BY trip_id
+            ON CONFLICT (trip_id) DO UPDATE SET {table} = {table} + excluded.{table}
+        ''', (last_id,))
+    conn.execute('''
+        INSERT INTO trip_day_totals (trip_id, day, activities, items)
+        SELECT trip_id, day, SUM(COALESCE(cost, 0)), COUNT(*) FROM activities NOT INDEXED
+        WHERE id > ? AND day IS NOT NULL GROUP BY trip_id, day
+        ON CONFLICT (trip_id, day) DO UPDATE SET activities = activities + excluded.activities,
+                                                 items = items + excluded.items
+    ''', (last_ids['activities'],))
+    conn.execute('''
+        UPDATE blobs SET refs = refs + (SELECT COUNT(*) FROM activities NOT INDEXED
+                                        WHERE id > ?1 AND substr(file_path, 1, 64) = blobs.digest)
+        WHERE digest IN (SELECT substr(file_path, 1, 64) FROM activities NOT INDEXED WHERE id > ?1 AND file_path IS NOT NULL)
+    ''', (last_ids['activities'],))
+
+    # One stamp per changed trip, plus trip 0 for the trip list, with the revision counting every row. The
+    # first query of the union names the column trip_id.
+    changes = ' UNION ALL '.join(
+        [f'SELECT trip_id FROM {table} NOT INDEXED WHERE id > ?' for table in ('activities', 'flights', 'hotels')]
+        + ['SELECT id FROM trips NOT INDEXED WHERE id > ?', 'SELECT 0 FROM trips NOT INDEXED WHERE id > ?'])
+    conn.execute(f'''
+        INSERT INTO trip_versions (trip_id, seq, revision)
+        SELECT trip_id, (SELECT COALESCE(MAX(seq), 0) FROM trip_versions) + ROW_NUMBER() OVER (ORDER BY trip_id),
+               COUNT(*)
+        FROM ({changes}) GROUP BY trip_id
+        ON CONFLICT (trip_id) DO UPDATE SET seq = excluded.seq, revision = revision + excluded.revision
+    ''', [last_ids[table] for table in ('activities', 'flights', 'hotels', 'trips', 'trips')])
+
+
+def _flush(pending, trip_ids):
+    """
+    Insert one batch of validated rows as a single write through the write queue.
+    """
+    if not any(pending.values()):
+        return
+    write_queue.run(_insert_batch, pending, trip_ids)
+    for rows in pending.values():
+        rows.clear()
+
+
+def _insert_batch(conn, pending, trip_ids):
+    """
+    Insert one batch of validated rows inside the write queue's transaction.
+
+    New trips get consecutive IDs allocated under the write lock, which lets child rows in the same
+    batch be resolved without a round trip per trip. The per-row insert triggers are suspended by a
+    bulk_load row for the batch and their effects applied in bulk afterwards. The row is deleted again
+    before the transaction commits, and rolled back with the batch if it fails, so other connections
+    never see it.
+    """
+    conn.execute('INSERT INTO bulk_load DEFAULT VALUES')
+    last_ids = {table: conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+                for table in IMPORTED_TABLES}
+    if pending['trip']:
+        next_id = conn.execute('''
+            SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'trips'), 0),
+                       COALESCE((SELECT MAX(id) FROM trips), 0)) + 1
+        ''').fetchone()[0]
+        rows = []
+        for offset, (trip_key, values) in enumerate(pending['trip']):
+            trip_ids[trip_key] = next_id + offset
+            rows.append((next_id + offset,) + values)
+        conn.executemany(INSERTS['trip'], rows)
+    for kind in ('activity', 'flight', 'hotel'):
+        if pending[kind]:
+            conn.executemany(INSERTS[kind], [(trip_ids[trip_key],) + values for trip_key, values in pending[kind]])
+    _apply_insert_triggers(conn, last_ids)
+    conn.execute('DELETE FROM bulk_load')
+
+
+def import_records(records, batch_size=BATCH_SIZE, progress=None):
+    """
+    Validate and insert a stream of trip, activity, flight and hotel records in batched transactions.
+
+    A trip must appear before any record that refers to its key. Invalid records are skipped and
+    reported; they don't abort the import. Once everything is inserted, the imported trips are checked
+    for scheduling conflicts, which are reported without rejecting anything.
+
+    Args:
+        records (iterable): (line_number, record, error) tuples, as produced by ``read_records``.
+        batch_size (int): The number of rows to insert per transaction.
+        progress (callable): Called with the number of records processed after every batch.
+
+    Returns:
+        dict: A report with the keys 'inserted' (row counts by type), 'rejected' (a list of
+            (line_number, reason) tuples), 'trip_ids' (external trip keys mapped to new trip IDs) and
+            'conflicts' (the conflict dictionaries involving the imported trips, as returned by
+            ``conflicts.audit``).
+    """
+    pending = {'trip': [], 'activity': [], 'flight': [], 'hotel': []}
+    inserted = {kind: 0 for kind in pending}
+    rejected = []
+    trip_ids = {}
+    seen_keys = set()
+    processed = 0
+    batched = 0
+
+    for line_number, record, error in records:
+        processed += 1
+        if error is None:
+            try:
+                kind, trip_key, values = _validate(record)
+                if kind == 'trip' and trip_key in seen_keys:
+                    raise ValueError(f'duplicate trip key: {trip_key}')
+                if kind != 'trip' and trip_key not in seen_keys:
+                    raise ValueError(f'unknown trip key: {trip_key}')
+            except ValueError as validation_error:
+                error = str(validation_error)
+        if error is not None:
+            rejected.append((line_number, error))
+            continue
+
+        if kind == 'trip':
+            seen_keys.add(trip_key)
+        pending[kind].append((trip_key, values))
+        inserted[kind] += 1
+        batched += 1
+        if batched == batch_size:
+            _flush(pending, trip_ids)
+            batched = 0
+            if progress:
+                progress(processed)
+
+    _flush(pending, trip_ids)
+    if progress:
+        progress(processed)
+    read_cache.invalidate(TRIP_LIST, *trip_ids.values())
+    found = conflicts.audit(trip_ids.values()) if trip_ids else []
+    return {'inserted': inserted, 'rejected': rejected, 'trip_ids': trip_ids, 'conflicts': found}
+
+
+def import_file(path, fmt=None, batch_size=BATCH_SIZE, progress=None):
+    """
+    Import trips and their bookings from a CSV or JSONL file.
+
+    Args:
+        path (str): The file to read, or '-' for standard input.
+        fmt (str): Either 'csv' or 'jsonl'. Detected from the file extension if omitted.
+        batch_size (int): The number of rows to insert per transaction.
+        progress (callable): Called with the number of records processed after every batch.
+
+    Returns:
+        dict: The import report, as returned by ``import_records``.
+    """
+    if fmt is None:
+        fmt = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    if path == '-':
+        return import_records(read_records(sys.stdin, fmt), batch_size, progress)
+    with open(path, newline='', encoding='utf-8') as source:
+        return import_records(read_records(source, fmt), batch_size, progress)
+
+
+def main(argv=None):
+    """
+    Command line entry point: import a CSV or JSONL file into the trips database.
+    """
+    parser = argparse.ArgumentParser(description='Bulk import trips, activities, flights and hotels.')
+    parser.add_argument('path', help="CSV or JSONL file to import, or '-' for standard input")
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='input format (default: from the file extension)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='rows per transaction')
+    parser.add_argument('--errors', help='write rejected rows to this file as JSONL')
+    args = parser.parse_args(argv)
+
+    def progress(processed):
+        print(f'{processed} records processed', file=sys.stderr)
+
+    report = import_file(args.path, args.format, args.batch_size, progress)
+    counts = ', '.join(f'{count} {kind}' for kind, count in report['inserted'].items())
+    print(f'Inserted {counts}; rejected {len(report["rejected"])} records; found {len(report["conflicts"])} '
+          f'scheduling conflicts.')
+    for conflict in report['conflicts']:
+        print(f'trip {conflict["trip_id"]}: {conflict["message"]}', file=sys.stderr)
+    if args.errors:
+        with open(args.errors, 'w', encoding='utf-8') as errors:
+            for line_number, reason in report['rejected']:
+                errors.write(json.dumps({'line': line_number, 'error': reason}) + '\n')
+    else:
+        for line_number, reason in report['rejected']:
+            print(f'line {line_number}: {reason}', file=sys.stderr)
+    return 1 if report['rejected'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
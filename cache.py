@@ -0,0 +1,188 @@
+import functools
+import threading
+from collections import OrderedDict
+
+import connection
+
+# Scope used for results that depend on the list of trips rather than on a single trip.
+# Matches the trip_id 0 row maintained in trip_versions.
+TRIP_LIST = 0
+
+
+class ReadCache:
+    """
+    A bounded LRU cache of db.py read results, invalidated per trip.
+
+    Entries are tagged with the trip they were read for, and with any other trips their value
+    depends on, such as the trips on a page of the trip list. Writers in this process invalidate their
+    trip directly. Writes made through any other connection, including other server processes, are
+    picked up by polling ``PRAGMA data_version`` on a dedicated connection and, when it has moved,
+    reading which trips were stamped in trip_versions since the last check.
+
+    Cached values are shared between callers and must be treated as read-only.
+
+    Attributes:
+        maxsize (int): The maximum number of entries kept before the least recently used is evicted.
+    """
+
+    def __init__(self, maxsize=4096):
+        """
+        Initialize a ReadCache object.
+
+        Args:
+            maxsize (int): The maximum number of entries to keep.
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._keys_by_trip = {}
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._watcher = None
+        self._data_version = None
+        self._last_seq = 0
+
+    def get_or_load(self, key, trip_id, loader, related=None):
+        """
+        Return the cached value for a key, calling the loader to fill it on a miss.
+
+        Args:
+            key (tuple): The cache key.
+            trip_id (int): The trip the value belongs to, or TRIP_LIST.
+            loader (callable): A function with no arguments that reads the value from the database.
+            related (callable): A function taking the loaded value and returning the other trips it
+                depends on, or None.
+
+        Returns:
+            The cached or freshly loaded value.
+        """
+        with self._lock:
+            self._sync()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][1]
+            generation = self._generation
+
+        value = loader()
+
+        # Skip the store if anything was invalidated while loading; the value may predate that write.
+        self.put_many({key: value}, trip_id, generation, related(value) if related else ())
+        return value
+
+    def generation(self):
+        """
+        Return a token identifying the current invalidation state, for use with ``put_many``.
+
+        Returns:
+            int: The current generation.
+        """
+        with self._lock:
+            self._sync()
+            return self._generation
+
+    def put_many(self, entries, trip_id, generation, related=()):
+        """
+        Store several values read for one trip, unless anything was invalidated since ``generation``.
+
+        Args:
+            entries (dict): Cache keys mapped to their values.
+            trip_id (int): The trip the values belong to.
+            generation (int): The value of ``generation()`` taken before the values were read.
+            related (iterable): Other trips the values depend on. Invalidating any of them drops the values.
+        """
+        trip_ids = {trip_id, *related}
+        with self._lock:
+            if generation != self._generation:
+                return
+            for key, value in entries.items():
+                self._entries[key] = (trip_ids, value)
+                self._entries.move_to_end(key)
+                for each_trip_id in trip_ids:
+                    self._keys_by_trip.setdefault(each_trip_id, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                evicted_key, (evicted_trip_ids, _) = self._entries.popitem(last=False)
+                for evicted_trip_id in evicted_trip_ids:
+                    self._keys_by_trip[evicted_trip_id].discard(evicted_key)
+
+    def invalidate(self, *trip_ids):
+        """
+        Drop every cached entry for the given trips.
+
+        Args:
+            *trip_ids (int): The trips to invalidate. Use TRIP_LIST for the list of trips.
+        """
+        with self._lock:
+            self._generation += 1
+            for trip_id in trip_ids:
+                for key in self._keys_by_trip.pop(trip_id, ()):
+                    entry = self._entries.pop(key, None)
+                    # Forget the entry under the other trips it was tagged with too.
+                    for other_trip_id in entry[0] if entry else ():
+                        if other_trip_id != trip_id:
+                            self._keys_by_trip[other_trip_id].discard(key)
+
+    def clear(self):
+        """
+        Drop every cached entry and forget the database the cache was watching.
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys_by_trip.clear()
+            if self._watcher is not None:
+                self._watcher.close()
+            self._watcher = None
+            self._data_version = None
+
+    def _sync(self):
+        """
+        Invalidate trips changed through other connections since the last check.
+
+        Must be called with the lock held.
+        """
+        if self._watcher is None:
+            self._watcher = connection.open_connection()
+            self._last_seq = self._watcher.execute('SELECT COALESCE(MAX(seq), 0) FROM trip_versions').fetchone()[0]
+            self._data_version = self._watcher.execute('PRAGMA data_version').fetchone()[0]
+            return
+
+        data_version = self._watcher.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        # The trip holding the latest stamp isn't re-stamped by further changes, so it is always
+        # included; see migrations._coalesce_trip_version_stamps.
+        changed = self._watcher.execute('SELECT trip_id, seq FROM trip_versions WHERE seq >= ?',
+                                        (self._last_seq,)).fetchall()
+        if changed:
+            self.invalidate(*(trip_id for trip_id, _ in changed))
+            self._last_seq = max(seq for _, seq in changed)
+
+
+read_cache = ReadCache()
+connection.on_database_change(read_cache.clear)
+
+
+def cached_read(scope, related=None):
+    """
+    Decorate a db.py reader so its results are served from ``read_cache``.
+
+    Reads made inside an open transaction bypass the cache, since they may see uncommitted writes.
+
+    Args:
+        scope (callable): A function taking the reader's arguments and returning the trip_id the
+            result belongs to, or TRIP_LIST.
+        related (callable): A function taking the reader's result and returning the other trips it
+            depends on, or None.
+
+    Returns:
+        callable: The decorator.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if connection.in_transaction():
+                return func(*args, **kwargs)
+            key = (func.__name__,) + args + tuple(sorted(kwargs.items()))
+            return read_cache.get_or_load(key, scope(*args, **kwargs), lambda: func(*args, **kwargs), related)
+        return wrapper
+    return decorator
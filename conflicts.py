@@ -0,0 +1,289 @@
+import argparse
+import bisect
+import heapq
+import itertools
+import json
+import sys
+
+from connection import transaction
+from dates import from_day, from_minute, to_day, to_minute
+from db import find_overlapping_activities, find_overlapping_trips, get_activity_days_outside_trip, \
+    get_hotels_for_trip, get_itinerary_range, get_trip_by_id
+
+# Minutes an activity is assumed to take when looking for double bookings, since activities only
+# record a start time. Activities of a trip starting less than this apart on the same day conflict.
+ACTIVITY_MINUTES = 60
+
+
+class IntervalIndex:
+    """
+    Half-open intervals sorted by start, searched with binary search instead of pairwise comparisons.
+
+    A running maximum of the interval ends lets a search stop as soon as no earlier interval reaches
+    the query, so finding the k intervals overlapping a query takes O(log n + k) in practice.
+    """
+
+    def __init__(self, intervals):
+        """
+        Initialize an IntervalIndex object.
+
+        Args:
+            intervals (iterable): (start, end, key) tuples, end exclusive. Sorting is O(n log n), and
+                O(n) for intervals that already come ordered by start, e.g. from an index.
+        """
+        self._intervals = sorted(intervals, key=lambda interval: interval[:2])
+        self._starts = [start for start, _, _ in self._intervals]
+        self._reach = list(itertools.accumulate((end for _, end, _ in self._intervals), max))
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def overlapping(self, start, end):
+        """
+        Return the keys of the intervals overlapping [start, end), ordered by start.
+
+        Args:
+            start: The start of the query interval.
+            end: The end of the query interval, exclusive.
+
+        Returns:
+            list: The keys of the overlapping intervals.
+        """
+        found = []
+        position = bisect.bisect_left(self._starts, end) - 1
+        while position >= 0 and self._reach[position] > start:
+            _, interval_end, key = self._intervals[position]
+            if interval_end > start:
+                found.append(key)
+            position -= 1
+        found.reverse()
+        return found
+
+    def overlaps(self):
+        """
+        Find every pair of overlapping intervals, in one sweep over the sorted intervals.
+
+        The intervals still open at each start are kept in a heap ordered by end, so the sweep takes
+        O(n log n + k) for k pairs.
+
+        Returns:
+            list: (earlier key, key) tuples, one per overlapping pair, ordered by the start of the later
+                interval and then of the earlier one.
+        """
+        pairs = []
+        open_intervals = []
+        for position, (start, end, key) in enumerate(self._intervals):
+            while open_intervals and open_intervals[0][0] <= start:
+                heapq.heappop(open_intervals)
+            pairs.extend((earlier_key, key) for _, _, earlier_key in sorted(open_intervals, key=lambda item: item[1]))
+            heapq.heappush(open_intervals, (end, position, key))
+        return pairs
+
+
+def _index_days(activities):
+    """
+    Group (day, id, name, minute) rows ordered by day into per-day IntervalIndexes of the timed activities,
+    each assumed to last ACTIVITY_MINUTES and keyed by (activity ID, name, minute). Days whose activities
+    have no time map to an empty index.
+    """
+    return {day: IntervalIndex((minute, minute + ACTIVITY_MINUTES, (activity_id, name, minute))
+                               for _, activity_id, name, minute in rows if minute is not None)
+            for day, rows in itertools.groupby(activities, key=lambda activity: activity[0])}
+
+
+def _conflict(kind, trip_id, day, ids, message):
+    return {'kind': kind, 'trip_id': trip_id, 'date': None if day is None else from_day(day).isoformat(),
+            'ids': ids, 'message': message}
+
+
+def _describe_activity(key):
+    _, name, minute = key
+    return f'{name} at {from_minute(minute)}'
+
+
+def _trip_overlap(trip, other):
+    trip_id, title, _, _ = trip
+    other_id, other_title, other_start, other_end = other
+    return _conflict('overlapping_trips', trip_id, None, [trip_id, other_id],
+                     f'{title} overlaps {other_title} ({from_day(other_start)} to {from_day(other_end)}).')
+
+
+def _overlapping_trips(trip, start_date, end_date):
+    """
+    Find the conflicts between a trip and the other trips sharing its dates.
+    """
+    return [_trip_overlap(trip, (other.id, other.title, other.start_day, other.end_day))
+            for other in find_overlapping_trips(start_date, end_date, trip[0])]
+
+
+def _schedule_conflicts(trip, days):
+    """
+    Find the double-booked activities and the activities outside the dates of one trip.
+
+    Args:
+        trip (tuple): (trip ID, title, start day, end day).
+        days (dict): Day numbers mapped to the IntervalIndex of the day's activities, from ``_index_days``.
+
+    Returns:
+        list: The conflicts, ordered by day.
+    """
+    trip_id, title, start_day, end_day = trip
+    conflicts = []
+    for day, index in sorted(days.items()):
+        if not start_day <= day <= end_day:
+            conflicts.append(_conflict('outside_trip', trip_id, day, [], f'{title} has activities on '
+                                       f'{from_day(day)}, outside its dates.'))
+        for earlier, later in index.overlaps():
+            conflicts.append(_conflict('double_booked', trip_id, day, [earlier[0], later[0]],
+                                       f'{from_day(day)}: {_describe_activity(later)} overlaps '
+                                       f'{_describe_activity(earlier)}.'))
+    return conflicts
+
+
+def _missing_hotel(trip_id, title, nights):
+    return _conflict('no_hotel', trip_id, None, [], f'No hotel is booked for the {nights} '
+                     f'night{"s" if nights > 1 else ""} of {title}.')
+
+
+def check_trip(start_date, end_date, trip_id=None):
+    """
+    Check the dates of a trip about to be created, or moved, against the other trips.
+
+    Args:
+        start_date (datetime.date or str): The first day of the trip.
+        end_date (datetime.date or str): The last day of the trip.
+        trip_id (int): The trip being changed, left out of the comparison, or None for a new trip.
+
+    Returns:
+        list: One conflict dictionary per overlapping trip, with the keys 'kind' ('overlapping_trips'),
+            'trip_id', 'date' (None), 'ids' (the trip IDs) and 'message'.
+    """
+    trip = (trip_id, 'This trip', to_day(start_date), to_day(end_date))
+    return _overlapping_trips(trip, start_date, end_date)
+
+
+def check_activity(trip_id, date, time):
+    """
+    Check an activity about to be added against the trip's dates and the activities already on its day.
+
+    Args:
+        trip_id (int): The trip of the activity.
+        date (str): The date of the activity in 'YYYY-MM-DD' format.
+        time (datetime.time or str): The time of the activity, or None.
+
+    Returns:
+        list: Conflict dictionaries, with the keys 'kind' ('outside_trip' or 'double_booked'),
+            'trip_id', 'date', 'ids' (the activities already booked) and 'message'.
+    """
+    day, minute = to_day(date), to_minute(time)
+    conflicts = []
+    trip = get_trip_by_id(trip_id)
+    if trip is not None and not trip.start_day <= day <= trip.end_day:
+        conflicts.append(_conflict('outside_trip', trip_id, day, [], f'{date} is outside the dates of the trip.'))
+    for activity in find_overlapping_activities(trip_id, date, time, ACTIVITY_MINUTES):
+        conflicts.append(_conflict('double_booked', trip_id, day, [activity.id],
+                                   f'{from_minute(minute)} overlaps {activity.name} at {activity.time}.'))
+    return conflicts
+
+
+def trip_conflicts(trip_id, start_date=None, end_date=None):
+    """
+    Find the conflicts involving one trip: other trips on its dates, double-booked activities, activities
+    outside its dates, and nights without a hotel.
+
+    Args:
+        trip_id (int): The ID of the trip.
+        start_date (datetime.date or str): The first day to look for double bookings on, or None for the
+            start of the trip.
+        end_date (datetime.date or str): The last day to look for double bookings on, or None for the end
+            of the trip.
+
+    Returns:
+        list: Conflict dictionaries, with the keys 'kind', 'trip_id', 'date', 'ids' and 'message'.
+    """
+    record = get_trip_by_id(trip_id)
+    if record is None:
+        return []
+    trip = (trip_id, record.title, record.start_day, record.end_day)
+    conflicts = _overlapping_trips(trip, record.start_date, record.end_date)
+    if record.end_day > record.start_day and not get_hotels_for_trip(trip_id):
+        conflicts.append(_missing_hotel(trip_id, record.title, record.end_day - record.start_day))
+    itinerary = get_itinerary_range(trip_id, start_date or record.start_date, end_date or record.end_date)
+    days = _index_days((to_day(activity.date), activity.id, activity.name, to_minute(activity.time))
+                       for date in sorted(itinerary) for activity in itinerary[date])
+    # Days outside the trip are only reported, so their activities don't need to be read.
+    days.update((to_day(date), IntervalIndex(())) for date in get_activity_days_outside_trip(trip_id))
+    return conflicts + _schedule_conflicts(trip, days)
+
+
+def audit(trip_ids=None):
+    """
+    Check every trip that isn't archived, or only some of them, in one pass over each table in index order.
+
+    Overlapping trips are found with a sweep over the trips sorted by start date, and double bookings
+    with a sweep over each day's activities sorted by time, so the audit takes O(n log n + k) for k
+    conflicts rather than comparing every pair.
+
+    Args:
+        trip_ids (iterable): Only report the conflicts involving these trips, e.g. the trips of a bulk
+            import, or None for every trip. The sweep over the trips still reads all of them, but only
+            the activities and hotels of these trips are read.
+
+    Returns:
+        list: Conflict dictionaries, with the keys 'kind' ('overlapping_trips', 'no_hotel',
+            'outside_trip' or 'double_booked'), 'trip_id', 'date', 'ids' and 'message'.
+    """
+    selected = None
+    trip_filter = activity_filter = ''
+    params = ()
+    if trip_ids is not None:
+        selected = set(trip_ids)
+        # The selected trips are passed to SQLite as one JSON array parameter.
+        trip_filter = 'AND id IN (SELECT value FROM json_each(?))'
+        activity_filter = 'WHERE trip_id IN (SELECT value FROM json_each(?))'
+        params = (json.dumps(sorted(selected)),)
+    with transaction() as conn:
+        trips = conn.execute('SELECT id, title, start_day, end_day FROM trips WHERE archived = 0 ORDER BY start_day')
+        index = IntervalIndex((trip[2], trip[3] + 1, trip) for trip in trips)
+        conflicts = [_trip_overlap(later, earlier) for earlier, later in index.overlaps()
+                     if selected is None or earlier[0] in selected or later[0] in selected]
+        for trip_id, title, nights in conn.execute(f'''
+            SELECT id, title, end_day - start_day FROM trips
+            WHERE archived = 0 AND end_day > start_day AND NOT EXISTS (SELECT 1 FROM hotels WHERE trip_id = trips.id)
+            {trip_filter}
+            ORDER BY id
+        ''', params):
+            conflicts.append(_missing_hotel(trip_id, title, nights))
+        trips = conn.execute(f'SELECT id, title, start_day, end_day FROM trips WHERE archived = 0 {trip_filter} '
+                             'ORDER BY id', params)
+        activities = conn.execute(f'SELECT trip_id, day, id, name, minute FROM activities {activity_filter} '
+                                  'ORDER BY trip_id, day, minute IS NULL, minute', params)
+        by_trip = itertools.groupby(activities, key=lambda activity: activity[0])
+        current = next(by_trip, None)
+        for trip in trips:
+            while current is not None and current[0] < trip[0]:
+                current = next(by_trip, None)
+            if current is not None and current[0] == trip[0]:
+                days = _index_days(activity[1:] for activity in current[1])
+                conflicts.extend(_schedule_conflicts(trip, days))
+    return conflicts
+
+
+def main(argv=None):
+    """
+    Command line entry point: audit every trip for scheduling conflicts.
+    """
+    parser = argparse.ArgumentParser(description='Report overlapping trips, double-booked activities, '
+                                                 'activities outside their trip and nights without a hotel.')
+    parser.add_argument('--trip', type=int, help='check only this trip')
+    args = parser.parse_args(argv)
+
+    conflicts = trip_conflicts(args.trip) if args.trip is not None else audit()
+    for conflict in conflicts:
+        print(f'trip {conflict["trip_id"]}: {conflict["message"]}')
+    print(f'Found {len(conflicts)} conflicts.')
+    return 1 if conflicts else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
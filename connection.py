@@ -0,0 +1,261 @@
+import atexit
+import itertools
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import migrations
+
+# The database to use: a file path, ':memory:' or a 'file:' URI. Set TRIPS_DB to override the
+# default, or call use_database() to switch at runtime.
+DB_PATH = os.environ.get('TRIPS_DB', 'trips.db')
+
+# Pragmas applied to every pooled connection when it is opened.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+}
+
+# Number of idle connections kept around for reuse.
+POOL_SIZE = 8
+
+# Seconds a connection waits on a locked database before raising.
+BUSY_TIMEOUT = 30.0
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_target_lock = threading.Lock()
+_generation = 0
+_memory_uri = None
+_memory_names = itertools.count(1)
+_keeper = None
+_reset_callbacks = []
+_connect_callbacks = []
+
+
+def database_target():
+    """
+    Return the arguments for ``sqlite3.connect`` that open the configured database.
+
+    ':memory:' is opened as a named in-memory database on the memdb VFS, so every connection in the
+    process shares it and waits on the busy timeout like it would on a file. In-memory databases are
+    kept alive by a connection held open here until ``use_database`` switches away from them.
+
+    Returns:
+        tuple: (database, uri), to pass as ``sqlite3.connect(database, uri=uri)``.
+    """
+    global _memory_uri, _keeper
+    with _target_lock:
+        database = DB_PATH
+        if database == ':memory:':
+            if _memory_uri is None:
+                _memory_uri = f'file:/trips-{os.getpid()}-{next(_memory_names)}?vfs=memdb'
+            database = _memory_uri
+        uri = database.startswith('file:')
+        if _keeper is None and uri and ('mode=memory' in database or 'vfs=memdb' in database):
+            _keeper = sqlite3.connect(database, uri=True, check_same_thread=False)
+        return database, uri
+
+
+def use_database(target):
+    """
+    Point the application at another database, such as a per-test in-memory one.
+
+    Idle pooled connections and the previous in-memory database are closed, and the callbacks
+    registered with ``on_database_change`` run so caches drop what they read. Connections checked out
+    at the time are closed when released. Migrations run on the first connection to the new database.
+
+    Args:
+        target (str): A file path, ':memory:' for a new in-memory database private to this process,
+            or a 'file:' URI, e.g. 'file:trips?mode=memory&cache=shared'.
+
+    Raises:
+        RuntimeError: If called inside a ``transaction()`` block.
+    """
+    global DB_PATH, _generation, _memory_uri, _keeper, _schema_ready
+    if in_transaction():
+        raise RuntimeError('Cannot switch databases inside a transaction')
+    with _target_lock:
+        DB_PATH = target
+        _generation += 1
+        _memory_uri = None
+        keeper, _keeper = _keeper, None
+    with _schema_lock:
+        _schema_ready = False
+    close_all()
+    for callback in _reset_callbacks:
+        callback()
+    if keeper is not None:
+        keeper.close()
+
+
+def on_database_change(callback):
+    """
+    Register a function to call, without arguments, whenever ``use_database`` switches databases.
+
+    Args:
+        callback (callable): The function, typically one that closes connections and clears caches.
+
+    Returns:
+        callable: The callback, so this can be used as a decorator.
+    """
+    _reset_callbacks.append(callback)
+    return callback
+
+
+def on_connect(callback):
+    """
+    Register a function to call with every connection ``open_connection`` opens from now on. Registering
+    the same function again has no effect.
+
+    Use it to instrument connections, e.g. with ``conn.set_trace_callback``. Call ``close_all`` or
+    ``use_database`` afterwards so idle pooled connections are reopened with the callback applied.
+
+    Args:
+        callback (callable): Called as ``callback(conn)`` after pragmas and migrations are applied.
+
+    Returns:
+        callable: The callback, so this can be used as a decorator.
+    """
+    if callback not in _connect_callbacks:
+        _connect_callbacks.append(callback)
+    return callback
+
+
+def open_connection():
+    """
+    Open a new connection to the database with the configured pragmas applied.
+
+    Pending schema migrations are applied the first time a connection is opened in this process.
+
+    Returns:
+        sqlite3.Connection: A new connection in autocommit mode.
+    """
+    global _schema_ready
+    database, uri = database_target()
+    conn = sqlite3.connect(database, uri=uri, timeout=BUSY_TIMEOUT, isolation_level=None,
+                           check_same_thread=False)
+    for name, value in PRAGMAS.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                migrations.migrate(conn)
+                _schema_ready = True
+    for callback in _connect_callbacks:
+        callback(conn)
+    return conn
+
+
+def _acquire():
+    """
+    Take an idle connection from the pool, opening a new one if the pool is empty.
+
+    Returns:
+        sqlite3.Connection: A connection owned by the caller until released.
+    """
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return open_connection()
+
+
+def _release(conn, generation):
+    """
+    Return a connection to the pool, closing it if the pool is already full.
+
+    Args:
+        conn (sqlite3.Connection): The connection to release.
+        generation (int): The database generation the connection was acquired in. Connections to a
+            database that ``use_database`` has since switched away from are closed.
+    """
+    if generation != _generation:
+        conn.close()
+        return
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+@contextmanager
+def transaction(immediate=False):
+    """
+    Run a block of work inside a single transaction on a pooled connection.
+
+    The transaction commits when the block exits normally and rolls back if it raises.
+    Nested calls on the same thread join the outermost transaction.
+
+    Args:
+        immediate (bool): Take the write lock up front (BEGIN IMMEDIATE). Use this for
+            blocks that write, so concurrent writers queue on the busy timeout instead of
+            failing on a lock upgrade.
+
+    Yields:
+        sqlite3.Connection: The connection to run statements on.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+
+    generation = _generation
+    conn = _acquire()
+    _local.conn = conn
+    try:
+        conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    finally:
+        _local.conn = None
+        _release(conn, generation)
+
+
+def in_transaction():
+    """
+    Return whether the current thread is inside a ``transaction()`` block.
+
+    Returns:
+        bool: True if a transaction is open on this thread.
+    """
+    return getattr(_local, 'conn', None) is not None
+
+
+def configure(**pragmas):
+    """
+    Override connection pragmas for connections opened from now on.
+
+    Idle pooled connections are closed so the new settings take effect on the next call.
+
+    Args:
+        **pragmas: Pragma names and values, e.g. ``synchronous='FULL'``.
+    """
+    PRAGMAS.update(pragmas)
+    close_all()
+
+
+def close_all():
+    """
+    Close every idle pooled connection.
+    """
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            break
+        conn.close()
+
+
+atexit.register(close_all)
@@ -0,0 +1,88 @@
+import re
+from datetime import date, datetime, time, timedelta
+
+# Dates are stored as days since 1970-01-01 and times as minutes since midnight.
+EPOCH = date(1970, 1, 1)
+
+# Julian day number of the epoch, for converting stored days with SQLite's date functions.
+EPOCH_JULIAN_DAY = 2440587.5
+
+# Accepts what strptime's '%I:%M %p' does: one or two digit hours and minutes, either case of AM/PM.
+TIME_PATTERN = re.compile(r'^(0?[1-9]|1[0-2]):([0-5]?[0-9])\s+(AM|PM)$', re.IGNORECASE)
+
+# SQL expressions that format a stored day as 'YYYY-MM-DD' and a stored minute as 'HH:MM AM'.
+# {} stands for the column or expression holding the stored value.
+DATE_SQL = f'date({{}} + {EPOCH_JULIAN_DAY})'
+TIME_SQL = ("CASE WHEN {0} IS NOT NULL THEN printf('%02d:%02d %s', ({0} / 60 + 11) % 12 + 1, {0} % 60, "
+            "CASE WHEN {0} < 720 THEN 'AM' ELSE 'PM' END) END")
+
+
+def to_day(value):
+    """
+    Encode a date as the number of days since 1970-01-01.
+
+    Args:
+        value (datetime.date or str): The date, or a string in 'YYYY-MM-DD' format. The time of day of a
+            datetime.datetime is ignored.
+
+    Returns:
+        int: The day number.
+    """
+    if isinstance(value, str):
+        value = date.fromisoformat(value)
+    elif isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH).days
+
+
+def from_day(day):
+    """
+    Decode a day number stored by ``to_day``.
+
+    Args:
+        day (int): The number of days since 1970-01-01.
+
+    Returns:
+        datetime.date: The date.
+    """
+    return EPOCH + timedelta(days=day)
+
+
+def to_minute(value):
+    """
+    Encode a time of day as the number of minutes since midnight.
+
+    Args:
+        value (datetime.time or str): The time, or a string in 'HH:MM AM' format, also accepted with a
+            one-digit hour or a lowercase 'am'/'pm'. May be None or empty.
+
+    Returns:
+        int: The minute of the day, or None if no time was given.
+
+    Raises:
+        ValueError: If a string isn't in 'HH:MM AM' format.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, time):
+        return value.hour * 60 + value.minute
+    match = TIME_PATTERN.match(value)
+    if match is None:
+        raise ValueError(f"Time must be in 'HH:MM AM' format: {value!r}")
+    hour, minute, period = match.groups()
+    return (int(hour) % 12 + (12 if period.upper() == 'PM' else 0)) * 60 + int(minute)
+
+
+def from_minute(minute):
+    """
+    Decode a minute of the day stored by ``to_minute`` into the 'HH:MM AM' format.
+
+    Args:
+        minute (int): The number of minutes since midnight, or None.
+
+    Returns:
+        str: The formatted time, or None if no time was stored.
+    """
+    if minute is None:
+        return None
+    return f"{(minute // 60 + 11) % 12 + 1:02d}:{minute % 60:02d} {'AM' if minute < 720 else 'PM'}"
@@ -1,63 +1,31 @@
 import sqlite3
 
+import connection
+import migrations
+from cache import TRIP_LIST, cached_read, read_cache
+from connection import transaction
+from dates import DATE_SQL, TIME_SQL, from_day, to_day, to_minute
+from instrumentation import instrumented
+from writer import write_queue
+
 
 def connect_db():
     """
-    Establish a connection to the SQLite database and create necessary tables if they don't exist.
+    Open a standalone connection to the SQLite database and apply any pending schema migrations.
+
+    Application code should use ``connection.transaction()`` instead, which reuses pooled connections.
 
     Returns:
         sqlite3.Connection: A connection object to the SQLite database.
     """
-    conn = sqlite3.connect('trips.db')
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS trips (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT,
-            start_date TEXT,
-            end_date TEXT
-        )
-    ''')
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS activities (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            trip_id INTEGER,
-            date TEXT,
-            name TEXT,
-            time TEXT,
-            cost REAL,
-            file_path TEXT,
-            address TEXT,
-            confirmation TEXT,
-            FOREIGN KEY (trip_id) REFERENCES trips (id)
-        )
-    ''')
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS flights (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            trip_id INTEGER,
-            cost REAL,
-            seat TEXT,
-            airline TEXT,
-            flight_number TEXT,
-            confirmation TEXT,
-            FOREIGN KEY (trip_id) REFERENCES trips (id)
-        )
-    ''')
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS hotels (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            trip_id INTEGER,
-            cost REAL,
-            name TEXT,
-            address TEXT,
-            rooms INTEGER,
-            confirmation TEXT,
-            FOREIGN KEY (trip_id) REFERENCES trips (id)
-        )
-    ''')
+    database, uri = connection.database_target()
+    conn = sqlite3.connect(database, uri=uri)
+    conn.execute('PRAGMA foreign_keys = ON')
+    migrations.migrate(conn)
     return conn
 
 
+@instrumented
 def create_trip(title, start_date, end_date):
     """
     Create a new trip in the database.
@@ -66,14 +34,18 @@ def create_trip(title, start_date, end_date):
         title (str): The title of the trip.
         start_date (datetime.date): The start date of the trip.
         end_date (datetime.date): The end date of the trip.
+
+    Returns:
+        int: The ID of the new trip.
     """
-    conn = connect_db()
-    conn.execute('INSERT INTO trips (title, start_date, end_date) VALUES (?, ?, ?)',
-                 (title, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")))
-    conn.commit()
-    conn.close()
+    trip_id = write_queue.run(_execute, 'INSERT INTO trips (title, start_day, end_day) VALUES (?, ?, ?)',
+                              (title, to_day(start_date), to_day(end_date)))
+    read_cache.invalidate(trip_id, TRIP_LIST)
+    return trip_id
 
 
+@instrumented
+@cached_read(lambda: TRIP_LIST)
 def get_all_trips():
     """
     Retrieve all trips from the database.
@@ -81,16 +53,47 @@ def get_all_trips():
     Returns:
         list: A list of Trip objects representing all trips in the database.
     """
-    conn = connect_db()
-    cursor = conn.execute('SELECT * FROM trips')
-    trips = cursor.fetchall()
-    conn.close()
-    return [
-        Trip(id=row[0], title=row[1], start_date=row[2], end_date=row[3])
-        for row in trips
-    ]
+    with transaction() as conn:
+        return _select(conn, Trip, 'FROM trips').fetchall()
 
 
+@instrumented
+@cached_read(lambda *args, **kwargs: TRIP_LIST,
+             related=lambda trips: [trip.id for trip in trips if isinstance(trip, TripSummary)])
+def list_trips(after=None, limit=50, filter=None, archived=False, with_totals=False):
+    """
+    Retrieve one page of trips ordered by start date, using keyset pagination.
+
+    Args:
+        after (tuple): The (start_date, id) of the last trip on the previous page, or None for the first page.
+        limit (int): The maximum number of trips to return.
+        filter (str): Only return trips whose title contains this text, ignoring case.
+        archived (bool): List the archived trips instead of the active ones.
+        with_totals (bool): Join each trip's total spend from the trip_totals rollup into the same query.
+
+    Returns:
+        list: A list of Trip objects, or of TripSummary objects with ``with_totals``. Pass
+            ``(trips[-1].start_date, trips[-1].id)`` as ``after`` to get the next page.
+    """
+    conditions = ['archived = ?']
+    params = [int(archived)]
+    if after is not None:
+        conditions.append('(start_day, id) > (?, ?)')
+        params.extend((to_day(after[0]), after[1]))
+    if filter:
+        conditions.append("title LIKE ? ESCAPE '\\'")
+        escaped = filter.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params.append(f'%{escaped}%')
+    record_type, source = Trip, 'trips'
+    if with_totals:
+        record_type, source = TripSummary, 'trips LEFT JOIN trip_totals ON trip_totals.trip_id = trips.id'
+    with transaction() as conn:
+        return _select(conn, record_type, f'FROM {source} WHERE {" AND ".join(conditions)} '
+                       'ORDER BY start_day, id LIMIT ?', params + [limit]).fetchall()
+
+
+@instrumented
+@cached_read(lambda trip_id, *_: trip_id)
 def get_trip_by_id(trip_id):
     """
     Retrieve a specific trip from the database by its ID.
@@ -101,15 +104,37 @@ def get_trip_by_id(trip_id):
     Returns:
         Trip: A Trip object representing the requested trip, or None if not found.
     """
-    conn = connect_db()
-    cursor = conn.execute('SELECT * FROM trips WHERE id = ?', (trip_id,))
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        return Trip(id=row[0], title=row[1], start_date=row[2], end_date=row[3])
-    return None
+    with transaction() as conn:
+        return _select(conn, Trip, 'FROM trips WHERE id = ?', (trip_id,)).fetchone()
+
+
+@instrumented
+@cached_read(lambda *args, **kwargs: TRIP_LIST)
+def find_overlapping_trips(start_date, end_date, exclude_trip_id=None):
+    """
+    Retrieve the trips that aren't archived and share at least one day with a date range.
+
+    No trip starting before the range minus the length of the longest trip can reach it, so only that
+    stretch of the start date index is scanned rather than every trip.
+
+    Args:
+        start_date (datetime.date or str): The first day of the range.
+        end_date (datetime.date or str): The last day of the range (inclusive).
+        exclude_trip_id (int): A trip to leave out, e.g. the one being checked, or None.
+
+    Returns:
+        list: A list of Trip objects ordered by start date.
+    """
+    start_day = to_day(start_date)
+    end_day = to_day(end_date)
+    with transaction() as conn:
+        return _select(conn, Trip, 'FROM trips WHERE archived = 0 AND start_day BETWEEN '
+                       '? - (SELECT MAX(end_day - start_day) FROM trips WHERE archived = 0) AND ? '
+                       'AND end_day >= ? AND id IS NOT ? ORDER BY start_day, id',
+                       (start_day, end_day, start_day, exclude_trip_id)).fetchall()
 
 
+@instrumented
 def add_flight_to_trip(trip_id, cost, seat, airline, flight_number, confirmation):
     """
     Add flight details to a specific trip.
@@ -122,15 +147,14 @@ def add_flight_to_trip(trip_id, cost, seat, airline, flight_number, confirmation
         flight_number (str): The flight number.
         confirmation (str): The confirmation number for the flight.
     """
-    conn = connect_db()
-    conn.execute('''
+    write_queue.run(_execute, '''
         INSERT INTO flights (trip_id, cost, seat, airline, flight_number, confirmation) 
         VALUES (?, ?, ?, ?, ?, ?)
     ''', (trip_id, cost, seat, airline, flight_number, confirmation))
-    conn.commit()
-    conn.close()
+    read_cache.invalidate(trip_id)
 
 
+@instrumented
 def add_hotel_to_trip(trip_id, cost, name, address, rooms, confirmation):
     """
     Add hotel details to a specific trip.
@@ -143,15 +167,14 @@ def add_hotel_to_trip(trip_id, cost, name, address, rooms, confirmation):
         rooms (int): The number of rooms booked.
         confirmation (str): The confirmation number for the hotel.
     """
-    conn = connect_db()
-    conn.execute('''
+    write_queue.run(_execute, '''
         INSERT INTO hotels (trip_id, cost, name, address, rooms, confirmation) 
         VALUES (?, ?, ?, ?, ?, ?)
     ''', (trip_id, cost, name, address, rooms, confirmation))
-    conn.commit()
-    conn.close()
+    read_cache.invalidate(trip_id)
 
 
+@instrumented
 def add_activity_to_day(trip_id, date, name, time, cost, file_path, address, confirmation):
     """
     Add an activity to a specific day of a trip.
@@ -160,20 +183,21 @@ def add_activity_to_day(trip_id, date, name, time, cost, file_path, address, con
         trip_id (int): The ID of the trip to add the activity to.
         date (str): The date of the activity in 'YYYY-MM-DD' format.
         name (str): The name of the activity.
-        time (str): The time of the activity.
+        time (str or datetime.time): The time of the activity, as a string in 'HH:MM AM' format, or None.
         cost (float): The cost of the activity.
         file_path (str): The file path associated with the activity (if any).
         address (str): The address of the activity.
         confirmation (str): The confirmation number for the activity.
     """
-    conn = connect_db()
-    conn.execute(
-        'INSERT INTO activities (trip_id, date, name, time, cost, file_path, address, confirmation) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-        (trip_id, date, name, time, cost, file_path, address, confirmation))
-    conn.commit()
-    conn.close()
+    write_queue.run(
+        _execute,
+        'INSERT INTO activities (trip_id, day, name, minute, cost, file_path, address, confirmation) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (trip_id, to_day(date), name, to_minute(time), cost, file_path, address, confirmation))
+    read_cache.invalidate(trip_id)
 
 
+@instrumented
+@cached_read(lambda trip_id, *_: trip_id)
 def get_itinerary_for_trip(trip_id, date):
     """
     Retrieve the itinerary for a specific trip and date.
@@ -183,18 +207,95 @@ def get_itinerary_for_trip(trip_id, date):
         date (str): The date to retrieve activities for, in 'YYYY-MM-DD' format.
 
     Returns:
-        list: A list of dictionaries containing activity details for the specified trip and date.
+        list: A list of Activity objects for the specified trip and date, ordered by time. Activities without
+            a time come last.
     """
-    conn = connect_db()
-    cursor = conn.execute('SELECT * FROM activities WHERE trip_id = ? AND date = ?', (trip_id, date))
-    activities = cursor.fetchall()
-    conn.close()
-    return [
-        {'name': row[3], 'time': row[4], 'cost': row[5], 'file_path': row[6], 'address': row[7], 'confirmation': row[8]}
-        for row in activities
-    ]
+    with transaction() as conn:
+        return _select(conn, Activity, 'FROM activities WHERE trip_id = ? AND day = ? '
+                       'ORDER BY minute IS NULL, minute',
+                       (trip_id, to_day(date))).fetchall()
 
 
+@instrumented
+@cached_read(lambda trip_id, *_: trip_id)
+def get_itinerary_range(trip_id, start_date, end_date):
+    """
+    Retrieve the itinerary for a range of days of a trip in a single query.
+
+    Args:
+        trip_id (int): The ID of the trip.
+        start_date (str): The first date of the range, in 'YYYY-MM-DD' format.
+        end_date (str): The last date of the range (inclusive), in 'YYYY-MM-DD' format.
+
+    Returns:
+        dict: A dictionary mapping 'YYYY-MM-DD' dates to lists of Activity objects ordered by time.
+            Days without activities are omitted.
+    """
+    start_day = to_day(start_date)
+    end_day = to_day(end_date)
+    generation = read_cache.generation()
+    with transaction() as conn:
+        activities = _select(conn, Activity, 'FROM activities WHERE trip_id = ? AND day BETWEEN ? AND ? '
+                             'ORDER BY day, minute IS NULL, minute', (trip_id, start_day, end_day)).fetchall()
+
+    itinerary = {}
+    for activity in activities:
+        itinerary.setdefault(activity.date, []).append(activity)
+    if not connection.in_transaction():
+        read_cache.put_many(_itinerary_day_entries(trip_id, start_day, end_day, itinerary), trip_id, generation)
+    return itinerary
+
+
+@instrumented
+@cached_read(lambda trip_id, *_: trip_id)
+def find_overlapping_activities(trip_id, date, time, minutes):
+    """
+    Retrieve the timed activities of a trip's day that start less than a number of minutes from a time.
+
+    Args:
+        trip_id (int): The ID of the trip.
+        date (str): The date in 'YYYY-MM-DD' format.
+        time (str or datetime.time): The time, as a string in 'HH:MM AM' format, or None.
+        minutes (int): How far before or after the time an activity may start without overlapping it.
+
+    Returns:
+        list: A list of Activity objects ordered by time. Empty if no time was given.
+    """
+    minute = to_minute(time)
+    if minute is None:
+        return []
+    with transaction() as conn:
+        return _select(conn, Activity, 'FROM activities WHERE trip_id = ? AND day = ? AND (minute IS NULL) = 0 '
+                       'AND minute > ? AND minute < ? ORDER BY minute',
+                       (trip_id, to_day(date), minute - minutes, minute + minutes)).fetchall()
+
+
+@instrumented
+@cached_read(lambda trip_id, *_: trip_id)
+def get_activity_days_outside_trip(trip_id):
+    """
+    Retrieve the days holding activities of a trip that fall before its start or after its end.
+
+    Only the activities outside the trip's dates are read, one index range on each side.
+
+    Args:
+        trip_id (int): The ID of the trip.
+
+    Returns:
+        list: 'YYYY-MM-DD' dates in order.
+    """
+    with transaction() as conn:
+        rows = conn.execute('''
+            SELECT day FROM activities WHERE trip_id = ?1 AND day < (SELECT start_day FROM trips WHERE id = ?1)
+            UNION
+            SELECT day FROM activities WHERE trip_id = ?1 AND day > (SELECT end_day FROM trips WHERE id = ?1)
+            ORDER BY day
+        ''', (trip_id,)).fetchall()
+    return [from_day(day).isoformat() for day, in rows]
+
+
+@instrumented
+@cached_read(lambda trip_id, *_: trip_id)
 def get_flights_for_trip(trip_id):
     """
     Retrieve all flights for a specific trip.
@@ -203,18 +304,14 @@ def get_flights_for_trip(trip_id):
         trip_id (int): The ID of the trip.
 
     Returns:
-        list: A list of dictionaries containing flight details for the specified trip.
+        list: A list of Flight objects for the specified trip.
     """
-    conn = connect_db()
-    cursor = conn.execute('SELECT * FROM flights WHERE trip_id = ?', (trip_id,))
-    flights = cursor.fetchall()
-    conn.close()
-    return [
-        {'cost': row[2], 'seat': row[3], 'airline': row[4], 'flight_number': row[5], 'confirmation': row[6]}
-        for row in flights
-    ]
+    with transaction() as conn:
+        return _select(conn, Flight, 'FROM flights WHERE trip_id = ? ORDER BY id', (trip_id,)).fetchall()
 
 
+@instrumented
+@cached_read(lambda trip_id, *_: trip_id)
 def get_hotels_for_trip(trip_id):
     """
     Retrieve all hotels for a specific trip.
@@ -223,35 +320,362 @@ def get_hotels_for_trip(trip_id):
         trip_id (int): The ID of the trip.
 
     Returns:
-        list: A list of dictionaries containing hotel details for the specified trip.
+        list: A list of Hotel objects for the specified trip.
     """
-    conn = connect_db()
-    cursor = conn.execute('SELECT * FROM hotels WHERE trip_id = ?', (trip_id,))
-    hotels = cursor.fetchall()
-    conn.close()
+    with transaction() as conn:
+        return _select(conn, Hotel, 'FROM hotels WHERE trip_id = ? ORDER BY id', (trip_id,)).fetchall()
+
+
+@instrumented
+@cached_read(lambda trip_id, *_: trip_id)
+def get_trip_totals(trip_id):
+    """
+    Retrieve a trip's spending from the trip_totals and trip_day_totals rollups.
+
+    Args:
+        trip_id (int): The ID of the trip.
+
+    Returns:
+        dict: The keys 'activities', 'flights' and 'hotels' hold the cost of each kind of booking,
+            'total' their sum, and 'days' maps each 'YYYY-MM-DD' date with activities to their cost.
+    """
+    with transaction() as conn:
+        row = conn.execute('SELECT activities, flights, hotels FROM trip_totals WHERE trip_id = ?',
+                           (trip_id,)).fetchone()
+        days = conn.execute(f"SELECT {DATE_SQL.format('day')}, activities FROM trip_day_totals WHERE trip_id = ?",
+                            (trip_id,)).fetchall()
+    activities, flights, hotels = (round(cost, 2) for cost in row) if row else (0.0, 0.0, 0.0)
+    return {
+        'activities': activities,
+        'flights': flights,
+        'hotels': hotels,
+        'total': round(activities + flights + hotels, 2),
+        'days': {date: round(cost, 2) for date, cost in days},
+    }
+
+
+@instrumented
+def get_trip_version(trip_id):
+    """
+    Retrieve the version of a trip, which changes whenever the trip or any of its bookings change.
+
+    Read the version before the data it describes: a write landing in between then only makes the
+    version look older than the data, never newer.
+
+    Args:
+        trip_id (int): The ID of the trip, or TRIP_LIST for the list of trips.
+
+    Returns:
+        tuple: The trip's (seq, revision) in trip_versions, or None if it has never been written.
+    """
+    with transaction() as conn:
+        return conn.execute('SELECT seq, revision FROM trip_versions WHERE trip_id = ?', (trip_id,)).fetchone()
+
+
+@instrumented
+@cached_read(lambda trip_id, *_: trip_id)
+def load_trip_bundle(trip_id):
+    """
+    Retrieve a trip together with its flights, hotels and full itinerary in one transaction.
+
+    The number of queries is fixed regardless of how many days the trip spans.
+
+    Args:
+        trip_id (int): The ID of the trip.
+
+    Returns:
+        dict: A dictionary with the keys 'trip' (Trip), 'flights' (list of Flight), 'hotels' (list of Hotel)
+            and 'itinerary' (dict mapping 'YYYY-MM-DD' dates to lists of Activity objects),
+            or None if the trip is not found.
+    """
+    generation = read_cache.generation()
+    with transaction() as conn:
+        trip = _select(conn, Trip, 'FROM trips WHERE id = ?', (trip_id,)).fetchone()
+        if trip is None:
+            return None
+        flights = _select(conn, Flight, 'FROM flights WHERE trip_id = ? ORDER BY id', (trip_id,)).fetchall()
+        hotels = _select(conn, Hotel, 'FROM hotels WHERE trip_id = ? ORDER BY id', (trip_id,)).fetchall()
+        activities = _select(conn, Activity, 'FROM activities WHERE trip_id = ? '
+                             'ORDER BY day, minute IS NULL, minute', (trip_id,)).fetchall()
+
+    itinerary = {}
+    for activity in activities:
+        itinerary.setdefault(activity.date, []).append(activity)
+    bundle = {
+        'trip': trip,
+        'flights': flights,
+        'hotels': hotels,
+        'itinerary': itinerary,
+    }
+    if not connection.in_transaction():
+        _prime_trip_reads(trip_id, bundle, generation)
+    return bundle
+
+
+def _prime_trip_reads(trip_id, bundle, generation):
+    """
+    Seed the read cache with the per-section reads contained in a trip bundle.
+
+    This lets the trip detail page fragments call get_flights_for_trip, get_hotels_for_trip and
+    get_itinerary_for_trip per day without extra queries after the bundle has been loaded.
+    """
+    trip = bundle['trip']
+    entries = {
+        ('get_trip_by_id', trip_id): trip,
+        ('get_flights_for_trip', trip_id): bundle['flights'],
+        ('get_hotels_for_trip', trip_id): bundle['hotels'],
+    }
+    entries.update(_itinerary_day_entries(trip_id, trip.start_day, trip.end_day, bundle['itinerary']))
+    read_cache.put_many(entries, trip_id, generation)
+
+
+def _itinerary_day_entries(trip_id, start_day, end_day, itinerary):
+    """
+    Build get_itinerary_for_trip cache entries for every day between two day numbers, inclusive.
+    """
+    entries = {}
+    for day in range(start_day, end_day + 1):
+        date = from_day(day).isoformat()
+        entries[('get_itinerary_for_trip', trip_id, date)] = itinerary.get(date, [])
+    return entries
+
+
+@instrumented
+def search(query, limit=20):
+    """
+    Search trip titles and activity, flight and hotel names, addresses and confirmation numbers.
+
+    Every word in the query must match, and each word also matches as a prefix.
+
+    Args:
+        query (str): The text to search for.
+        limit (int): The maximum number of results to return.
+
+    Returns:
+        list: A list of dictionaries with the keys 'kind' ('trip', 'activity', 'flight' or 'hotel'),
+            'trip_id', 'trip_title', 'title', 'detail' and 'confirmation', best matches first.
+    """
+    terms = ' '.join('"{}"*'.format(word.replace('"', '""')) for word in query.split())
+    if not terms:
+        return []
+    with transaction() as conn:
+        cursor = conn.execute('''
+            SELECT search_index.kind, search_index.trip_id, trips.title, search_index.title,
+                   search_index.detail, search_index.confirmation
+            FROM search_index JOIN trips ON trips.id = search_index.trip_id
+            WHERE search_index MATCH ?
+            ORDER BY search_index.rank
+            LIMIT ?
+        ''', (terms, limit))
+        results = cursor.fetchall()
     return [
-        {'cost': row[2], 'name': row[3], 'address': row[4], 'rooms': row[5], 'confirmation': row[6]}
-        for row in hotels
+        {'kind': row[0], 'trip_id': row[1], 'trip_title': row[2], 'title': row[3], 'detail': row[4],
+         'confirmation': row[5]}
+        for row in results
     ]
 
 
+@instrumented
 def delete_trip(trip_id):
     """
     Delete a trip and all its associated activities from the database.
 
+    Activities, flights and hotels are removed by the ON DELETE CASCADE foreign keys. The deleted rows
+    are kept in trip_journal, from which backup.restore_trip can put the trip back.
+
     Args:
         trip_id (int): The ID of the trip to delete.
     """
-    conn = connect_db()
-    conn.execute('DELETE FROM activities WHERE trip_id = ?', (trip_id,))
-    conn.execute('DELETE FROM flights WHERE trip_id = ?', (trip_id,))
-    conn.execute('DELETE FROM hotels WHERE trip_id = ?', (trip_id,))
-    conn.execute('DELETE FROM trips WHERE id = ?', (trip_id,))
-    conn.commit()
-    conn.close()
+    write_queue.run(_execute, 'DELETE FROM trips WHERE id = ?', (trip_id,))
+    read_cache.invalidate(trip_id, TRIP_LIST)
+
+
+@instrumented
+def clone_trip(trip_id, new_start_date, title=None):
+    """
+    Copy a trip with all its activities, flights and hotels, moved to start on another date.
 
+    Each table is copied with one INSERT ... SELECT, all in one transaction. Activities keep their
+    offset from the start of the trip.
 
-class Trip:
+    Args:
+        trip_id (int): The ID of the trip to copy.
+        new_start_date (datetime.date): The start date of the copy, or None to keep the original dates.
+        title (str): The title of the copy. Defaults to the title of the original.
+
+    Returns:
+        int: The ID of the new trip, or None if the trip is not found.
+
+    Raises:
+        ValueError: If a new start date is given for a trip without a start date.
+    """
+    start_day = None if new_start_date is None else to_day(new_start_date)
+    new_trip_id = write_queue.run(_clone_trip, trip_id, start_day, title)
+    if new_trip_id is not None:
+        read_cache.invalidate(new_trip_id, TRIP_LIST)
+    return new_trip_id
+
+
+@instrumented
+def delete_trips(trip_ids):
+    """
+    Delete several trips and all their bookings with one statement.
+
+    Args:
+        trip_ids (list): The IDs of the trips to delete.
+
+    Returns:
+        int: The number of trips deleted.
+    """
+    trip_ids = [int(trip_id) for trip_id in trip_ids]
+    if not trip_ids:
+        return 0
+    deleted = write_queue.run(_execute_rowcount,
+                              f'DELETE FROM trips WHERE id IN ({", ".join("?" * len(trip_ids))})', trip_ids)
+    read_cache.invalidate(*trip_ids, TRIP_LIST)
+    return deleted
+
+
+@instrumented
+def archive_trips(trip_ids, archived=True):
+    """
+    Archive several trips with one statement, or restore them. Archived trips are left out of
+    ``list_trips`` unless it is asked for them.
+
+    Args:
+        trip_ids (list): The IDs of the trips.
+        archived (bool): False to restore the trips instead.
+
+    Returns:
+        int: The number of trips whose state changed.
+    """
+    trip_ids = [int(trip_id) for trip_id in trip_ids]
+    if not trip_ids:
+        return 0
+    changed = write_queue.run(_execute_rowcount,
+                              f'UPDATE trips SET archived = ? '
+                              f'WHERE archived != ? AND id IN ({", ".join("?" * len(trip_ids))})',
+                              [int(archived), int(archived)] + trip_ids)
+    read_cache.invalidate(*trip_ids, TRIP_LIST)
+    return changed
+
+
+def _clone_trip(conn, trip_id, start_day, title):
+    """
+    Copy a trip and its bookings, shifting every day by the offset to the new start day. Passed to
+    ``write_queue.run``, so the copy commits or rolls back as a whole.
+
+    Returns:
+        int: The ID of the new trip, or None if the trip is not found.
+    """
+    source = conn.execute('SELECT start_day FROM trips WHERE id = ?', (trip_id,)).fetchone()
+    if source is None:
+        return None
+    if start_day is not None and source[0] is None:
+        raise ValueError(f'Trip {trip_id} has no start date to move from')
+    offset = 0 if start_day is None else start_day - source[0]
+    new_trip_id = conn.execute('''
+        INSERT INTO trips (title, start_day, end_day)
+        SELECT COALESCE(?, title), start_day + ?, end_day + ? FROM trips WHERE id = ?
+    ''', (title, offset, offset, trip_id)).lastrowid
+    conn.execute('''
+        INSERT INTO activities (trip_id, day, name, minute, cost, file_path, address, confirmation)
+        SELECT ?, day + ?, name, minute, cost, file_path, address, confirmation
+        FROM activities WHERE trip_id = ? ORDER BY id
+    ''', (new_trip_id, offset, trip_id))
+    conn.execute('''
+        INSERT INTO flights (trip_id, cost, seat, airline, flight_number, confirmation)
+        SELECT ?, cost, seat, airline, flight_number, confirmation FROM flights WHERE trip_id = ? ORDER BY id
+    ''', (new_trip_id, trip_id))
+    conn.execute('''
+        INSERT INTO hotels (trip_id, cost, name, address, rooms, confirmation)
+        SELECT ?, cost, name, address, rooms, confirmation FROM hotels WHERE trip_id = ? ORDER BY id
+    ''', (new_trip_id, trip_id))
+    return new_trip_id
+
+
+def _execute(conn, sql, params):
+    """
+    Run one write statement. Passed to ``write_queue.run``, which calls it on the writer's connection.
+
+    Returns:
+        int: The row ID of the last inserted row.
+    """
+    return conn.execute(sql, params).lastrowid
+
+
+def _execute_rowcount(conn, sql, params):
+    """
+    Run one write statement, like ``_execute``.
+
+    Returns:
+        int: The number of rows the statement changed.
+    """
+    return conn.execute(sql, params).rowcount
+
+
+def _select(conn, record_type, clause, params=()):
+    """
+    Run a SELECT of a record type's columns and return a cursor that yields instances of that type.
+
+    Args:
+        conn (sqlite3.Connection): The connection to query.
+        record_type (type): A Record subclass.
+        clause (str): The rest of the query after the column list, starting with FROM.
+        params (tuple): The query parameters.
+
+    Returns:
+        sqlite3.Cursor: A cursor whose rows are built by ``record_type.from_row``.
+    """
+    cursor = conn.cursor()
+    cursor.row_factory = record_type.from_row
+    return cursor.execute(f'SELECT {record_type.SELECT} {clause}', params)
+
+
+class Record:
+    """
+    Base class of the rows returned by the readers in this module.
+
+    Subclasses declare their fields in ``__slots__``, so instances carry no per-instance ``__dict__``,
+    and list the SQL expression selected for each field, in the same order, in COLUMNS. Queries name
+    their columns explicitly through SELECT instead of relying on the table's column order. A subclass
+    of a record type only declares the fields it adds; FIELDS lists them all.
+
+    Fields can also be read by name, ``record['cost']``, like the dictionaries readers used to return.
+    """
+
+    __slots__ = ()
+    COLUMNS = ()
+    FIELDS = ()
+    SELECT = ''
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.FIELDS = cls.FIELDS + cls.__dict__.get('__slots__', ())
+        cls.SELECT = ', '.join(cls.COLUMNS)
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        """
+        Build a record from a row of its COLUMNS. Used as the ``row_factory`` of reader cursors.
+        """
+        return cls(*row)
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def as_dict(self):
+        """
+        Return the record's fields as a new dictionary, e.g. for JSON encoding.
+        """
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        fields = ', '.join(f'{field}={getattr(self, field)!r}' for field in self.FIELDS)
+        return f'{type(self).__name__}({fields})'
+
+
+class Trip(Record):
     """
     Represents a trip with its associated details.
 
@@ -260,9 +684,16 @@ class Trip:
         title (str): The title of the trip.
         start_date (str): The start date of the trip in 'YYYY-MM-DD' format.
         end_date (str): The end date of the trip in 'YYYY-MM-DD' format.
+        start_day (int): The start date of the trip as a number of days since 1970-01-01.
+        end_day (int): The end date of the trip as a number of days since 1970-01-01.
+        archived (bool): Whether the trip is archived, and so left out of the trip list.
     """
 
-    def __init__(self, id, title, start_date, end_date):
+    __slots__ = ('id', 'title', 'start_date', 'end_date', 'start_day', 'end_day', 'archived')
+    COLUMNS = ('id', 'title', DATE_SQL.format('start_day'), DATE_SQL.format('end_day'), 'start_day', 'end_day',
+               'archived')
+
+    def __init__(self, id, title, start_date, end_date, start_day=None, end_day=None, archived=False):
         """
         Initialize a Trip object.
 
@@ -271,8 +702,130 @@ class Trip:
             title (str): The title of the trip.
             start_date (str): The start date of the trip in 'YYYY-MM-DD' format.
             end_date (str): The end date of the trip in 'YYYY-MM-DD' format.
+            start_day (int): The start date as a number of days since 1970-01-01.
+            end_day (int): The end date as a number of days since 1970-01-01.
+            archived (bool): Whether the trip is archived.
         """
         self.id = id
         self.title = title
         self.start_date = start_date
         self.end_date = end_date
+        self.start_day = start_day
+        self.end_day = end_day
+        self.archived = bool(archived)
+
+
+class TripSummary(Trip):
+    """
+    Represents a trip in the trip list, with its total spend.
+
+    Attributes:
+        total (float): The trip's spend on activities, flights and hotels, from the trip_totals rollup.
+    """
+
+    __slots__ = ('total',)
+    COLUMNS = Trip.COLUMNS + ('ROUND(ROUND(COALESCE(trip_totals.activities, 0), 2) + '
+                              'ROUND(COALESCE(trip_totals.flights, 0), 2) + ROUND(COALESCE(trip_totals.hotels, 0), 2), 2)',)
+
+    def __init__(self, id, title, start_date, end_date, start_day, end_day, archived, total):
+        """
+        Initialize a TripSummary object.
+
+        Args:
+            id (int): The unique identifier for the trip.
+            title (str): The title of the trip.
+            start_date (str): The start date of the trip in 'YYYY-MM-DD' format.
+            end_date (str): The end date of the trip in 'YYYY-MM-DD' format.
+            start_day (int): The start date as a number of days since 1970-01-01.
+            end_day (int): The end date as a number of days since 1970-01-01.
+            archived (bool): Whether the trip is archived.
+            total (float): The trip's total spend.
+        """
+        super().__init__(id, title, start_date, end_date, start_day, end_day, archived)
+        self.total = total
+
+
+class Activity(Record):
+    """
+    Represents an activity on one day of a trip.
+
+    Attributes:
+        id (int): The unique identifier for the activity.
+        trip_id (int): The ID of the trip the activity belongs to.
+        date (str): The date of the activity in 'YYYY-MM-DD' format.
+        name (str): The name of the activity.
+        time (str): The time of the activity in 'HH:MM AM' format, or None.
+        cost (float): The cost of the activity.
+        file_path (str): The file path associated with the activity (if any).
+        address (str): The address of the activity.
+        confirmation (str): The confirmation number for the activity.
+    """
+
+    __slots__ = ('id', 'trip_id', 'date', 'name', 'time', 'cost', 'file_path', 'address', 'confirmation')
+    COLUMNS = ('id', 'trip_id', DATE_SQL.format('day'), 'name', TIME_SQL.format('minute'), 'cost', 'file_path',
+               'address', 'confirmation')
+
+    def __init__(self, id, trip_id, date, name, time, cost, file_path, address, confirmation):
+        self.id = id
+        self.trip_id = trip_id
+        self.date = date
+        self.name = name
+        self.time = time
+        self.cost = cost
+        self.file_path = file_path
+        self.address = address
+        self.confirmation = confirmation
+
+
+class Flight(Record):
+    """
+    Represents a flight booked for a trip.
+
+    Attributes:
+        id (int): The unique identifier for the flight.
+        trip_id (int): The ID of the trip the flight belongs to.
+        cost (float): The cost of the flight.
+        seat (str): The seat number for the flight.
+        airline (str): The airline name.
+        flight_number (str): The flight number.
+        confirmation (str): The confirmation number for the flight.
+    """
+
+    __slots__ = ('id', 'trip_id', 'cost', 'seat', 'airline', 'flight_number', 'confirmation')
+    COLUMNS = __slots__
+
+    def __init__(self, id, trip_id, cost, seat, airline, flight_number, confirmation):
+        self.id = id
+        self.trip_id = trip_id
+        self.cost = cost
+        self.seat = seat
+        self.airline = airline
+        self.flight_number = flight_number
+        self.confirmation = confirmation
+
+
+class Hotel(Record):
+    """
+    Represents a hotel booked for a trip.
+
+    Attributes:
+        id (int): The unique identifier for the hotel booking.
+        trip_id (int): The ID of the trip the hotel belongs to.
+        cost (float): The cost of the hotel.
+        name (str): The hotel name.
+        address (str): The hotel address.
+        rooms (int): The number of rooms booked.
+        confirmation (str): The confirmation number for the hotel.
+    """
+
+    __slots__ = ('id', 'trip_id', 'cost', 'name', 'address', 'rooms', 'confirmation')
+    COLUMNS = __slots__
+
+    def __init__(self, id, trip_id, cost, name, address, rooms, confirmation):
+        self.id = id
+        self.trip_id = trip_id
+        self.cost = cost
+        self.name = name
+        self.address = address
+        self.rooms = rooms
+        self.confirmation = confirmation
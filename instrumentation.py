@@ -0,0 +1,435 @@
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import connection
+
+logger = logging.getLogger(__name__)
+
+# Statements running at least this many milliseconds are logged together with their query plan.
+SLOW_QUERY_MS = float(os.environ.get('TRIPS_SLOW_QUERY_MS', 100))
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Number of slow statements kept for ``slow_queries``.
+SLOW_LOG_SIZE = 50
+
+# Name statements are recorded under when they don't run inside an instrumented db.py call.
+OTHER = '(other)'
+
+# Statements that only manage transactions or connections. They are not counted as queries.
+_CONTROL = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE', 'PRAGMA')
+
+_enabled = False
+_lock = threading.Lock()
+_calls = {}
+_statements = {}
+_rows = {}
+_slow_count = 0
+_slow_log = deque(maxlen=SLOW_LOG_SIZE)
+_unexplained = deque()
+_local = threading.local()
+# The (function name, Rerun) of the db.py call running in the current context. The write queue runs
+# each write in its submitter's context, so statements on the writer thread count for that call.
+_current_call = contextvars.ContextVar('current_call', default=None)
+_current_rerun = contextvars.ContextVar('current_rerun', default=None)
+
+
+class Histogram:
+    """
+    Counts of observed durations in the fixed BUCKETS, plus their sum.
+
+    Attributes:
+        counts (list): The number of observations per bucket; the last one counts those above every bound.
+        total (float): The sum of all observations, in seconds.
+        count (int): The number of observations.
+    """
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        """
+        Initialize an empty Histogram object.
+        """
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        """
+        Add one observation.
+
+        Args:
+            seconds (float): The observed duration.
+        """
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, fraction):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in.
+
+        Args:
+            fraction (float): The quantile, e.g. 0.99.
+
+        Returns:
+            float: The estimate in seconds, or 0.0 without observations.
+        """
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= fraction * self.count:
+                return BUCKETS[min(index, len(BUCKETS) - 1)]
+        return 0.0
+
+
+class Rerun:
+    """
+    Statistics of the instrumented db.py calls made during one Streamlit script run.
+
+    Attributes:
+        calls (int): The number of db.py calls, including those answered from the read cache.
+        queries (int): The number of SQL statements they ran.
+        rows (int): The number of records they returned.
+        seconds (float): The time spent in those calls.
+        functions (dict): Maps each db.py function name to its [calls, queries, rows, seconds].
+    """
+
+    __slots__ = ('calls', 'queries', 'rows', 'seconds', 'functions')
+
+    def __init__(self):
+        """
+        Initialize an empty Rerun object.
+        """
+        self.calls = 0
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.functions = {}
+
+    def _function(self, name):
+        stats = self.functions.get(name)
+        if stats is None:
+            stats = self.functions[name] = [0, 0, 0, 0.0]
+        return stats
+
+
+def enable():
+    """
+    Start recording db.py calls and SQL statements in this process.
+
+    Statement tracing is installed on every connection opened from now on; idle pooled connections
+    are closed so they are reopened with it.
+    """
+    global _enabled
+    connection.on_connect(_install)
+    if not _enabled:
+        _enabled = True
+        connection.close_all()
+
+
+def disable():
+    """
+    Stop recording. Statistics collected so far are kept.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """
+    Return whether db.py calls and SQL statements are being recorded.
+    """
+    return _enabled
+
+
+def reset():
+    """
+    Forget all recorded statistics and slow statements.
+    """
+    global _slow_count
+    with _lock:
+        _calls.clear()
+        _statements.clear()
+        _rows.clear()
+        _slow_log.clear()
+        _unexplained.clear()
+        _slow_count = 0
+
+
+def start_rerun(rerun=None):
+    """
+    Begin collecting the statistics of a script run in the current context.
+
+    Call it at the top of the Streamlit script; every instrumented call made afterwards from this
+    context, including writes applied by the write queue on its behalf, is added to the result.
+
+    Args:
+        rerun (Rerun): Statistics to keep adding to, e.g. those of the widget callbacks that ran before
+            the script, or None to start from zero.
+
+    Returns:
+        Rerun: The statistics of this run, filled in as calls complete.
+    """
+    if rerun is None:
+        rerun = Rerun()
+    _current_rerun.set(rerun)
+    return rerun
+
+
+def instrumented(function):
+    """
+    Decorate a db.py entry point so its latency, the statements it runs and the records it returns are
+    recorded while instrumentation is enabled. Apply it outside ``cached_read``, so cache hits count too.
+
+    Args:
+        function (callable): The function to wrap.
+
+    Returns:
+        callable: The wrapper.
+    """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        call = (name, _current_rerun.get())
+        token = _current_call.set(call)
+        result = None
+        started = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+            return result
+        finally:
+            now = time.perf_counter()
+            _current_call.reset(token)
+            # The last statement of the call has run once the call returns, including fetching its rows.
+            pending = getattr(_local, 'statement', None)
+            if pending is not None and pending[0] is call:
+                _local.statement = None
+                _finish(pending, now)
+            _record_call(call, now - started, _count_rows(result))
+            if _unexplained:
+                _explain_pending()
+    return wrapper
+
+
+def _install(conn):
+    conn.set_trace_callback(_on_statement)
+
+
+def _on_statement(sql):
+    """
+    Trace callback run as each statement starts. A statement's duration is measured up to the next
+    statement on the same thread or the end of the db.py call running it, so it includes fetching its rows.
+    """
+    # Trigger bodies are reported as comments; their time counts towards the statement firing them.
+    if not _enabled or sql.startswith('--'):
+        return
+    now = time.perf_counter()
+    pending = getattr(_local, 'statement', None)
+    if pending is not None:
+        _finish(pending, now)
+    if sql.lstrip()[:9].upper().startswith(_CONTROL):
+        _local.statement = None
+    else:
+        _local.statement = (_current_call.get(), sql, now)
+
+
+def _finish(statement, now):
+    """
+    Record a completed statement.
+    """
+    global _slow_count
+    call, sql, started = statement
+    name, rerun = call or (OTHER, None)
+    seconds = now - started
+    slow = seconds * 1000 >= SLOW_QUERY_MS
+    with _lock:
+        histogram = _statements.get(name)
+        if histogram is None:
+            histogram = _statements[name] = Histogram()
+        histogram.observe(seconds)
+        if slow:
+            _slow_count += 1
+    if rerun is not None:
+        rerun.queries += 1
+        rerun._function(name)[1] += 1
+    if slow:
+        _unexplained.append((name, sql, seconds * 1000))
+
+
+def _record_call(call, seconds, rows):
+    """
+    Record a completed db.py call.
+    """
+    name, rerun = call
+    with _lock:
+        histogram = _calls.get(name)
+        if histogram is None:
+            histogram = _calls[name] = Histogram()
+        histogram.observe(seconds)
+        _rows[name] = _rows.get(name, 0) + rows
+    if rerun is not None:
+        rerun.calls += 1
+        rerun.rows += rows
+        rerun.seconds += seconds
+        stats = rerun._function(name)
+        stats[0] += 1
+        stats[2] += rows
+        stats[3] += seconds
+
+
+def _count_rows(result):
+    """
+    Count the records in a db.py result: the items of lists, including lists nested one or two dictionaries
+    deep such as a bundle's itinerary, and single records. Numbers and strings don't count.
+    """
+    if type(result) is list:
+        return len(result)
+    if type(result) is not dict:
+        return 0 if result is None or isinstance(result, (int, float, str)) else 1
+    rows = 0
+    for value in result.values():
+        if type(value) is list:
+            rows += len(value)
+        elif type(value) is dict:
+            for item in value.values():
+                if type(item) is list:
+                    rows += len(item)
+        elif value is not None and not isinstance(value, (int, float, str)):
+            rows += 1
+    return rows
+
+
+def explain(sql):
+    """
+    Return the query plan of a statement, read on a separate connection.
+
+    Args:
+        sql (str): The statement, with its parameters filled in as reported by the trace callback.
+
+    Returns:
+        list: One line per plan step, or a single line saying why no plan is available.
+    """
+    database, uri = connection.database_target()
+    conn = sqlite3.connect(database, uri=uri, timeout=1)
+    try:
+        return [detail for _, _, _, detail in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+    except sqlite3.Error as error:
+        return [f'No query plan: {error}']
+    finally:
+        conn.close()
+
+
+def _explain_pending():
+    """
+    Look up the query plans of newly recorded slow statements and log them.
+
+    Runs at the end of an instrumented call rather than in the trace callback, where the connection
+    is in the middle of running a statement.
+    """
+    while True:
+        try:
+            name, sql, milliseconds = _unexplained.popleft()
+        except IndexError:
+            return
+        plan = explain(sql)
+        _slow_log.append({'function': name, 'sql': sql, 'ms': milliseconds, 'plan': plan})
+        logger.warning('Slow statement in %s took %.1f ms: %s\nQuery plan:\n  %s', name, milliseconds,
+                       ' '.join(sql.split()), '\n  '.join(plan))
+
+
+def slow_queries():
+    """
+    Return the most recent slow statements, oldest first.
+
+    Returns:
+        list: Dictionaries with the keys 'function' (the db.py call that ran it), 'sql', 'ms' and 'plan'.
+    """
+    _explain_pending()
+    return list(_slow_log)
+
+
+def query_count():
+    """
+    Return the number of SQL statements recorded so far, excluding transaction control.
+    """
+    with _lock:
+        return sum(histogram.count for histogram in _statements.values())
+
+
+def summary():
+    """
+    Summarize the recorded db.py calls.
+
+    Returns:
+        list: One dictionary per function, slowest total first, with the keys 'function', 'calls',
+            'p50_ms' and 'p99_ms' (bucket upper bounds), 'mean_ms', 'queries_per_call' and 'rows_per_call'.
+    """
+    with _lock:
+        rows = []
+        for name, histogram in _calls.items():
+            statements = _statements.get(name)
+            rows.append({
+                'function': name,
+                'calls': histogram.count,
+                'p50_ms': histogram.quantile(0.5) * 1000,
+                'p99_ms': histogram.quantile(0.99) * 1000,
+                'mean_ms': histogram.total / histogram.count * 1000,
+                'queries_per_call': (statements.count if statements else 0) / histogram.count,
+                'rows_per_call': _rows.get(name, 0) / histogram.count,
+                'total': histogram.total,
+            })
+    rows.sort(key=lambda row: row.pop('total'), reverse=True)
+    return rows
+
+
+def _histogram_lines(metric, label, histograms):
+    lines = []
+    for name, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.total}')
+        lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+    return lines
+
+
+def metrics_text():
+    """
+    Render the recorded statistics in the Prometheus text exposition format.
+
+    Returns:
+        str: The metrics, ending with a newline.
+    """
+    with _lock:
+        lines = [
+            '# HELP trips_db_call_duration_seconds Latency of db.py calls, including read cache hits.',
+            '# TYPE trips_db_call_duration_seconds histogram',
+            *_histogram_lines('trips_db_call_duration_seconds', 'function', _calls),
+            '# HELP trips_db_call_rows_total Records returned by db.py calls.',
+            '# TYPE trips_db_call_rows_total counter',
+            *(f'trips_db_call_rows_total{{function="{name}"}} {rows}' for name, rows in sorted(_rows.items())),
+            '# HELP trips_db_statement_duration_seconds Latency of SQL statements by the db.py call running them.',
+            '# TYPE trips_db_statement_duration_seconds histogram',
+            *_histogram_lines('trips_db_statement_duration_seconds', 'function', _statements),
+            f'# HELP trips_db_slow_statements_total Statements taking at least {SLOW_QUERY_MS:g} ms.',
+            '# TYPE trips_db_slow_statements_total counter',
+            f'trips_db_slow_statements_total {_slow_count}',
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+if os.environ.get('TRIPS_INSTRUMENT'):
+    enable()
@@ -0,0 +1,119 @@
+import argparse
+import gzip
+import http.client
+import json
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(samples, fraction):
+    """
+    Return the value below which the given fraction of sorted samples fall.
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def _client(url, paths, count, use_etags, use_gzip, latencies, errors):
+    """
+    Send requests over one keep-alive connection, cycling through the paths, and record their latency.
+    """
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+    etags = {}
+    for index in range(count):
+        path = paths[index % len(paths)]
+        headers = {'Accept-Encoding': 'gzip'} if use_gzip else {}
+        if use_etags and path in etags:
+            headers['If-None-Match'] = etags[path]
+        started = time.perf_counter()
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            errors.append(path)
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+            continue
+        latencies.append(time.perf_counter() - started)
+        if response.status >= 400:
+            errors.append(path)
+        elif response.getheader('ETag'):
+            etags[path] = response.getheader('ETag')
+        if response.getheader('Content-Encoding') == 'gzip':
+            gzip.decompress(body)
+    conn.close()
+
+
+def run(url, paths, clients, requests, use_etags=False, use_gzip=True):
+    """
+    Load an API server with concurrent keep-alive clients.
+
+    Args:
+        url (str): The base URL of the server, e.g. 'http://127.0.0.1:8000'.
+        paths (list): The paths to request, cycled through by every client.
+        clients (int): The number of concurrent clients, one connection each.
+        requests (int): The total number of requests to send.
+        use_etags (bool): Revalidate with If-None-Match after the first response for each path.
+        use_gzip (bool): Accept gzip responses.
+
+    Returns:
+        dict: The keys 'requests', 'errors', 'seconds', 'per_second', 'p50_ms' and 'p99_ms'.
+    """
+    latencies = []
+    errors = []
+    per_client = max(1, requests // clients)
+    threads = [threading.Thread(target=_client, args=(url, paths, per_client, use_etags, use_gzip, latencies, errors))
+               for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'seconds': seconds,
+        'per_second': len(latencies) / seconds,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main(argv=None):
+    """
+    Command line entry point: load test a running API server and report throughput and latency.
+    """
+    parser = argparse.ArgumentParser(description='Load test the JSON API started with `python api.py`.')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='server URL (default: %(default)s)')
+    parser.add_argument('--path', action='append',
+                        help='path to request; may be repeated (default: the bundles of the first 20 trips)')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=5000, help='total requests (default: %(default)s)')
+    parser.add_argument('--etags', action='store_true', help='revalidate with If-None-Match')
+    parser.add_argument('--no-gzip', action='store_true', help='do not accept gzip responses')
+    args = parser.parse_args(argv)
+
+    paths = args.path
+    if not paths:
+        parts = urlsplit(args.url)
+        conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+        conn.request('GET', '/trips?limit=20')
+        trips = json.loads(conn.getresponse().read())
+        conn.close()
+        paths = [f'/trips/{trip["id"]}/bundle' for trip in trips] or ['/trips']
+
+    result = run(args.url, paths, args.clients, args.requests, args.etags, not args.no_gzip)
+    print(f'{result["requests"]:,} requests in {result["seconds"]:.2f}s: {result["per_second"]:,.0f} requests/s, '
+          f'p50 {result["p50_ms"]:.1f} ms, p99 {result["p99_ms"]:.1f} ms, {result["errors"]} errors')
+    return 1 if result['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,713 @@
+import re
+
+import dates
+
+
+def _create_tables(conn):
+    """
+    Create the original trips, activities, flights and hotels tables.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS trips (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            start_date TEXT,
+            end_date TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS activities (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id INTEGER,
+            date TEXT,
+            name TEXT,
+            time TEXT,
+            cost REAL,
+            file_path TEXT,
+            address TEXT,
+            confirmation TEXT,
+            FOREIGN KEY (trip_id) REFERENCES trips (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS flights (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id INTEGER,
+            cost REAL,
+            seat TEXT,
+            airline TEXT,
+            flight_number TEXT,
+            confirmation TEXT,
+            FOREIGN KEY (trip_id) REFERENCES trips (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS hotels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id INTEGER,
+            cost REAL,
+            name TEXT,
+            address TEXT,
+            rooms INTEGER,
+            confirmation TEXT,
+            FOREIGN KEY (trip_id) REFERENCES trips (id)
+        )
+    ''')
+
+
+def _cascade_trip_foreign_keys(conn):
+    """
+    Rebuild the activities, flights and hotels tables so their trip_id foreign keys cascade on delete.
+
+    SQLite cannot alter a foreign key in place, so each table is copied into a new definition.
+    Rows that point at a trip which no longer exists are unreachable and are not carried over.
+    """
+    conn.execute('''
+        CREATE TABLE activities_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id INTEGER NOT NULL REFERENCES trips (id) ON DELETE CASCADE,
+            date TEXT,
+            name TEXT,
+            time TEXT,
+            cost REAL,
+            file_path TEXT,
+            address TEXT,
+            confirmation TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE flights_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id INTEGER NOT NULL REFERENCES trips (id) ON DELETE CASCADE,
+            cost REAL,
+            seat TEXT,
+            airline TEXT,
+            flight_number TEXT,
+            confirmation TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE hotels_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id INTEGER NOT NULL REFERENCES trips (id) ON DELETE CASCADE,
+            cost REAL,
+            name TEXT,
+            address TEXT,
+            rooms INTEGER,
+            confirmation TEXT
+        )
+    ''')
+    columns = {
+        'activities': 'id, trip_id, date, name, time, cost, file_path, address, confirmation',
+        'flights': 'id, trip_id, cost, seat, airline, flight_number, confirmation',
+        'hotels': 'id, trip_id, cost, name, address, rooms, confirmation',
+    }
+    for table, column_list in columns.items():
+        conn.execute(f'''
+            INSERT INTO {table}_new ({column_list})
+            SELECT {column_list} FROM {table} WHERE trip_id IN (SELECT id FROM trips)
+        ''')
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    if conn.execute('PRAGMA foreign_key_check').fetchone() is not None:
+        raise RuntimeError('Rebuilding trip foreign keys left dangling references')
+
+
+def _index_trip_lookups(conn):
+    """
+    Index the per-trip lookups used by the itinerary, flight and hotel readers and by cascading deletes.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activities_trip_date_time ON activities (trip_id, date, time)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_flights_trip ON flights (trip_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_hotels_trip ON hotels (trip_id)')
+
+
+def _track_trip_versions(conn):
+    """
+    Record the latest change to each trip in trip_versions so caches in other processes can invalidate it.
+
+    Every insert, update or delete on trips, activities, flights or hotels stamps the affected trip with
+    the next sequence number. Changes to the trips table also stamp the row with trip_id 0, which
+    stands for the list of trips itself.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS trip_versions (
+            trip_id INTEGER PRIMARY KEY,
+            seq INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trip_versions_seq ON trip_versions (seq)')
+    bump = ('INSERT OR REPLACE INTO trip_versions (trip_id, seq) '
+            'VALUES ({trip_id}, (SELECT COALESCE(MAX(seq), 0) + 1 FROM trip_versions));')
+    for table, trip_column in (('trips', 'id'), ('activities', 'trip_id'), ('flights', 'trip_id'),
+                               ('hotels', 'trip_id')):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            statements = bump.format(trip_id=f'{row}.{trip_column}')
+            if table == 'trips':
+                statements += bump.format(trip_id=0)
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version AFTER {event} ON {table}
+                BEGIN {statements} END
+            ''')
+
+
+def _coalesce_trip_version_stamps(conn):
+    """
+    Skip re-stamping a trip in trip_versions when it already holds the latest sequence number.
+
+    Consecutive changes to one trip, such as a batch of activity inserts, then write a single stamp
+    instead of one per row. Readers must treat the trip holding the latest sequence number as
+    changed whenever the database changes, i.e. poll with ``seq >= last_seen`` rather than ``>``.
+    """
+    bump = ('INSERT OR REPLACE INTO trip_versions (trip_id, seq) '
+            'SELECT {trip_id}, (SELECT COALESCE(MAX(seq), 0) + 1 FROM trip_versions) '
+            'WHERE {trip_id} IS NOT (SELECT trip_id FROM trip_versions ORDER BY seq DESC LIMIT 1);')
+    for table, trip_column in (('trips', 'id'), ('activities', 'trip_id'), ('flights', 'trip_id'),
+                               ('hotels', 'trip_id')):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            statements = bump.format(trip_id=f'{row}.{trip_column}')
+            if table == 'trips':
+                statements += bump.format(trip_id=0)
+            conn.execute(f'DROP TRIGGER IF EXISTS {table}_{event.lower()}_version')
+            conn.execute(f'''
+                CREATE TRIGGER {table}_{event.lower()}_version AFTER {event} ON {table}
+                BEGIN {statements} END
+            ''')
+
+
+def _index_trip_start_dates(conn):
+    """
+    Index trips by start date for the keyset-paginated trip list.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trips_start_date_id ON trips (start_date, id)')
+
+
+# Rows indexed for full-text search, per source table: the kind code and name, then SQL expressions for
+# the trip ID and the title, detail and confirmation columns of search_index. {row} stands for the
+# source row (NEW, OLD or the table itself).
+SEARCH_SOURCES = {
+    'trips': (0, 'trip', '{row}.id', '{row}.title', 'NULL', 'NULL'),
+    'activities': (1, 'activity', '{row}.trip_id', '{row}.name', '{row}.address', '{row}.confirmation'),
+    'flights': (2, 'flight', '{row}.trip_id', "{row}.airline || ' ' || {row}.flight_number", 'NULL',
+                '{row}.confirmation'),
+    'hotels': (3, 'hotel', '{row}.trip_id', '{row}.name', '{row}.address', '{row}.confirmation'),
+}
+
+
+def _create_search_index(conn):
+    """
+    Add an FTS5 full-text index over trips, activities, flights and hotels, kept in sync by triggers.
+
+    Each indexed row gets the rowid ``id * 4 + kind code`` so triggers can find it again without
+    scanning the index.
+    """
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            kind UNINDEXED,
+            trip_id UNINDEXED,
+            title,
+            detail,
+            confirmation
+        )
+    ''')
+    for table, (code, kind, *expressions) in SEARCH_SOURCES.items():
+        def values(row):
+            return f"{row}.id * 4 + {code}, '{kind}', " + ', '.join(expressions).format(row=row)
+        insert = 'INSERT INTO search_index (rowid, kind, trip_id, title, detail, confirmation) VALUES ({});'
+        delete = f'DELETE FROM search_index WHERE rowid = OLD.id * 4 + {code};'
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_insert_search AFTER INSERT ON {table}
+            BEGIN {insert.format(values('NEW'))} END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_update_search AFTER UPDATE ON {table}
+            BEGIN {delete} {insert.format(values('NEW'))} END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_delete_search AFTER DELETE ON {table}
+            BEGIN {delete} END
+        ''')
+        conn.execute(f'''
+            INSERT INTO search_index (rowid, kind, trip_id, title, detail, confirmation)
+            SELECT {values(table)} FROM {table}
+        ''')
+
+
+# Recompute the trip_totals and trip_day_totals rollups from the source tables, in the column order of
+# those tables. Used to fill the rollups and to check them for drift.
+TRIP_TOTALS_QUERY = '''
+    SELECT trips.id AS trip_id,
+           COALESCE((SELECT SUM(cost) FROM activities WHERE trip_id = trips.id), 0) AS activities,
+           COALESCE((SELECT SUM(cost) FROM flights WHERE trip_id = trips.id), 0) AS flights,
+           COALESCE((SELECT SUM(cost) FROM hotels WHERE trip_id = trips.id), 0) AS hotels
+    FROM trips
+'''
+TRIP_DAY_TOTALS_QUERY = '''
+    SELECT trip_id, day, COALESCE(SUM(cost), 0) AS activities, COUNT(*) AS items
+    FROM activities
+    WHERE day IS NOT NULL AND trip_id IN (SELECT id FROM trips)
+    GROUP BY trip_id, day
+'''
+
+
+def _create_trip_totals(conn):
+    """
+    Add the trip_totals and trip_day_totals rollups of booking costs, kept up to date by triggers.
+
+    trip_totals holds each trip's spend on activities, flights and hotels. trip_day_totals holds the
+    activity spend and number of activities for each day of a trip; flights and hotels are not dated.
+    Triggers adjust the affected rows by the cost of each inserted, updated or deleted booking instead
+    of re-summing the trip, so totals are only exact to within floating point rounding.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS trip_totals (
+            trip_id INTEGER PRIMARY KEY,
+            activities REAL NOT NULL DEFAULT 0,
+            flights REAL NOT NULL DEFAULT 0,
+            hotels REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS trip_day_totals (
+            trip_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            activities REAL NOT NULL DEFAULT 0,
+            items INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (trip_id, date)
+        ) WITHOUT ROWID
+    ''')
+
+    # Deletes only ever update existing rows, so a booking removed by a cascading trip delete can't
+    # recreate the totals of the deleted trip, whichever order SQLite runs the triggers in.
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trips_insert_totals AFTER INSERT ON trips
+        BEGIN INSERT OR IGNORE INTO trip_totals (trip_id) VALUES (NEW.id); END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trips_delete_totals AFTER DELETE ON trips
+        BEGIN
+            DELETE FROM trip_totals WHERE trip_id = OLD.id;
+            DELETE FROM trip_day_totals WHERE trip_id = OLD.id;
+        END
+    ''')
+    for table in ('activities', 'flights', 'hotels'):
+        add = (f'INSERT INTO trip_totals (trip_id, {table}) VALUES (NEW.trip_id, COALESCE(NEW.cost, 0)) '
+               f'ON CONFLICT (trip_id) DO UPDATE SET {table} = {table} + excluded.{table};')
+        remove = f'UPDATE trip_totals SET {table} = {table} - COALESCE(OLD.cost, 0) WHERE trip_id = OLD.trip_id;'
+        changed_columns = 'trip_id, cost'
+        if table == 'activities':
+            add += '''
+                INSERT INTO trip_day_totals (trip_id, date, activities, items)
+                SELECT NEW.trip_id, NEW.date, COALESCE(NEW.cost, 0), 1 WHERE NEW.date IS NOT NULL
+                ON CONFLICT (trip_id, date) DO UPDATE SET activities = activities + excluded.activities,
+                                                          items = items + 1;
+            '''
+            remove += '''
+                UPDATE trip_day_totals SET activities = activities - COALESCE(OLD.cost, 0), items = items - 1
+                WHERE trip_id = OLD.trip_id AND date = OLD.date;
+                DELETE FROM trip_day_totals WHERE trip_id = OLD.trip_id AND date = OLD.date AND items <= 0;
+            '''
+            changed_columns += ', date'
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_insert_totals AFTER INSERT ON {table}
+            BEGIN {add} END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_update_totals AFTER UPDATE OF {changed_columns} ON {table}
+            BEGIN {remove} {add} END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_delete_totals AFTER DELETE ON {table}
+            BEGIN {remove} END
+        ''')
+
+    conn.execute(f'INSERT INTO trip_totals (trip_id, activities, flights, hotels) {TRIP_TOTALS_QUERY}')
+    conn.execute('''
+        INSERT INTO trip_day_totals (trip_id, date, activities, items)
+        SELECT trip_id, date, COALESCE(SUM(cost), 0), COUNT(*)
+        FROM activities
+        WHERE date IS NOT NULL AND trip_id IN (SELECT id FROM trips)
+        GROUP BY trip_id, date
+    ''')
+
+
+def _encode_dates_as_integers(conn):
+    """
+    Store trip and activity dates as day numbers and activity times as minutes since midnight.
+
+    Integer days and minutes sort correctly in SQL, so activities can be read in order from the
+    (trip_id, day, minute) index instead of being parsed and sorted in Python. trips and activities are
+    rebuilt with start_day, end_day, day and minute columns in place of the text ones, keeping their
+    rows, IDs and triggers. Times are parsed as strptime's '%I:%M %p' did, so '7:00 pm' is kept too; a
+    time that can't be parsed stops the migration instead of being dropped. The trips_text and
+    activities_text views present the old text columns to readers that expect them.
+    """
+    # Zero-padded times are converted in SQL below. The few others are parsed here first, so a time
+    # that can't be read stops the migration before anything is rebuilt.
+    minute = '''
+        CASE WHEN time GLOB '[01][0-9]:[0-5][0-9] [AP]M' THEN
+            (CAST(substr(time, 1, 2) AS INTEGER) % 12 + CASE substr(time, 7, 2) WHEN 'PM' THEN 12 ELSE 0 END) * 60
+            + CAST(substr(time, 4, 2) AS INTEGER)
+        END
+    '''
+    parsed = []
+    invalid = []
+    for activity_id, time in conn.execute(f"SELECT id, time FROM activities WHERE time != '' AND ({minute}) IS NULL"):
+        try:
+            parsed.append((dates.to_minute(time), activity_id))
+        except (TypeError, ValueError):
+            invalid.append(f'{activity_id} ({time!r})')
+    if invalid:
+        raise RuntimeError(f"Activities with times not in 'HH:MM AM' format: {', '.join(invalid[:20])}"
+                           f"{' and more' if len(invalid) > 20 else ''}. Correct them and run the migration again.")
+
+    # Triggers are dropped with their tables, so their definitions are kept to recreate them. The
+    # activities triggers maintaining trip_day_totals are redefined below for the day column.
+    triggers = [sql for (sql,) in conn.execute('''
+        SELECT sql FROM sqlite_master
+        WHERE type = 'trigger' AND tbl_name IN ('trips', 'activities') AND name NOT LIKE 'activities%totals'
+    ''')]
+    sequences = conn.execute("SELECT name, seq FROM sqlite_sequence WHERE name IN ('trips', 'activities')").fetchall()
+
+    conn.execute('''
+        CREATE TABLE trips_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            start_day INTEGER,
+            end_day INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE activities_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id INTEGER NOT NULL REFERENCES trips (id) ON DELETE CASCADE,
+            day INTEGER,
+            name TEXT,
+            minute INTEGER,
+            cost REAL,
+            file_path TEXT,
+            address TEXT,
+            confirmation TEXT
+        )
+    ''')
+    day = f'CAST(julianday({{}}) - {dates.EPOCH_JULIAN_DAY} AS INTEGER)'
+    conn.execute(f'''
+        INSERT INTO trips_new (id, title, start_day, end_day)
+        SELECT id, title, {day.format('start_date')}, {day.format('end_date')} FROM trips
+    ''')
+    conn.execute(f'''
+        INSERT INTO activities_new (id, trip_id, day, name, minute, cost, file_path, address, confirmation)
+        SELECT id, trip_id, {day.format('date')}, name, {minute}, cost, file_path, address, confirmation
+        FROM activities
+    ''')
+    conn.executemany('UPDATE activities_new SET minute = ? WHERE id = ?', parsed)
+    conn.execute('DROP TABLE activities')
+    conn.execute('DROP TABLE trips')
+    conn.execute('ALTER TABLE trips_new RENAME TO trips')
+    conn.execute('ALTER TABLE activities_new RENAME TO activities')
+    # Keep the AUTOINCREMENT counters, so IDs of deleted rows are still never reused.
+    for name, seq in sequences:
+        conn.execute('DELETE FROM sqlite_sequence WHERE name = ?', (name,))
+        conn.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (name, seq))
+
+    conn.execute('DROP TABLE trip_day_totals')
+    conn.execute('''
+        CREATE TABLE trip_day_totals (
+            trip_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            activities REAL NOT NULL DEFAULT 0,
+            items INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (trip_id, day)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute(f'INSERT INTO trip_day_totals (trip_id, day, activities, items) {TRIP_DAY_TOTALS_QUERY}')
+
+    conn.execute('CREATE INDEX idx_trips_start_day_id ON trips (start_day, id)')
+    conn.execute('CREATE INDEX idx_activities_trip_day_minute ON activities (trip_id, day, minute)')
+    for sql in triggers:
+        conn.execute(sql)
+    add = '''
+        INSERT INTO trip_totals (trip_id, activities) VALUES (NEW.trip_id, COALESCE(NEW.cost, 0))
+        ON CONFLICT (trip_id) DO UPDATE SET activities = activities + excluded.activities;
+        INSERT INTO trip_day_totals (trip_id, day, activities, items)
+        SELECT NEW.trip_id, NEW.day, COALESCE(NEW.cost, 0), 1 WHERE NEW.day IS NOT NULL
+        ON CONFLICT (trip_id, day) DO UPDATE SET activities = activities + excluded.activities, items = items + 1;
+    '''
+    remove = '''
+        UPDATE trip_totals SET activities = activities - COALESCE(OLD.cost, 0) WHERE trip_id = OLD.trip_id;
+        UPDATE trip_day_totals SET activities = activities - COALESCE(OLD.cost, 0), items = items - 1
+        WHERE trip_id = OLD.trip_id AND day = OLD.day;
+        DELETE FROM trip_day_totals WHERE trip_id = OLD.trip_id AND day = OLD.day AND items <= 0;
+    '''
+    conn.execute(f'CREATE TRIGGER activities_insert_totals AFTER INSERT ON activities BEGIN {add} END')
+    conn.execute(f'''
+        CREATE TRIGGER activities_update_totals AFTER UPDATE OF trip_id, cost, day ON activities
+        BEGIN {remove} {add} END
+    ''')
+    conn.execute(f'CREATE TRIGGER activities_delete_totals AFTER DELETE ON activities BEGIN {remove} END')
+
+    conn.execute(f'''
+        CREATE VIEW trips_text AS
+        SELECT id, title, {dates.DATE_SQL.format('start_day')} AS start_date,
+               {dates.DATE_SQL.format('end_day')} AS end_date
+        FROM trips
+    ''')
+    conn.execute(f'''
+        CREATE VIEW activities_text AS
+        SELECT id, trip_id, {dates.DATE_SQL.format('day')} AS date, name, {dates.TIME_SQL.format('minute')} AS time,
+               cost, file_path, address, confirmation
+        FROM activities
+    ''')
+    if conn.execute('PRAGMA foreign_key_check').fetchone() is not None:
+        raise RuntimeError('Rebuilding trips and activities left dangling references')
+
+
+def _count_trip_revisions(conn):
+    """
+    Count every change to a trip in trip_versions.revision, so a trip's version changes on each write.
+
+    The sequence number alone can't identify a trip's state, since the trip holding the latest stamp
+    isn't re-stamped by further changes. The revision is bumped on every change, while seq keeps its
+    coalesced behaviour for the cache's polling. Together they make a per-trip version, e.g. for ETags.
+    """
+    conn.execute('ALTER TABLE trip_versions ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+    bump = ('INSERT INTO trip_versions (trip_id, seq, revision) '
+            'VALUES ({trip_id}, (SELECT COALESCE(MAX(seq), 0) + 1 FROM trip_versions), 1) '
+            'ON CONFLICT (trip_id) DO UPDATE SET revision = revision + 1, '
+            'seq = CASE WHEN trip_id IS (SELECT trip_id FROM trip_versions ORDER BY seq DESC LIMIT 1) '
+            'THEN seq ELSE excluded.seq END;')
+    for table, trip_column in (('trips', 'id'), ('activities', 'trip_id'), ('flights', 'trip_id'),
+                               ('hotels', 'trip_id')):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            statements = bump.format(trip_id=f'{row}.{trip_column}')
+            if table == 'trips':
+                statements += bump.format(trip_id=0)
+            conn.execute(f'DROP TRIGGER IF EXISTS {table}_{event.lower()}_version')
+            conn.execute(f'''
+                CREATE TRIGGER {table}_{event.lower()}_version AFTER {event} ON {table}
+                BEGIN {statements} END
+            ''')
+
+
+def _add_trip_archiving(conn):
+    """
+    Add trips.archived, set for trips hidden from the trip list, and lead the list's index with it.
+
+    The trip list pages through either the active or the archived trips by (start_day, id), so both use the index.
+    """
+    conn.execute('ALTER TABLE trips ADD COLUMN archived INTEGER NOT NULL DEFAULT 0')
+    conn.execute('DROP INDEX IF EXISTS idx_trips_start_day_id')
+    conn.execute('CREATE INDEX idx_trips_archived_start_day_id ON trips (archived, start_day, id)')
+
+
+def _count_attachment_references(conn):
+    """
+    Add the blobs table of the attachment store, with reference counts kept by triggers on activities.
+
+    An activity's file_path refers to a stored attachment as '<sha256 hex digest>/<file name>'. Every
+    insert, delete (including cascades from deleted trips) and change of file_path adjusts the count of
+    the blob it refers to, so cloned trips share blobs and garbage collection finds unreferenced ones.
+    Other file_path values match no blob and are left alone.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refs INTEGER NOT NULL DEFAULT 0,
+            created INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (created) WHERE refs <= 0')
+    add = 'UPDATE blobs SET refs = refs + 1 WHERE digest = substr(NEW.file_path, 1, 64);'
+    remove = 'UPDATE blobs SET refs = refs - 1 WHERE digest = substr(OLD.file_path, 1, 64);'
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS activities_insert_blob_refs AFTER INSERT ON activities
+        WHEN NEW.file_path IS NOT NULL BEGIN {add} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS activities_delete_blob_refs AFTER DELETE ON activities
+        WHEN OLD.file_path IS NOT NULL BEGIN {remove} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS activities_update_blob_refs AFTER UPDATE OF file_path ON activities
+        WHEN OLD.file_path IS NOT NEW.file_path BEGIN {remove} {add} END
+    ''')
+
+
+# Tables whose deleted rows are kept in trip_journal, with the column holding each row's trip.
+JOURNAL_TABLES = (('trips', 'id'), ('activities', 'trip_id'), ('flights', 'trip_id'), ('hotels', 'trip_id'))
+
+
+def _journal_deleted_rows(conn):
+    """
+    Add trip_journal, which keeps a JSON copy of every deleted trip, activity, flight and hotel row.
+
+    A deleted trip can then be put back without restoring a whole backup. The rows removed by one
+    delete share its timestamp and sit next to each other, children first, ahead of their trip.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS trip_journal (
+            id INTEGER PRIMARY KEY,
+            trip_id INTEGER NOT NULL,
+            table_name TEXT NOT NULL,
+            row TEXT NOT NULL,
+            deleted INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trip_journal_trip_id ON trip_journal (trip_id, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trip_journal_deleted ON trip_journal (deleted)')
+    create_journal_triggers(conn)
+
+
+def create_journal_triggers(conn):
+    """
+    Create, or recreate, the triggers that copy deleted rows into trip_journal.
+
+    Each trigger lists the table's columns, so migrations that add columns to a journaled table must call
+    this again. Migrations that rebuild a table should drop the triggers first, or the old rows are journaled.
+
+    Args:
+        conn (sqlite3.Connection): The connection to create the triggers on.
+    """
+    # Milliseconds since 1970, the same for every row one statement deletes.
+    now = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+    for table, trip_column in JOURNAL_TABLES:
+        columns = [column[1] for column in conn.execute(f'PRAGMA table_info({table})')]
+        row = ', '.join(f"'{column}', OLD.{column}" for column in columns)
+        conn.execute(f'DROP TRIGGER IF EXISTS {table}_delete_journal')
+        conn.execute(f'''
+            CREATE TRIGGER {table}_delete_journal AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO trip_journal (trip_id, table_name, row, deleted)
+                VALUES (OLD.{trip_column}, '{table}', json_object({row}), {now});
+            END
+        ''')
+
+
+def drop_journal_triggers(conn):
+    """
+    Stop copying deleted rows into trip_journal. Rows already journaled are kept.
+
+    Args:
+        conn (sqlite3.Connection): The connection to drop the triggers on.
+    """
+    for table, _ in JOURNAL_TABLES:
+        conn.execute(f'DROP TRIGGER IF EXISTS {table}_delete_journal')
+
+
+def _order_untimed_activities_last(conn):
+    """
+    Index activities by (trip_id, day, minute IS NULL, minute), the itinerary order.
+
+    Activities without a time are listed after the timed ones of their day. Leading the minute with
+    ``minute IS NULL`` lets that order be read from the index instead of sorted.
+    """
+    conn.execute('DROP INDEX IF EXISTS idx_activities_trip_day_minute')
+    conn.execute('CREATE INDEX idx_activities_trip_day_timed ON activities (trip_id, day, minute IS NULL, minute)')
+
+
+def _index_trip_lengths(conn):
+    """
+    Index the length of the trips, so the longest trip that isn't archived is found without a scan.
+
+    db.find_overlapping_trips bounds its range scan of the start dates by that length.
+    """
+    conn.execute('CREATE INDEX idx_trips_archived_length ON trips (archived, end_day - start_day)')
+
+
+def _let_bulk_loads_suspend_insert_triggers(conn):
+    """
+    Add the bulk_load flag table and make the per-row insert triggers skip their work while it holds a row.
+
+    bulk_import inserts the flag row at the start of each batch, inside its write transaction, applies
+    the triggers' effects set-based after its inserts, and deletes the row before the transaction
+    commits, so other connections never see it. Checking an empty table costs an insert one index
+    probe, and no schema change is needed per batch.
+    """
+    conn.execute('CREATE TABLE bulk_load (id INTEGER PRIMARY KEY)')
+    names = [f'{table}_insert_{effect}' for table in ('trips', 'activities', 'flights', 'hotels')
+             for effect in ('version', 'search', 'totals')] + ['activities_insert_blob_refs']
+    triggers = conn.execute(f"SELECT name, sql FROM sqlite_master WHERE type = 'trigger' "
+                            f"AND name IN ({', '.join('?' * len(names))})", names).fetchall()
+    for name, sql in triggers:
+        header, body = sql.split('BEGIN', 1)
+        if re.search(r'\bWHEN\b', header):
+            header = re.sub(r'\bWHEN\b', 'WHEN NOT EXISTS (SELECT 1 FROM bulk_load) AND', header, count=1)
+        else:
+            header = header.rstrip() + ' WHEN NOT EXISTS (SELECT 1 FROM bulk_load) '
+        conn.execute(f'DROP TRIGGER {name}')
+        conn.execute(f'{header}BEGIN{body}')
+
+
+# Ordered schema migrations. A database's PRAGMA user_version records how many have been applied.
+# Append new migrations to the end; never reorder or edit ones that have shipped.
+MIGRATIONS = [
+    _create_tables,
+    _cascade_trip_foreign_keys,
+    _index_trip_lookups,
+    _track_trip_versions,
+    _coalesce_trip_version_stamps,
+    _index_trip_start_dates,
+    _create_search_index,
+    _create_trip_totals,
+    _encode_dates_as_integers,
+    _count_trip_revisions,
+    _add_trip_archiving,
+    _count_attachment_references,
+    _journal_deleted_rows,
+    _order_untimed_activities_last,
+    _index_trip_lengths,
+    _let_bulk_loads_suspend_insert_triggers,
+]
+
+
+def schema_version(conn):
+    """
+    Return the schema version recorded in the database.
+
+    Args:
+        conn (sqlite3.Connection): The connection to inspect.
+
+    Returns:
+        int: The number of migrations applied to the database.
+    """
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Bring the database up to the latest schema version in place.
+
+    Each pending migration runs in its own write transaction together with the version bump, so an
+    interrupted upgrade resumes from the last completed step. The version is re-read after taking
+    the write lock, which makes it safe for several processes to call this at once.
+
+    Args:
+        conn (sqlite3.Connection): The connection to migrate. Must not be inside a transaction.
+
+    Returns:
+        int: The schema version after migrating.
+    """
+    if schema_version(conn) >= len(MIGRATIONS):
+        return schema_version(conn)
+
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    # Foreign key enforcement must be off while tables are rebuilt, and can only be changed outside a transaction.
+    foreign_keys = conn.execute('PRAGMA foreign_keys').fetchone()[0]
+    conn.execute('PRAGMA foreign_keys = OFF')
+    try:
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if schema_version(conn) < version:
+                    migration(conn)
+                    conn.execute(f'PRAGMA user_version = {version}')
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+    finally:
+        conn.execute(f'PRAGMA foreign_keys = {foreign_keys}')
+        conn.isolation_level = isolation_level
+    return schema_version(conn)
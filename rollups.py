@@ -0,0 +1,113 @@
+import argparse
+import sys
+
+from cache import read_cache
+from connection import transaction
+from dates import DATE_SQL
+from migrations import TRIP_DAY_TOTALS_QUERY, TRIP_TOTALS_QUERY
+
+# Largest difference between a stored and a recomputed cost that is put down to floating point rounding.
+TOLERANCE = 0.005
+
+
+def _differs(stored, expected):
+    """
+    Return whether a stored rollup value has drifted from the recomputed one.
+    """
+    if stored is None or expected is None:
+        return stored is not expected
+    return abs(stored - expected) > TOLERANCE
+
+
+def find_drift():
+    """
+    Recompute the trip_totals and trip_day_totals rollups from scratch and compare them to the stored rows.
+
+    Returns:
+        list: One dictionary per drifted value, with the keys 'trip_id', 'date' ('YYYY-MM-DD', or None
+            for trip totals), 'field', 'stored' and 'expected'. 'stored' is None for a missing row and
+            'expected' is None for a row that should not exist.
+    """
+    drift = []
+    with transaction() as conn:
+        rows = conn.execute(f'''
+            SELECT expected.trip_id, expected.activities, expected.flights, expected.hotels,
+                   trip_totals.activities, trip_totals.flights, trip_totals.hotels
+            FROM ({TRIP_TOTALS_QUERY}) AS expected
+            LEFT JOIN trip_totals ON trip_totals.trip_id = expected.trip_id
+            UNION ALL
+            SELECT trip_id, NULL, NULL, NULL, activities, flights, hotels FROM trip_totals
+            WHERE trip_id NOT IN (SELECT id FROM trips)
+        ''')
+        for trip_id, *values in rows:
+            for field, expected, stored in zip(('activities', 'flights', 'hotels'), values[:3], values[3:]):
+                if _differs(stored, expected):
+                    drift.append({'trip_id': trip_id, 'date': None, 'field': field, 'stored': stored,
+                                  'expected': expected})
+
+        rows = conn.execute(f'''
+            SELECT expected.trip_id, {DATE_SQL.format('expected.day')}, expected.activities, expected.items,
+                   trip_day_totals.activities, trip_day_totals.items
+            FROM ({TRIP_DAY_TOTALS_QUERY}) AS expected
+            LEFT JOIN trip_day_totals
+                ON trip_day_totals.trip_id = expected.trip_id AND trip_day_totals.day = expected.day
+            UNION ALL
+            SELECT trip_id, {DATE_SQL.format('day')}, NULL, NULL, activities, items FROM trip_day_totals
+            WHERE NOT EXISTS (SELECT 1 FROM activities
+                              WHERE activities.trip_id = trip_day_totals.trip_id
+                                AND activities.day = trip_day_totals.day)
+               OR trip_id NOT IN (SELECT id FROM trips)
+        ''')
+        for trip_id, date, *values in rows:
+            for field, expected, stored in zip(('activities', 'items'), values[:2], values[2:]):
+                if _differs(stored, expected):
+                    drift.append({'trip_id': trip_id, 'date': date, 'field': field, 'stored': stored,
+                                  'expected': expected})
+    return drift
+
+
+def rebuild():
+    """
+    Replace the trip_totals and trip_day_totals rollups with totals recomputed from the bookings.
+
+    Runs in one write transaction, so readers see either the old or the rebuilt rollups. The rollup
+    tables have no triggers of their own, so every trip is stamped in trip_versions as changed, which
+    drops cached totals and ETags in every process.
+    """
+    with transaction(immediate=True) as conn:
+        conn.execute('DELETE FROM trip_totals')
+        conn.execute('DELETE FROM trip_day_totals')
+        conn.execute(f'INSERT INTO trip_totals (trip_id, activities, flights, hotels) {TRIP_TOTALS_QUERY}')
+        conn.execute(f'INSERT INTO trip_day_totals (trip_id, day, activities, items) {TRIP_DAY_TOTALS_QUERY}')
+        conn.execute('''
+            INSERT INTO trip_versions (trip_id, seq, revision)
+            SELECT id, (SELECT COALESCE(MAX(seq), 0) FROM trip_versions) + ROW_NUMBER() OVER (ORDER BY id), 1
+            FROM trips WHERE true
+            ON CONFLICT (trip_id) DO UPDATE SET seq = excluded.seq, revision = revision + 1
+        ''')
+        trip_ids = [trip_id for trip_id, in conn.execute('SELECT id FROM trips')]
+    read_cache.invalidate(*trip_ids)
+
+
+def main(argv=None):
+    """
+    Command line entry point: check the cost rollups for drift, and optionally rebuild them.
+    """
+    parser = argparse.ArgumentParser(description='Verify or rebuild the per-trip cost rollups.')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the rollups after reporting drift')
+    args = parser.parse_args(argv)
+
+    drift = find_drift()
+    for item in drift:
+        where = f'trip {item["trip_id"]}' + (f' on {item["date"]}' if item['date'] else '')
+        print(f'{where}: {item["field"]} is {item["stored"]}, expected {item["expected"]}')
+    print(f'Found {len(drift)} drifted values.')
+    if args.rebuild:
+        rebuild()
+        print('Rebuilt the rollups.')
+        return 0
+    return 1 if drift else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,62 @@
+import asyncio
+import gzip
+import http.client
+import io
+import os
+import sqlite3
+import tempfile
+import threading
 import unittest
 from datetime import datetime, timedelta
+import analytics
+import api
+import async_db
+import attachments
+import backup
+import benchmark
+import bulk_export
+import bulk_import
+import conflicts
+import connection
+import instrumentation
+import migrations
+import rollups
+from connection import transaction
+from writer import WriteQueue
 from db import connect_db, create_trip, get_all_trips, get_trip_by_id, add_flight_to_trip, add_hotel_to_trip, \
-    add_activity_to_day, get_itinerary_for_trip, delete_trip
+    add_activity_to_day, get_itinerary_for_trip, delete_trip, load_trip_bundle, \
+    get_itinerary_range, list_trips, search, get_trip_totals, get_flights_for_trip, get_hotels_for_trip, Activity, \
+    Flight, clone_trip, delete_trips, archive_trips
+
+
+# A migrated, empty database that every test starts from. Built once per test process.
+_template = None
+
+
+def use_fresh_database():
+    """
+    Point the application at a new in-memory database copied from the migrated template.
+
+    Each test process, such as a parallel test worker, has its own in-memory databases, so tests never
+    share state or touch trips.db.
+    """
+    global _template
+    if _template is None:
+        _template = sqlite3.connect(':memory:')
+        migrations.migrate(_template)
+    connection.use_database(':memory:')
+    database, uri = connection.database_target()
+    target = sqlite3.connect(database, uri=uri)
+    _template.backup(target)
+    target.close()
 
 
 class TestTravelPlanner(unittest.TestCase):
 
     def setUp(self):
-        # Create a test database connection
+        # Give every test its own pre-migrated database
+        use_fresh_database()
         self.conn = connect_db()
-        self.conn.execute("DELETE FROM trips")
-        self.conn.execute("DELETE FROM activities")
-        self.conn.commit()
 
     def tearDown(self):
         # Close the database connection
@@ -45,20 +90,20 @@ class TestTravelPlanner(unittest.TestCase):
     def test_add_flight_to_trip(self):
         create_trip("Flight Test Trip", datetime.now().date(), datetime.now().date() + timedelta(days=3))
         trip = get_all_trips()[0]
-        flight_details = "Test Flight AA123"
-        add_flight_to_trip(trip.id, flight_details)
+        add_flight_to_trip(trip.id, 320.0, "14C", "Test Air", "AA123", "FL-1")
 
-        updated_trip = get_trip_by_id(trip.id)
-        self.assertEqual(updated_trip.flight_details, flight_details)
+        flights = get_flights_for_trip(trip.id)
+        self.assertEqual([(flight.airline, flight.flight_number, flight.seat, flight.cost) for flight in flights],
+                         [("Test Air", "AA123", "14C", 320.0)])
 
     def test_add_hotel_to_trip(self):
         create_trip("Hotel Test Trip", datetime.now().date(), datetime.now().date() + timedelta(days=3))
         trip = get_all_trips()[0]
-        hotel_details = "Test Hotel XYZ"
-        add_hotel_to_trip(trip.id, hotel_details)
+        add_hotel_to_trip(trip.id, 480.0, "Test Hotel XYZ", "1 Test Road", 2, "HT-1")
 
-        updated_trip = get_trip_by_id(trip.id)
-        self.assertEqual(updated_trip.hotel_details, hotel_details)
+        hotels = get_hotels_for_trip(trip.id)
+        self.assertEqual([(hotel.name, hotel.address, hotel.rooms, hotel.cost) for hotel in hotels],
+                         [("Test Hotel XYZ", "1 Test Road", 2, 480.0)])
 
     def test_add_and_get_activity(self):
         create_trip("Activity Test Trip", datetime.now().date(), datetime.now().date() + timedelta(days=3))
@@ -80,6 +125,587 @@ class TestTravelPlanner(unittest.TestCase):
         trips = get_all_trips()
         self.assertEqual(len(trips), 0)
 
+    def test_clone_trip_shifts_dates_and_copies_bookings(self):
+        trip_id = create_trip("Conference", datetime(2024, 3, 4).date(), datetime(2024, 3, 6).date())
+        add_activity_to_day(trip_id, "2024-03-05", "Keynote", "09:00 AM", 0.0, None, "Hall A", "K1")
+        add_flight_to_trip(trip_id, 300.0, "12A", "TAP", "TP100", "F1")
+        add_hotel_to_trip(trip_id, 450.0, "Hotel Central", "1 Main St", 1, "H1")
+
+        copy_id = clone_trip(trip_id, datetime(2025, 3, 3).date(), "Conference 2025")
+        copy = get_trip_by_id(copy_id)
+        self.assertEqual((copy.title, copy.start_date, copy.end_date), ("Conference 2025", "2025-03-03", "2025-03-05"))
+        self.assertEqual([activity.name for activity in get_itinerary_for_trip(copy_id, "2025-03-04")], ["Keynote"])
+        self.assertEqual(get_flights_for_trip(copy_id)[0].flight_number, "TP100")
+        self.assertEqual(get_trip_totals(copy_id)['total'], 750.0)
+        self.assertEqual(len(get_itinerary_for_trip(trip_id, "2024-03-05")), 1)
+        self.assertIsNone(clone_trip(copy_id + 1, None))
+
+    def test_bulk_archive_and_delete_trips(self):
+        trip_ids = [create_trip(f"Trip {index}", datetime(2024, 1, index).date(), datetime(2024, 1, index).date())
+                    for index in range(1, 5)]
+        add_flight_to_trip(trip_ids[0], 100.0, "1A", "TAP", "TP1", "F1")
+
+        self.assertEqual(archive_trips(trip_ids[:2]), 2)
+        self.assertEqual([trip.id for trip in list_trips()], trip_ids[2:])
+        self.assertEqual([trip.id for trip in list_trips(archived=True)], trip_ids[:2])
+        self.assertEqual(archive_trips(trip_ids[:1], archived=False), 1)
+        self.assertEqual([trip.id for trip in list_trips()], [trip_ids[0]] + trip_ids[2:])
+
+        self.assertEqual(delete_trips(trip_ids[:3]), 3)
+        self.assertEqual([trip.id for trip in get_all_trips()], trip_ids[3:])
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM flights').fetchone()[0], 0)
+        self.assertEqual(delete_trips([]), 0)
+
+    def test_attachments_are_deduplicated_reference_counted_and_served_by_range(self):
+        directory = attachments.ATTACHMENTS_DIR
+        with tempfile.TemporaryDirectory() as store_dir:
+            attachments.use_directory(store_dir)
+            try:
+                content = bytes(range(256)) * 40
+                reference = attachments.store(io.BytesIO(content), "ticket.pdf", chunk_size=1000)
+                self.assertEqual(attachments.store(io.BytesIO(content), "copy.pdf").split('/')[0],
+                                 reference.split('/')[0])
+                self.assertEqual(attachments.read_attachment(reference, 10, 20), content[10:20])
+
+                trip_id = create_trip("Files", datetime(2024, 5, 1).date(), datetime(2024, 5, 2).date())
+                add_activity_to_day(trip_id, "2024-05-01", "Train", "08:00 AM", 0.0, reference, None, None)
+                copy_id = clone_trip(trip_id, datetime(2024, 6, 1).date())
+                refs = 'SELECT refs FROM blobs'
+                self.assertEqual(self.conn.execute(refs).fetchone()[0], 2)
+                self.assertEqual(attachments.collect_garbage(grace=-1)['blobs'], 0)
+
+                server = api.serve(port=0)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                try:
+                    conn = http.client.HTTPConnection(*server.server_address)
+                    conn.request('GET', f'/attachments/{reference}', headers={'Range': 'bytes=100-199'})
+                    response = conn.getresponse()
+                    self.assertEqual((response.status, response.read()), (206, content[100:200]))
+                    self.assertEqual(response.getheader('Content-Range'), f'bytes 100-199/{len(content)}')
+                    conn.request('GET', f'/attachments/{reference}', headers={'Range': f'bytes={len(content)}-'})
+                    response = conn.getresponse()
+                    response.read()
+                    self.assertEqual(response.status, 416)
+                finally:
+                    server.shutdown()
+                    server.server_close()
+
+                delete_trips([trip_id, copy_id])
+                self.assertEqual(self.conn.execute(refs).fetchone()[0], 0)
+                self.assertEqual(attachments.collect_garbage(grace=-1)['blobs'], 1)
+                self.assertFalse(attachments.exists(reference))
+            finally:
+                attachments.use_directory(directory)
+
+    def test_snapshot_restore_and_restore_deleted_trip(self):
+        trip_id = create_trip("Backup", datetime(2024, 7, 1).date(), datetime(2024, 7, 3).date())
+        add_activity_to_day(trip_id, "2024-07-02", "Hike", "08:00 AM", 10.0, None, "Trailhead", "H1")
+        add_hotel_to_trip(trip_id, 200.0, "Lodge", "1 Ridge Rd", 1, "L1")
+        other_id = create_trip("Other", datetime(2024, 8, 1).date(), datetime(2024, 8, 2).date())
+        add_activity_to_day(other_id, "2024-08-01", "Swim", "09:00 AM", 0.0, None, None, None)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = backup.snapshot(directory, pages=1)
+            delete_trip(other_id)
+            self.assertEqual(get_trip_totals(trip_id)['total'], 210.0)
+
+            saved = backup.restore(path)
+            self.assertEqual([trip.title for trip in get_all_trips()], ["Backup", "Other"])
+            self.assertEqual([snapshot for snapshot, _ in backup.list_snapshots(directory)], [saved, path])
+            self.assertEqual(backup.prune(keep=1, daily=0, directory=directory), [path])
+
+        add_activity_to_day(trip_id, "2024-07-03", "Dinner", "07:00 PM", 30.0, None, None, None)
+        delete_trip(trip_id)
+        self.assertEqual([trip['title'] for trip in backup.deleted_trips()], ["Backup"])
+        self.assertEqual(backup.restore_trip(trip_id), trip_id)
+        self.assertEqual({date: [activity.name for activity in activities]
+                          for date, activities in get_itinerary_range(trip_id, "2024-07-01", "2024-07-03").items()},
+                         {"2024-07-02": ["Hike"], "2024-07-03": ["Dinner"]})
+        self.assertEqual(get_trip_totals(trip_id)['total'], 240.0)
+        self.assertEqual(backup.deleted_trips(), [])
+        self.assertIsNone(backup.restore_trip(trip_id))
+
+    def test_conflicts_find_overlaps_double_bookings_and_missing_hotels(self):
+        alps = create_trip("Alps", datetime(2030, 1, 1).date(), datetime(2030, 1, 5).date())
+        coast = create_trip("Coast", datetime(2030, 1, 5).date(), datetime(2030, 1, 8).date())
+        city = create_trip("City", datetime(2030, 2, 1).date(), datetime(2030, 2, 1).date())
+        add_hotel_to_trip(coast, 300.0, "Inn", "1 Beach Rd", 1, "I1")
+        add_activity_to_day(alps, "2030-01-02", "Ski", "09:00 AM", 0.0, None, None, None)
+        add_activity_to_day(alps, "2030-01-02", "Lesson", "09:30 AM", 0.0, None, None, None)
+        add_activity_to_day(alps, "2030-01-02", "Lunch", "12:00 PM", 0.0, None, None, None)
+        add_activity_to_day(city, "2030-02-03", "Tour", None, 0.0, None, None, None)
+
+        self.assertEqual([conflict['ids'] for conflict in conflicts.check_trip("2030-01-06", "2030-01-10")],
+                         [[None, coast]])
+        self.assertEqual(conflicts.check_trip("2030-01-09", "2030-01-31"), [])
+        lesson = get_itinerary_for_trip(alps, "2030-01-02")[1]
+        self.assertEqual([conflict['ids'] for conflict in conflicts.check_activity(alps, "2030-01-02", "10:15 AM")],
+                         [[lesson.id]])
+        self.assertEqual([conflict['kind'] for conflict in conflicts.check_activity(alps, "2030-01-09", None)],
+                         ['outside_trip'])
+
+        found = {(conflict['kind'], conflict['trip_id']) for conflict in conflicts.audit()}
+        self.assertEqual(found, {('overlapping_trips', coast), ('no_hotel', alps), ('double_booked', alps),
+                                 ('outside_trip', city)})
+        self.assertEqual(sorted(conflict['kind'] for conflict in conflicts.trip_conflicts(alps)),
+                         ['double_booked', 'no_hotel', 'overlapping_trips'])
+        self.assertEqual(sorted(conflict['kind'] for conflict in conflicts.trip_conflicts(alps, "2030-01-03", "2030-01-05")),
+                         ['no_hotel', 'overlapping_trips'])
+        self.assertEqual({conflict['kind'] for conflict in conflicts.audit([city])}, {'outside_trip'})
+
+        status, _, body = api.dispatch('POST', '/trips', {"title": "Clash", "start_date": "2030-01-08",
+                                                          "end_date": "2030-01-09"})
+        self.assertEqual((status, [conflict['ids'] for conflict in body['conflicts']]), (409, [[None, coast]]))
+        status, _, _ = api.dispatch('POST', f'/trips/{alps}/activities', {"date": "2030-01-02", "name": "Tea",
+                                                                          "time": "11:30 AM"})
+        self.assertEqual((status, len(get_itinerary_for_trip(alps, "2030-01-02"))), (409, 3))
+        self.assertEqual(api.dispatch('POST', f'/trips/{alps}/activities', {"date": "2030-01-02", "name": "Tea",
+                                                                            "time": "11:30 AM",
+                                                                            "allow_conflicts": True})[0], 201)
+        archive_trips([coast])
+        self.assertEqual(api.dispatch('GET', f'/trips/{alps}/conflicts')[2][0]['kind'], 'no_hotel')
+
+    def test_conflicts_report_every_overlapping_pair(self):
+        long = create_trip("Long", datetime(2030, 3, 1).date(), datetime(2030, 3, 20).date())
+        middle = create_trip("Middle", datetime(2030, 3, 2).date(), datetime(2030, 3, 10).date())
+        short = create_trip("Short", datetime(2030, 3, 5).date(), datetime(2030, 3, 6).date())
+        for name, time in (("Museum", "10:00 AM"), ("Walk", "10:20 AM"), ("Cafe", "10:40 AM")):
+            add_activity_to_day(long, "2030-03-03", name, time, 0.0, None, None, None)
+
+        found = conflicts.audit()
+        self.assertEqual(sorted(conflict['ids'] for conflict in found if conflict['kind'] == 'overlapping_trips'),
+                         [[middle, long], [short, long], [short, middle]])
+        self.assertEqual(len([conflict for conflict in found if conflict['kind'] == 'double_booked']), 3)
+        # The per-trip check finds the same pairs as the audit.
+        self.assertEqual([conflict['ids'] for conflict in conflicts.trip_conflicts(short)
+                          if conflict['kind'] == 'overlapping_trips'], [[short, long], [short, middle]])
+
+    def test_dates_accept_datetimes_and_empty_times(self):
+        trip_id = create_trip("Datetime Trip", datetime(2024, 1, 1, 23, 30), datetime(2024, 1, 3, 8, 0))
+        trip = get_trip_by_id(trip_id)
+        self.assertEqual((trip.start_date, trip.end_date), ("2024-01-01", "2024-01-03"))
+        add_activity_to_day(trip_id, "2024-01-02", "Untimed", "", 0.0, None, None, None)
+        self.assertIsNone(get_itinerary_for_trip(trip_id, "2024-01-02")[0].time)
+
+    def test_load_trip_bundle(self):
+        start_date = datetime.now().date()
+        create_trip("Bundle Test Trip", start_date, start_date + timedelta(days=2))
+        trip = get_all_trips()[0]
+        first_day = start_date.strftime("%Y-%m-%d")
+        last_day = (start_date + timedelta(days=2)).strftime("%Y-%m-%d")
+        add_activity_to_day(trip.id, first_day, "Museum", "09:00 AM", 20.0, None, "1 Art St", "M1")
+        add_activity_to_day(trip.id, last_day, "Dinner", "07:00 PM", 80.0, None, "2 Food St", "D1")
+
+        bundle = load_trip_bundle(trip.id)
+        self.assertEqual(bundle['trip'].title, "Bundle Test Trip")
+        self.assertEqual(sorted(bundle['itinerary']), [first_day, last_day])
+        self.assertEqual(bundle['itinerary'][first_day][0]['name'], "Museum")
+        self.assertIsNone(load_trip_bundle(trip.id + 1))
+
+    def test_list_trips_pages_by_start_date(self):
+        base = datetime(2024, 1, 1).date()
+        for offset, title in ((2, 'Rome'), (0, 'Paris'), (1, 'Porto'), (1, '100% Lisbon')):
+            create_trip(title, base + timedelta(days=offset), base + timedelta(days=offset + 1))
+
+        first_page = list_trips(limit=2)
+        self.assertEqual([trip.title for trip in first_page], ['Paris', 'Porto'])
+        last = first_page[-1]
+        second_page = list_trips(after=(last.start_date, last.id), limit=2)
+        self.assertEqual([trip.title for trip in second_page], ['100% Lisbon', 'Rome'])
+        self.assertEqual([trip.title for trip in list_trips(filter='p')], ['Paris', 'Porto'])
+        self.assertEqual([trip.title for trip in list_trips(filter='0%')], ['100% Lisbon'])
+
+    def test_search_matches_prefixes_and_follows_deletes(self):
+        trip_id = create_trip("Search Test Trip", datetime.now().date(), datetime.now().date() + timedelta(days=1))
+        add_hotel_to_trip(trip_id, 450.0, "Harbour Inn", "12 Lisbon Road", 1, "HX-7781")
+        add_flight_to_trip(trip_id, 300.0, "12A", "Test Air", "TA1", "F1")
+
+        results = search("lisb")
+        self.assertEqual([(result['kind'], result['title']) for result in results], [('hotel', 'Harbour Inn')])
+        self.assertEqual(results[0]['trip_title'], "Search Test Trip")
+        self.assertEqual([result['kind'] for result in search("hx-7781")], ['hotel'])
+        self.assertEqual([result['kind'] for result in search('test "air')], ['flight'])
+        self.assertEqual(search("   "), [])
+
+        delete_trip(trip_id)
+        self.assertEqual(search("harbour"), [])
+
+    def test_trip_totals_follow_bookings_and_report_drift(self):
+        start_date = datetime.now().date()
+        day = start_date.strftime("%Y-%m-%d")
+        trip_id = create_trip("Totals Test Trip", start_date, start_date + timedelta(days=1))
+        add_flight_to_trip(trip_id, 300.0, "12A", "Test Air", "TA1", "F1")
+        add_hotel_to_trip(trip_id, 450.5, "Harbour Inn", "12 Lisbon Road", 1, "H1")
+        add_activity_to_day(trip_id, day, "Tour", "10:00 AM", 20.25, None, None, None)
+        add_activity_to_day(trip_id, day, "Dinner", "07:00 PM", 40.0, None, None, None)
+        self.conn.execute("DELETE FROM activities WHERE name = 'Dinner'")
+        self.conn.commit()
+
+        totals = get_trip_totals(trip_id)
+        self.assertEqual((totals['flights'], totals['hotels'], totals['activities'], totals['total']),
+                         (300.0, 450.5, 20.25, 770.75))
+        self.assertEqual(totals['days'], {day: 20.25})
+        self.assertEqual(rollups.find_drift(), [])
+        self.assertEqual([trip.total for trip in list_trips(with_totals=True)], [770.75])
+        add_activity_to_day(trip_id, day, "Museum", None, 9.25, None, None, None)
+        self.assertEqual([trip.total for trip in list_trips(with_totals=True)], [780.0])
+
+        self.conn.execute("UPDATE trip_totals SET flights = 0 WHERE trip_id = ?", (trip_id,))
+        self.conn.commit()
+        drift = rollups.find_drift()
+        self.assertEqual([(item['trip_id'], item['field'], item['expected']) for item in drift],
+                         [(trip_id, 'flights', 300.0)])
+        revision = 'SELECT revision FROM trip_versions WHERE trip_id = ?'
+        before = self.conn.execute(revision, (trip_id,)).fetchone()[0]
+        rollups.rebuild()
+        self.assertEqual(rollups.find_drift(), [])
+        self.assertEqual(self.conn.execute(revision, (trip_id,)).fetchone()[0], before + 1)
+
+        delete_trip(trip_id)
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM trip_day_totals').fetchone()[0], 0)
+
+    def test_analytics_aggregate_snapshot_and_reload_after_writes(self):
+        trip_id = create_trip("Analytics Trip", datetime(2024, 3, 30).date(), datetime(2024, 4, 2).date())
+        add_flight_to_trip(trip_id, 300.0, "12A", "Test Air", "TA1", "F1")
+        add_flight_to_trip(trip_id, 100.0, "3C", "Test Air", "TA2", "F2")
+        add_hotel_to_trip(trip_id, 450.0, "Harbour Inn", "12 Lisbon Road", 1, "H1")
+        add_activity_to_day(trip_id, "2024-03-31", "Tour", "10:00 AM", 20.0, None, None, None)
+        add_activity_to_day(trip_id, "2024-04-01", "Dinner", "07:00 PM", 30.0, None, None, None)
+
+        spend = analytics.spend_by_month()
+        self.assertEqual(spend['activities'].tolist(), [20.0, 30.0])
+        self.assertEqual(spend['total'].tolist(), [870.0, 30.0])
+        airlines = analytics.top_airlines()
+        self.assertEqual(airlines.loc["Test Air", 'flights'], 2)
+        self.assertEqual(airlines.loc["Test Air", 'average_cost'], 200.0)
+        self.assertEqual(analytics.hotel_cost_per_night().loc["Harbour Inn", 'cost_per_night'], 150.0)
+        self.assertEqual(analytics.summary()['cost_per_traveler_day'], 900.0 / 4)
+
+        add_hotel_to_trip(trip_id, 150.0, "Harbour Inn", "12 Lisbon Road", 1, "H2")
+        self.assertEqual(analytics.summary()['total_spend'], 1050.0)
+
+    def test_itinerary_is_ordered_by_time(self):
+        start_date = datetime(2024, 5, 1).date()
+        trip_id = create_trip("Order Test Trip", start_date, start_date + timedelta(days=1))
+        for name, time in (("Dinner", "07:30 PM"), ("Lunch", "12:15 PM"), ("Breakfast", "09:00 AM"),
+                           ("Late Snack", "12:05 AM"), ("Free Day", None)):
+            add_activity_to_day(trip_id, "2024-05-01", name, time, 0.0, None, None, None)
+
+        activities = get_itinerary_for_trip(trip_id, "2024-05-01")
+        self.assertEqual([activity['name'] for activity in activities],
+                         ["Late Snack", "Breakfast", "Lunch", "Dinner", "Free Day"])
+        self.assertEqual([activity['time'] for activity in activities[:-1]],
+                         ["12:05 AM", "09:00 AM", "12:15 PM", "07:30 PM"])
+        for day in (get_itinerary_range(trip_id, "2024-05-01", "2024-05-02")["2024-05-01"],
+                    load_trip_bundle(trip_id)['itinerary']["2024-05-01"]):
+            self.assertEqual([activity.id for activity in day], [activity.id for activity in activities])
+        self.assertEqual(get_trip_by_id(trip_id).start_day, 19844)
+
+    def test_readers_return_slotted_records(self):
+        start_date = datetime(2024, 5, 1).date()
+        trip_id = create_trip("Record Test Trip", start_date, start_date + timedelta(days=1))
+        add_flight_to_trip(trip_id, 250.0, "12A", "Test Air", "TA100", "F1")
+        add_activity_to_day(trip_id, "2024-05-02", "Museum", "10:00 AM", 15.0, None, "1 Museum Way", "M1")
+
+        bundle = load_trip_bundle(trip_id)
+        flight = bundle['flights'][0]
+        self.assertIsInstance(flight, Flight)
+        self.assertEqual((flight.trip_id, flight.airline, flight.seat, flight['cost']),
+                         (trip_id, "Test Air", "12A", 250.0))
+        activity = bundle['itinerary']["2024-05-02"][0]
+        self.assertIsInstance(activity, Activity)
+        self.assertEqual((activity.date, activity.time, activity.address), ("2024-05-02", "10:00 AM", "1 Museum Way"))
+        for record in (bundle['trip'], flight, activity):
+            self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_get_itinerary_range(self):
+        start_date = datetime.now().date()
+        trip_id = create_trip("Range Test Trip", start_date, start_date + timedelta(days=9))
+        for offset in (0, 3, 9):
+            day = (start_date + timedelta(days=offset)).strftime("%Y-%m-%d")
+            add_activity_to_day(trip_id, day, f"Day {offset}", "10:00 AM", 0.0, None, None, None)
+
+        itinerary = get_itinerary_range(trip_id, start_date.strftime("%Y-%m-%d"),
+                                        (start_date + timedelta(days=6)).strftime("%Y-%m-%d"))
+        self.assertEqual(sorted(activity['name'] for day in itinerary.values() for activity in day),
+                         ["Day 0", "Day 3"])
+        empty_day = (start_date + timedelta(days=1)).strftime("%Y-%m-%d")
+        self.assertEqual(get_itinerary_for_trip(trip_id, empty_day), [])
+
+    def test_delete_trip_cascades(self):
+        create_trip("Cascade Test Trip", datetime.now().date(), datetime.now().date() + timedelta(days=1))
+        trip = get_all_trips()[0]
+        activity_date = datetime.now().date().strftime("%Y-%m-%d")
+        add_activity_to_day(trip.id, activity_date, "Tour", "10:00 AM", 5.0, None, None, None)
+        add_flight_to_trip(trip.id, 300.0, "12A", "Test Air", "TA1", "F1")
+        delete_trip(trip.id)
+
+        for table in ('activities', 'flights', 'hotels'):
+            count = self.conn.execute(f'SELECT COUNT(*) FROM {table} WHERE trip_id = ?', (trip.id,)).fetchone()[0]
+            self.assertEqual(count, 0)
+
+    def test_migrate_upgrades_legacy_database(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        legacy = sqlite3.connect(path)
+        migrations._create_tables(legacy)
+        legacy.execute("INSERT INTO trips (title, start_date, end_date) VALUES ('Old', '2020-01-01', '2020-01-02')")
+        legacy.execute("INSERT INTO activities (trip_id, date, name, time) "
+                       "VALUES (1, '2020-01-01', 'Kept', '01:30 PM')")
+        legacy.execute("INSERT INTO activities (trip_id, date, name, time) VALUES (1, '2020-01-01', 'Late', '7:05 pm')")
+        legacy.execute("INSERT INTO activities (trip_id, date, name) VALUES (99, '2020-01-01', 'Orphan')")
+        legacy.commit()
+
+        self.assertEqual(migrations.migrate(legacy), len(migrations.MIGRATIONS))
+        self.assertEqual(migrations.migrate(legacy), len(migrations.MIGRATIONS))
+        names = [row[0] for row in legacy.execute('SELECT name FROM activities')]
+        self.assertEqual(names, ['Kept', 'Late'])
+        indexes = {row[1] for row in legacy.execute('PRAGMA index_list(activities)')}
+        self.assertIn('idx_activities_trip_day_timed', indexes)
+        self.assertEqual(legacy.execute('SELECT day, minute FROM activities').fetchall(),
+                         [(18262, 13 * 60 + 30), (18262, 19 * 60 + 5)])
+        self.assertEqual(legacy.execute('SELECT date, time FROM activities_text').fetchone(),
+                         ('2020-01-01', '01:30 PM'))
+        self.assertEqual(legacy.execute('SELECT start_date, end_date FROM trips_text').fetchone(),
+                         ('2020-01-01', '2020-01-02'))
+        legacy.close()
+
+        unreadable = sqlite3.connect(':memory:')
+        migrations._create_tables(unreadable)
+        unreadable.execute("INSERT INTO trips (title, start_date, end_date) VALUES ('Old', '2020-01-01', '2020-01-02')")
+        unreadable.execute("INSERT INTO activities (trip_id, date, name, time) VALUES (1, '2020-01-01', 'Noon', 'noon')")
+        unreadable.commit()
+        with self.assertRaisesRegex(RuntimeError, "noon"):
+            migrations.migrate(unreadable)
+        self.assertEqual(unreadable.execute('SELECT time FROM activities').fetchone(), ('noon',))
+        unreadable.close()
+
+    def test_cached_read_sees_writes_from_other_connections(self):
+        trip_id = create_trip("Cache Test Trip", datetime.now().date(), datetime.now().date() + timedelta(days=1))
+        first = get_trip_by_id(trip_id)
+        self.assertIs(get_trip_by_id(trip_id), first)
+
+        self.conn.execute("UPDATE trips SET title = 'Renamed' WHERE id = ?", (trip_id,))
+        self.conn.commit()
+        self.assertEqual(get_trip_by_id(trip_id).title, 'Renamed')
+
+    def test_bulk_import_maps_trip_keys_and_reports_rejects(self):
+        source = io.StringIO(
+            'type,key,trip_key,title,start_date,end_date,date,name,time,cost,airline,flight_number,rooms\n'
+            'trip,T1,,Import Trip,2024-03-01,2024-03-03,,,,,,,\n'
+            'activity,,T1,,,,2024-03-02,Walk,09:30 AM,5,,,\n'
+            'flight,,T1,,,,,,,,Test Air,TA9,\n'
+            'activity,,T2,,,,2024-03-02,Orphan,,,,,\n'
+            'activity,,T1,,,,2024-03-02,Bad time,25:00,,,,\n'
+            'hotel,,T1,,,,,Half Inn,,100,,,2.7\n'
+            'hotel,,T1,,,,,NaN Inn,,nan,,,1\n'
+            'hotel,,T1,,,,,Harbour Inn,,100,,,2\n'
+        )
+        report = bulk_import.import_records(bulk_import.read_records(source, 'csv'), batch_size=2)
+
+        self.assertEqual(report['inserted'], {'trip': 1, 'activity': 1, 'flight': 1, 'hotel': 1})
+        self.assertEqual([line for line, _ in report['rejected']], [5, 6, 7, 8])
+        self.assertEqual(report['conflicts'], [])
+        trip_id = report['trip_ids']['T1']
+        self.assertEqual(get_trip_by_id(trip_id).title, 'Import Trip')
+        self.assertEqual(get_itinerary_for_trip(trip_id, '2024-03-02')[0]['name'], 'Walk')
+        self.assertEqual(get_hotels_for_trip(trip_id)[0].rooms, 2)
+
+        # The insert triggers are suspended during the import; their effects are applied in bulk.
+        with transaction() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM bulk_load').fetchone()[0], 0)
+        self.assertEqual(get_trip_totals(trip_id)['total'], 105.0)
+        self.assertEqual(rollups.find_drift(), [])
+        self.assertEqual([result['kind'] for result in search('harbour')], ['hotel'])
+        add_activity_to_day(trip_id, '2024-03-03', 'Ferry', None, 10.0, None, None, None)
+        self.assertEqual(get_trip_totals(trip_id)['total'], 115.0)
+
+    def test_export_streams_trip_records(self):
+        trip_id = create_trip("Export Trip", datetime(2024, 6, 1).date(), datetime(2024, 6, 2).date())
+        other_id = create_trip("Other Trip", datetime(2024, 7, 1).date(), datetime(2024, 7, 2).date())
+        add_activity_to_day(trip_id, '2024-06-02', 'Opera, balcony', '07:30 PM', 90.0, None, None, 'OP1')
+        add_activity_to_day(other_id, '2024-07-01', 'Not exported', None, 0.0, None, None, None)
+        add_hotel_to_trip(trip_id, 400.0, 'Grand', '1 Main St', 1, 'G1')
+
+        records = list(bulk_export.iter_records([trip_id], fetch_size=1))
+        self.assertEqual([record['type'] for record in records], ['trip', 'hotel', 'activity'])
+        self.assertTrue(all(record.get('trip_key', record.get('key')) == str(trip_id) for record in records))
+
+        calendar = bulk_export.export_text('ics', [trip_id])
+        self.assertIn('DTSTART:20240602T193000\r\n', calendar)
+        self.assertIn('SUMMARY:Opera\\, balcony\r\n', calendar)
+
+    def test_transaction_rolls_back_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with transaction(immediate=True) as conn:
+                conn.execute("INSERT INTO trips (title, start_day, end_day) VALUES ('Rollback', 19723, 19724)")
+                raise RuntimeError("abort")
+
+        self.assertEqual(len(get_all_trips()), 0)
+
+    def test_write_queue_commits_writes_together_and_isolates_failures(self):
+        def insert(conn, title, fail=False):
+            trip_id = conn.execute("INSERT INTO trips (title, start_day, end_day) VALUES (?, 19723, 19724)",
+                                   (title,)).lastrowid
+            if fail:
+                raise ValueError(title)
+            return trip_id
+
+        writes = WriteQueue(max_delay=0.5)
+        futures = [writes.submit(insert, f"Queued {n}") for n in range(5)]
+        failed = writes.submit(insert, "Failed", True)
+        writes.close()
+
+        self.assertEqual((writes.batches, writes.writes), (1, 6))
+        self.assertEqual(len({future.result() for future in futures}), 5)
+        with self.assertRaises(ValueError):
+            failed.result()
+        self.assertEqual(sorted(trip.title for trip in get_all_trips()), [f"Queued {n}" for n in range(5)])
+
+    def test_async_db_gathers_independent_reads(self):
+        async def plan_trip():
+            trip_id = await async_db.create_trip("Async Test Trip", "2024-06-01", "2024-06-03")
+            await asyncio.gather(
+                async_db.add_flight_to_trip(trip_id, 200.0, "1A", "Test Air", "TA1", "F1"),
+                async_db.add_hotel_to_trip(trip_id, 300.0, "Harbour Inn", "12 Lisbon Road", 1, "H1"),
+                async_db.add_activity_to_day(trip_id, "2024-06-02", "Museum", "10:00 AM", 15.0, None, None, None),
+            )
+            flights, hotels, itinerary = await asyncio.gather(
+                async_db.get_flights_for_trip(trip_id),
+                async_db.get_hotels_for_trip(trip_id),
+                async_db.get_itinerary_range(trip_id, "2024-06-01", "2024-06-03"),
+            )
+            await async_db.delete_trip(trip_id)
+            return flights, hotels, itinerary, await async_db.get_trip_by_id(trip_id)
+
+        flights, hotels, itinerary, deleted = asyncio.run(plan_trip())
+        self.assertEqual([flight.airline for flight in flights], ["Test Air"])
+        self.assertEqual([hotel.name for hotel in hotels], ["Harbour Inn"])
+        self.assertEqual([activity.name for activity in itinerary["2024-06-02"]], ["Museum"])
+        self.assertIsNone(deleted)
+
+    def test_api_revalidates_with_etags_and_batches_requests(self):
+        status, _, trip = api.dispatch('POST', '/trips', {"title": "API Test Trip", "start_date": "2024-06-01",
+                                                          "end_date": "2024-06-03"})
+        self.assertEqual(status, 201)
+        status, etag, _ = api.dispatch('GET', f'/trips/{trip.id}/bundle')
+        self.assertEqual((status, api.dispatch('GET', f'/trips/{trip.id}/bundle', if_none_match=etag)[0]), (200, 304))
+
+        api.dispatch('POST', f'/trips/{trip.id}/activities', {"date": "2024-06-02", "name": "Museum", "cost": 15.0})
+        status, new_etag, bundle = api.dispatch('GET', f'/trips/{trip.id}/bundle', if_none_match=etag)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(bundle['itinerary']["2024-06-02"][0].name, "Museum")
+
+        status, _, result = api.dispatch('POST', '/batch', {"requests": [f'/trips/{trip.id}',
+                                                                         {"path": "/trips/0", "etag": etag}]})
+        self.assertEqual([response['status'] for response in result['responses']], [200, 404])
+        self.assertEqual(api.dispatch('POST', '/trips', {"title": "No Dates"})[0], 400)
+        create_trip("Second API Trip", datetime(2024, 7, 1).date(), datetime(2024, 7, 2).date())
+        self.assertEqual(len(api.dispatch('GET', '/trips?limit=-1')[2]), 1)
+        self.assertEqual(api.dispatch('GET', '/search?q=api&limit=x')[0], 400)
+
+        server = api.serve(port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        min_gzip_size, api.MIN_GZIP_SIZE = api.MIN_GZIP_SIZE, 0
+        try:
+            conn = http.client.HTTPConnection(*server.server_address)
+            for _ in range(2):
+                conn.request('GET', f'/trips/{trip.id}/bundle', headers={'Accept-Encoding': 'gzip'})
+                response = conn.getresponse()
+                body = gzip.decompress(response.read())
+                self.assertEqual(response.getheader('ETag'), new_etag)
+            self.assertFalse(response.will_close)
+            self.assertIn(b'"Museum"', body)
+            conn.close()
+            for length in ('-1', 'ten'):
+                conn = http.client.HTTPConnection(*server.server_address)
+                conn.request('POST', '/trips', headers={'Content-Length': length})
+                response = conn.getresponse()
+                self.assertEqual((response.status, response.will_close), (400, True))
+                conn.close()
+        finally:
+            api.MIN_GZIP_SIZE = min_gzip_size
+            server.shutdown()
+            server.server_close()
+
+    def test_use_database_switches_between_targets(self):
+        create_trip("Memory Trip", datetime(2024, 1, 1).date(), datetime(2024, 1, 2).date())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trips.db')
+            connection.use_database(path)
+            self.assertEqual(get_all_trips(), [])
+            create_trip("File Trip", datetime(2024, 1, 1).date(), datetime(2024, 1, 2).date())
+            on_disk = sqlite3.connect(path)
+            self.assertEqual(on_disk.execute('SELECT title FROM trips').fetchall(), [("File Trip",)])
+            on_disk.close()
+
+            connection.use_database('file:shared_test?mode=memory&cache=shared')
+            create_trip("Shared Trip", datetime(2024, 1, 1).date(), datetime(2024, 1, 2).date())
+            self.assertEqual([trip.title for trip in get_all_trips()], ["Shared Trip"])
+            connection.use_database(':memory:')
+        self.assertEqual(get_all_trips(), [])
+
+    def test_instrumentation_records_calls_statements_and_slow_query_plans(self):
+        slow_query_ms, instrumentation.SLOW_QUERY_MS = instrumentation.SLOW_QUERY_MS, 0
+        instrumentation.reset()
+        instrumentation.enable()
+        try:
+            rerun = instrumentation.start_rerun()
+            trip_id = create_trip("Traced Trip", datetime(2024, 1, 1).date(), datetime(2024, 1, 2).date())
+            add_flight_to_trip(trip_id, 300.0, "12A", "TAP", "TP100", "ABC123")
+            get_flights_for_trip(trip_id)
+            get_flights_for_trip(trip_id)
+
+            calls, queries, rows, _ = rerun.functions['get_flights_for_trip']
+            self.assertEqual((calls, rows), (2, 2))
+            self.assertGreaterEqual(queries, 1)
+            # The insert runs on the write queue's thread but counts for the call that submitted it
+            self.assertGreaterEqual(rerun.functions['add_flight_to_trip'][1], 1)
+
+            plans = [entry['plan'] for entry in instrumentation.slow_queries()
+                     if entry['sql'].lstrip().startswith('SELECT') and 'FROM flights' in entry['sql']]
+            self.assertTrue(plans)
+            self.assertIn('flights', ' '.join(plans[0]))
+            metrics = instrumentation.metrics_text()
+            self.assertIn('trips_db_call_duration_seconds_count{function="get_flights_for_trip"} 2', metrics)
+            self.assertIn('trips_db_call_rows_total{function="get_flights_for_trip"} 2', metrics)
+            # A run can keep adding to the statistics of the callbacks that ran before it
+            self.assertIs(instrumentation.start_rerun(rerun), rerun)
+            get_flights_for_trip(trip_id)
+            self.assertEqual(rerun.functions['get_flights_for_trip'][0], 3)
+        finally:
+            instrumentation.disable()
+            instrumentation.reset()
+            instrumentation.SLOW_QUERY_MS = slow_query_ms
+
+    def test_benchmark_generator_is_reproducible_and_compare_flags_regressions(self):
+        scale = {'trips': 3, 'days': 2, 'activities': 2, 'flights': 1, 'hotels': 1}
+        dumps = []
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('first.db', 'second.db'):
+                benchmark.generate(os.path.join(directory, name), seed=7, **scale)
+                self.assertEqual(len(get_all_trips()), 3)
+                self.assertEqual(len(get_flights_for_trip(1)), 1)
+                with transaction() as conn:
+                    dumps.append([conn.execute(f'SELECT * FROM {table} ORDER BY id').fetchall()
+                                  for table in ('trips', 'activities', 'flights', 'hotels')])
+            connection.use_database(':memory:')
+        self.assertEqual(dumps[0], dumps[1])
+        self.assertEqual(len(dumps[0][1]), 12)
+
+        def result(p50_ms, queries_per_op):
+            return {'operations': {'search': {'p50_ms': p50_ms, 'p99_ms': p50_ms, 'queries_per_op': queries_per_op}}}
+        self.assertEqual(benchmark.compare(result(1.0, 1), result(1.1, 1), threshold=0.2), [])
+        self.assertEqual(benchmark.compare(result(1.0, 1), result(1.5, 2), threshold=0.2),
+                         [('search', 'p50_ms', 1.0, 1.5), ('search', 'queries_per_op', 1, 2)])
+
+    def test_nested_transaction_reuses_connection(self):
+        with transaction() as outer:
+            with transaction() as inner:
+                self.assertIs(inner, outer)
+
 
 if __name__ == '__main__':
     unittest.main()
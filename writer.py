@@ -0,0 +1,190 @@
+import atexit
+import contextvars
+import functools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import connection
+from connection import transaction
+
+# Longest time, in seconds, the first write of a batch waits for others to join its commit.
+MAX_DELAY = 0.002
+
+# Most writes committed together in one transaction.
+MAX_BATCH = 256
+
+_STOP = object()
+
+
+class WriteQueue:
+    """
+    A single writer thread that applies writes from every session and commits them in groups.
+
+    Callers hand over a unit of work and get a Future back. The writer thread takes the first queued
+    write, waits at most ``max_delay`` seconds for more to arrive, then runs the whole batch in one
+    ``BEGIN IMMEDIATE`` transaction and commits once, so concurrent writers share a single commit
+    instead of queueing for the lock and syncing the log one by one.
+
+    Each write runs in its own savepoint, so a write that raises is rolled back alone and its caller
+    receives the exception while the rest of the batch still commits. Futures are resolved only once
+    the batch has committed; if the commit itself fails, every write in the batch fails with it.
+
+    Attributes:
+        max_delay (float): Seconds the first write of a batch waits for others to join it.
+        max_batch (int): The most writes committed in one transaction.
+        batches (int): The number of batch transactions committed so far.
+        writes (int): The number of writes applied in those batches.
+    """
+
+    def __init__(self, max_delay=MAX_DELAY, max_batch=MAX_BATCH):
+        """
+        Initialize a WriteQueue object. The writer thread starts with the first submitted write.
+
+        Args:
+            max_delay (float): Seconds the first write of a batch waits for others to join it.
+            max_batch (int): The most writes committed in one transaction.
+        """
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, work, *args):
+        """
+        Queue a write for the writer thread.
+
+        Args:
+            work (callable): Called as ``work(conn, *args)`` on the writer's connection, inside the
+                batch transaction. Must not commit or roll back.
+            *args: Extra arguments passed to ``work``.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the return value of ``work`` after the batch commits,
+                or to the exception it raised.
+        """
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+                self._thread.start()
+            # Run the write in the caller's context, so context variables such as the db.py call being
+            # instrumented carry over to the writer thread.
+            self._queue.put((future, functools.partial(contextvars.copy_context().run, work), args))
+        return future
+
+    def run(self, work, *args):
+        """
+        Apply a write through the queue and wait for it to commit.
+
+        When the calling thread is already inside a ``transaction()`` block, the write runs directly
+        on that transaction instead, so it commits or rolls back together with the caller's work.
+
+        Args:
+            work (callable): Called as ``work(conn, *args)``. Must not commit or roll back.
+            *args: Extra arguments passed to ``work``.
+
+        Returns:
+            The return value of ``work``.
+        """
+        if connection.in_transaction():
+            with transaction() as conn:
+                return work(conn, *args)
+        return self.submit(work, *args).result()
+
+    def close(self):
+        """
+        Commit the writes already queued and stop the writer thread.
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            if thread is None:
+                return
+            self._queue.put(_STOP)
+        thread.join()
+
+    def _collect(self, first):
+        """
+        Gather a batch starting with the given write, waiting up to max_delay for more to arrive.
+
+        Returns:
+            tuple: (batch, stop), where stop is True if the queue was closed while collecting.
+        """
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        """
+        Writer thread loop: collect a batch, apply it in one transaction and resolve its futures.
+        """
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch, stop = self._collect(item)
+            outcomes = []
+            try:
+                with transaction(immediate=True) as conn:
+                    for future, work, args in batch:
+                        outcomes.append(_apply(conn, future, work, args))
+            except BaseException as error:
+                for future, _, _ in batch:
+                    if not future.cancelled():
+                        future.set_exception(error)
+                continue
+            self.batches += 1
+            self.writes += sum(outcome is not None for outcome in outcomes)
+            for (future, _, _), outcome in zip(batch, outcomes):
+                if outcome is None:
+                    continue
+                ok, value = outcome
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+
+def _apply(conn, future, work, args):
+    """
+    Run one write inside a savepoint, rolling back only that write if it raises.
+
+    Returns:
+        tuple: (True, result) on success, (False, exception) if the write raised, or None if its
+            caller cancelled it before it ran.
+    """
+    if not future.set_running_or_notify_cancel():
+        return None
+    conn.execute('SAVEPOINT write_queue')
+    try:
+        result = work(conn, *args)
+    except Exception as error:
+        conn.execute('ROLLBACK TO write_queue')
+        conn.execute('RELEASE write_queue')
+        return False, error
+    conn.execute('RELEASE write_queue')
+    return True, result
+
+
+write_queue = WriteQueue()
+atexit.register(write_queue.close)